@@ -0,0 +1,404 @@
+# Ingest benchmark suite for NVD_Loader
+import os, sys, json, csv, time, threading, argparse, resource, statistics, zipfile, subprocess
+from urllib.parse import unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from NVD_Loader import NVDLoader
+
+
+class ElasticsearchStandIn(BaseHTTPRequestHandler):
+    """Just enough of the Elasticsearch REST API for the loader, served from memory.
+
+    Covers index creation (recording each index's mappings), settings, refresh and force merge, ``_cat/indices``, ``_bulk``
+    and single document writes. ``reject_statuses`` hands out item statuses for the next
+    bulk items, which lets callers simulate 429s and mapping errors, and the next
+    ``drop_bulk_requests`` bulk requests are answered by closing the connection.
+    """
+    documents = {}
+    indices = set()
+    settings = {}
+    mappings = {}
+    calls = []
+    reject_statuses = []
+    drop_bulk_requests = 0
+    store_sources = True
+    took = 3
+
+    @classmethod
+    def serve(cls, store_sources=True):
+        # each server gets its own subclass so concurrent stand-ins never share state
+        handler = type('ElasticsearchStandInHandler', (cls,), {'documents': {}, 'indices': set(), 'settings': {}, 'mappings': {}, 'calls': [],
+                                                               'reject_statuses': [], 'drop_bulk_requests': 0,
+                                                               'store_sources': store_sources})
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server, handler, f'http://127.0.0.1:{server.server_address[1]}'
+
+    @classmethod
+    def serve_process(cls, store_sources=True):
+        # Runs the stand-in in its own process, so answering requests adds nothing to the client's CPU time or GIL contention
+        # Returns (process, url); terminate the process when done
+        command = [sys.executable, os.path.abspath(__file__), '--serve-stand-in'] + ([] if store_sources else ['--no-store-sources'])
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+        url = process.stdout.readline().strip()
+        if not url:
+            process.wait()
+            raise RuntimeError(f'the Elasticsearch stand-in exited with status {process.returncode}')
+        return process, url
+
+    def reply(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_HEAD(self):
+        index = self.path.split('?')[0].strip('/').split('/')[0]
+        self.reply(200 if index in self.indices else 404, {})
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path.startswith('/_cat/indices'):
+            self.reply(200, [{'index': index, 'docs.count': str(len(self.documents.get(index, {})))} for index in sorted(self.indices)])
+        elif path.endswith('/_settings'):
+            index = path.strip('/').split('/')[0]
+            self.reply(200, {index: {'settings': dict(self.settings.get(index, {}))}})
+        elif path.startswith('/_cluster/health'):
+            self.reply(200, {'status': 'green', 'timed_out': False})
+        elif '/_doc/' in path:
+            index, _id = path.strip('/').split('/_doc/', 1)
+            source = self.documents.get(index, {}).get(unquote(_id))
+            if source is None:
+                self.reply(404, {'_index': index, '_id': unquote(_id), 'found': False})
+            else:
+                self.reply(200, {'_index': index, '_id': unquote(_id), 'found': True, '_source': source})
+        else:
+            self.reply(200, {'version': {'number': '8.6.0'}, 'tagline': 'You Know, for Search'})
+
+    def do_DELETE(self):
+        index = self.path.split('?')[0].strip('/').split('/')[0]
+        if index not in self.indices:
+            self.reply(404, {'error': {'type': 'index_not_found_exception'}, 'status': 404})
+            return
+        self.indices.discard(index)
+        self.documents.pop(index, None)
+        self.settings.pop(index, None)
+        self.mappings.pop(index, None)
+        self.reply(200, {'acknowledged': True})
+
+    def do_PUT(self):
+        if self.path.split('?')[0].endswith('/_bulk'):
+            return self.do_POST()
+        body = self.read_body()
+        parts = self.path.split('?')[0].strip('/').split('/')
+        self.calls.append(('PUT', self.path.split('?')[0]))
+        if len(parts) == 1:
+            self.indices.add(parts[0])
+            self.settings[parts[0]] = dict(json.loads(body).get('settings', {})) if body else {}
+            self.mappings[parts[0]] = json.loads(body).get('mappings', {}) if body else {}
+            self.reply(200, {'acknowledged': True, 'index': parts[0]})
+        elif parts[1] == '_settings':
+            settings = self.settings.setdefault(parts[0], {})
+            for key, value in json.loads(body).items():
+                if value is None:
+                    settings.pop(key, None)
+                else:
+                    settings[key] = value
+            self.reply(200, {'acknowledged': True})
+        else:
+            self.store(parts[0], unquote(parts[-1]), json.loads(body))
+            self.reply(201, {'_index': parts[0], '_id': unquote(parts[-1]), 'result': 'created'})
+
+    def do_POST(self):
+        body = self.read_body()
+        path = self.path.split('?')[0]
+        if path.endswith('/_bulk') and self.drop_bulk_requests:
+            type(self).drop_bulk_requests -= 1
+            self.close_connection = True
+            return
+        if path.endswith('/_bulk'):
+            lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+            items = []
+            i = 0
+            while i < len(lines):
+                op_type, meta = next(iter(lines[i].items()))
+                source = lines[i + 1] if op_type != 'delete' else None
+                i += 1 if op_type == 'delete' else 2
+                status = self.reject_statuses.pop(0) if self.reject_statuses else 201
+                if status == 201 and op_type == 'create' and meta.get('_id') in self.documents.get(meta.get('_index'), {}):
+                    status = 409
+                if status == 201:
+                    self.store(meta.get('_index'), meta.get('_id'), source)
+                items.append({op_type: {'_index': meta.get('_index'), '_id': meta.get('_id'), 'status': status}})
+            self.reply(200, {'took': self.took, 'errors': any(item[next(iter(item))]['status'] >= 300 for item in items), 'items': items})
+        elif path.endswith('/_refresh') or path.endswith('/_forcemerge'):
+            self.calls.append(('POST', path))
+            self.reply(200, {'_shards': {'total': 1, 'successful': 1, 'failed': 0}})
+        else:
+            parts = path.strip('/').split('/')
+            self.store(parts[0], unquote(parts[-1]) if len(parts) > 2 else None, json.loads(body))
+            self.reply(201, {'_index': parts[0], 'result': 'created'})
+
+    def store(self, index, _id, source):
+        self.indices.add(index)
+        documents = self.documents.setdefault(index, {})
+        documents[_id if _id is not None else str(len(documents))] = source if self.store_sources else None
+
+    def log_message(self, format, *args):
+        pass
+
+
+# ingest options for every case; 'processes' runs the case through parallel_ingest_json_dataset
+BENCHMARK_CASES = {
+    'singleton': {'ingest_method': 'singleton'},
+    'bulk': {'ingest_method': 'bulk'},
+    'parallel_bulk': {'ingest_method': 'parallel_bulk'},
+    'streaming_bulk': {'ingest_method': 'streaming_bulk'},
+    'adaptive_bulk': {'ingest_method': 'adaptive_bulk'},
+    'ndjson_bulk': {'ingest_method': 'ndjson_bulk'},
+    'ndjson_bulk_load': {'ingest_method': 'ndjson_bulk', 'bulk_load': True},
+    'ndjson_bulk_cache': {'ingest_method': 'ndjson_bulk', 'parse_method': 'cache'},
+    'async': {'ingest_method': 'async', 'concurrency': 4},
+    'process_pool': {'ingest_method': 'ndjson_bulk', 'processes': os.cpu_count()}
+}
+
+# metrics compared against a baseline, and whether a higher value is better
+BASELINE_METRICS = {'docs_per_second': True, 'mb_per_second': True, 'p95_latency_ms': False, 'cpu_seconds': False, 'peak_rss_mb': False}
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+
+def reset_peak_rss():
+    # Linux resets VmHWM when 5 is written to clear_refs; elsewhere the peak is process wide
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_bytes():
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class IngestBenchmark:
+    """Times NVDLoader ingest methods over the same files, with warmup and repetitions.
+
+    Each run reports docs/s, MB/s of source JSON, p50/p95/p99 bulk request latency,
+    client CPU seconds and peak RSS. Results can be written as JSON or CSV and compared
+    against a stored baseline.
+    """
+
+    def __init__(self, loader, file_list, data_path, target_index='nvd_benchmark', warmup=1, repetitions=3, verbose=True):
+        self.loader = loader
+        self.file_list = file_list
+        self.data_path = data_path
+        self.target_index = target_index
+        self.warmup = warmup
+        self.repetitions = repetitions
+        self.verbose = verbose
+        self.latencies = []
+        self.from_workers = False
+        self.documents = sum(sum(1 for _ in loader.read_cve_items(os.path.join(data_path, file))) for file in file_list)
+        self.source_bytes = sum(self.source_size(file) for file in file_list)
+        self.time_bulk_requests()
+
+    def source_size(self, file):
+        # MB/s is measured on the uncompressed JSON, whether the feed is extracted or still zipped
+        path = os.path.join(self.data_path, file)
+        if file.endswith('.zip'):
+            with zipfile.ZipFile(path) as archive:
+                return sum(member.file_size for member in archive.infolist())
+        return os.path.getsize(path)
+
+    def time_bulk_requests(self):
+        # every client made with .options() shares the transport, so timing it catches the bulk helpers' requests too
+        transport = self.loader.client.transport
+        perform_request = transport.perform_request
+
+        def timed_perform_request(method, target, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return perform_request(method, target, *args, **kwargs)
+            finally:
+                if target.split('?')[0].endswith('/_bulk'):
+                    self.latencies.append(time.perf_counter() - start)
+
+        transport.perform_request = timed_perform_request
+        # the async ingest makes a fresh AsyncElasticsearch for every run
+        async_client = self.loader.async_client
+
+        def timed_async_client():
+            client = async_client()
+            perform_async_request = client.transport.perform_request
+
+            async def timed_perform_async_request(method, target, *args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await perform_async_request(method, target, *args, **kwargs)
+                finally:
+                    if target.split('?')[0].endswith('/_bulk'):
+                        self.latencies.append(time.perf_counter() - start)
+
+            client.transport.perform_request = timed_perform_async_request
+            return client
+
+        self.loader.async_client = timed_async_client
+        # worker processes time their own requests and parallel_ingest_json_dataset replays them into the parent's metrics
+        self.loader.metrics.add_hook(self.record_worker_latency)
+
+    def record_worker_latency(self, kind, name, value, labels):
+        if self.from_workers and kind == 'histogram' and name == 'nvd_stage_seconds' and labels.get('stage') == 'bulk':
+            self.latencies.append(value)
+
+    def run_once(self, options):
+        self.loader.client.options(ignore_status=404).indices.delete(index=self.target_index)
+        options = dict(options)
+        processes = options.pop('processes', None)
+        self.latencies = []
+        self.from_workers = bool(processes)
+        reset_peak_rss()
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        if processes:
+            self.loader.parallel_ingest_json_dataset(self.file_list, self.target_index, data_path=self.data_path, processes=processes, verbose=False, **options)
+        else:
+            self.loader.ingest_bulk_json_dataset(self.file_list, self.target_index, data_path=self.data_path, verbose=False, **options)
+        seconds = time.perf_counter() - start
+        cpu_seconds = time.process_time() - cpu_start
+        children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_seconds += (children_after.ru_utime - children.ru_utime) + (children_after.ru_stime - children.ru_stime)
+        latencies = [latency * 1000 for latency in self.latencies]
+        return {
+            'seconds': round(seconds, 3),
+            'docs_per_second': round(self.documents / seconds, 2) if seconds else 0.0,
+            'mb_per_second': round(self.source_bytes / (1024 * 1024) / seconds, 2) if seconds else 0.0,
+            'bulk_requests': len(latencies),
+            'p50_latency_ms': round(percentile(latencies, 0.50), 2) if latencies else None,
+            'p95_latency_ms': round(percentile(latencies, 0.95), 2) if latencies else None,
+            'p99_latency_ms': round(percentile(latencies, 0.99), 2) if latencies else None,
+            'cpu_seconds': round(cpu_seconds, 3),
+            'peak_rss_mb': round(peak_rss_bytes() / (1024 * 1024), 1)
+        }
+
+    def run_case(self, name, options):
+        for i in range(self.warmup):
+            if self.verbose == True:
+                print(f'{name}: warmup {i + 1} of {self.warmup}')
+            self.run_once(options)
+        runs = []
+        for i in range(self.repetitions):
+            runs.append(self.run_once(options))
+            if self.verbose == True:
+                print(f"{name}: run {i + 1} of {self.repetitions}, {runs[-1]['docs_per_second']} docs/s")
+        summary = {'case': name, 'documents': self.documents, 'repetitions': self.repetitions}
+        for metric in runs[0]:
+            values = [run[metric] for run in runs if run[metric] is not None]
+            summary[metric] = round(statistics.median(values), 3) if values else None
+        summary['runs'] = runs
+        return summary
+
+    def run(self, cases=None):
+        cases = cases or list(BENCHMARK_CASES)
+        try:
+            return [self.run_case(name, BENCHMARK_CASES[name]) for name in cases]
+        finally:
+            self.loader.client.options(ignore_status=404).indices.delete(index=self.target_index)
+
+    def write_json(self, results, path):
+        with open(path, 'w') as f:
+            f.write(json.dumps(results, indent=2))
+
+    def write_csv(self, results, path):
+        fields = [field for field in results[0] if field != 'runs']
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(results)
+
+    def compare_to_baseline(self, results, baseline_path, tolerance=0.1):
+        # Returns the metrics that moved the wrong way by more than tolerance against a JSON file written by write_json
+        with open(baseline_path, 'r') as f:
+            baseline = {result['case']: result for result in json.loads(f.read())}
+        regressions = []
+        for result in results:
+            previous = baseline.get(result['case'])
+            if previous is None:
+                continue
+            for metric, higher_is_better in BASELINE_METRICS.items():
+                current, expected = result.get(metric), previous.get(metric)
+                if not current or not expected:
+                    continue
+                change = (current - expected) / expected
+                if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                    regressions.append({'case': result['case'], 'metric': metric, 'baseline': expected, 'current': current, 'change': round(change, 3)})
+        return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark NVDLoader ingest methods')
+    parser.add_argument('--data-path', default=os.path.join(os.curdir, 'demo', 'data', 'db'))
+    parser.add_argument('--files', nargs='*', help='feed files in data-path, all .json and .json.zip files by default')
+    parser.add_argument('--cases', nargs='*', choices=list(BENCHMARK_CASES), help='cases to run, all by default')
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--repetitions', type=int, default=3)
+    parser.add_argument('--elastic-url', help='benchmark against this cluster instead of the in-memory stand-in')
+    parser.add_argument('--output-json', default='nvd_benchmark.json')
+    parser.add_argument('--output-csv', default='nvd_benchmark.csv')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--serve-stand-in', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--no-store-sources', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve_stand_in:
+        # the child side of ElasticsearchStandIn.serve_process: print the URL, then serve until terminated
+        server, _, url = ElasticsearchStandIn.serve(store_sources=not args.no_store_sources)
+        print(url, flush=True)
+        threading.Event().wait()
+
+    server = None
+    if args.elastic_url:
+        loader = NVDLoader(elastic_url=args.elastic_url)
+    else:
+        server, url = ElasticsearchStandIn.serve_process(store_sources=False)
+        loader = NVDLoader(elastic_url=url)
+    files = args.files or sorted(x for x in os.listdir(args.data_path) if x.endswith('.json') or x.endswith('.json.zip'))
+    try:
+        benchmark = IngestBenchmark(loader, files, args.data_path, warmup=args.warmup, repetitions=args.repetitions)
+        results = benchmark.run(args.cases)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    benchmark.write_json(results, args.output_json)
+    benchmark.write_csv(results, args.output_csv)
+    if args.baseline:
+        regressions = benchmark.compare_to_baseline(results, args.baseline, tolerance=args.tolerance)
+        for regression in regressions:
+            print(f"Regression in {regression['case']}: {regression['metric']} {regression['baseline']} -> {regression['current']} ({regression['change']:+.1%})")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
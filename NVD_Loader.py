@@ -1,22 +1,1095 @@
 # Assemble code into a class
-import os, requests, zipfile, json, time, xmltodict, datetime
-from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk, parallel_bulk, streaming_bulk
-import sys, logging
+import os, requests, zipfile, json, time, xmltodict, datetime, gzip, random, hashlib, sqlite3, zlib, base64
+from elasticsearch import Elasticsearch, AsyncElasticsearch, ApiError, ConnectionError as ElasticsearchConnectionError
+from elasticsearch.helpers import bulk, parallel_bulk, streaming_bulk, expand_action, async_streaming_bulk
+import sys, logging, threading, io, asyncio, itertools, re
+import xml.etree.ElementTree as ElementTree
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from collections import deque
 import numpy as np
 import pandas as pd
 import yaml
 from yaml import Loader
-from copy import deepcopy
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:
+    pa = None
+
+
+def dumps_json(document):
+    """Encode ``document`` as compact UTF-8 JSON bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(document, default=str)
+    return json.dumps(document, separators=(',', ':'), default=str).encode('utf-8')
+
+
+def loads_json(data):
+    # data may be bytes or a memoryview into a memory mapped cache file
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(bytes(data))
+
+
+class NdjsonChunk:
+    """A pre-serialized ``_bulk`` body and the offset at which each document's lines start.
+
+    Indexing returns the lines of one document, which is only needed for items the
+    cluster rejected, so successful documents are never split back out of the body.
+    """
+
+    def __init__(self, body, offsets):
+        self.body = body
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, position):
+        start = self.offsets[position]
+        end = self.offsets[position + 1] if position + 1 < len(self.offsets) else len(self.body)
+        return self.body[start:end].rstrip(b'\n').split(b'\n')
+
+
+def run_coroutine(coroutine):
+    # asyncio.run refuses to start inside a running loop, as in a Jupyter kernel, so run it on a fresh thread there
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+@contextmanager
+def open_feed(file_path):
+    """Open a feed as a text stream, reading the member of a .zip archive in place."""
+    if file_path.endswith('.zip'):
+        with zipfile.ZipFile(file_path) as archive:
+            member = [name for name in archive.namelist() if not name.endswith('/')][0]
+            with archive.open(member) as raw:
+                yield io.TextIOWrapper(raw, encoding='utf-8')
+    else:
+        with open(file_path, 'r') as f:
+            yield f
+
+
+JSON_STRUCTURE = re.compile(r'["{}\[\]:,]')
+JSON_STRING_BODY = re.compile(r'(?:[^"\\]|\\.)*"', re.DOTALL)
+JSON_KEY_SEPARATOR = re.compile(r'\s*(:\s*)?')
+
+
+def iter_json_array(file_obj, key, chunk_size=1024 * 1024):
+    """Yield the elements of the top level array stored under ``key`` one at a time.
+
+    Only a single chunk plus the element being decoded is held in memory, so the
+    footprint stays flat regardless of the size of the feed. ``key`` only matches a
+    key of the outermost object, never a string value or a key of a nested object.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    eof = False
+    # walk the structure up to the key, tracking the object depth and whether the next string is a key
+    depth = 0
+    expect_key = False
+    position = 0
+    while True:
+        token = JSON_STRUCTURE.search(buffer, position)
+        keep = None
+        if token is None:
+            keep = len(buffer)
+        elif token.group() == '"':
+            body = JSON_STRING_BODY.match(buffer, token.end())
+            if body is None:
+                keep = token.start()
+            elif depth == 1 and expect_key and json.loads(buffer[token.start():body.end()]) == key:
+                separator = JSON_KEY_SEPARATOR.match(buffer, body.end())
+                if separator.end() == len(buffer):
+                    keep = token.start()
+                elif separator.group(1) is None or buffer[separator.end()] != '[':
+                    raise ValueError(f'{key} is not an array')
+                else:
+                    buffer = buffer[separator.end() + 1:]
+                    break
+            else:
+                position = body.end()
+        else:
+            char = token.group()
+            position = token.end()
+            if char in '{[':
+                depth += 1
+                expect_key = char == '{' and depth == 1
+            elif char in '}]':
+                depth -= 1
+            elif char == ',':
+                expect_key = depth == 1
+            elif char == ':' and depth == 1:
+                expect_key = False
+        if keep is not None:
+            # the rest of the buffer is scanned, or holds a string or key that may continue in the next chunk
+            if eof:
+                return
+            buffer = buffer[keep:]
+            position = 0
+            chunk = file_obj.read(chunk_size)
+            eof = not chunk
+            buffer += chunk
+    position = 0
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        try:
+            if position >= len(buffer):
+                raise ValueError('buffer exhausted')
+            item, end = decoder.raw_decode(buffer, position)
+            if end == len(buffer) and not eof:
+                raise ValueError('item may continue in the next chunk')
+        except ValueError:
+            if eof:
+                raise ValueError(f'Unexpected end of file while reading {key}')
+            buffer = buffer[position:]
+            position = 0
+            chunk = file_obj.read(chunk_size)
+            eof = not chunk
+            buffer += chunk
+            continue
+        yield item
+        position = end
+        if position > chunk_size:
+            buffer = buffer[position:]
+            position = 0
+
+
+def xml_element_to_dict(element, prefixes):
+    # Same shape as xmltodict: '@' attributes, prefixed names, '#text' beside attributes, repeated children as lists
+    def name(tag):
+        if tag.startswith('{'):
+            uri, local = tag[1:].split('}', 1)
+            prefix = prefixes.get(uri, '')
+            return f'{prefix}:{local}' if prefix else local
+        return tag
+    document = {f'@{name(key)}': value for key, value in element.attrib.items()}
+    for child in element:
+        key, value = name(child.tag), xml_element_to_dict(child, prefixes)
+        if key in document:
+            if not isinstance(document[key], list):
+                document[key] = [document[key]]
+            document[key].append(value)
+        else:
+            document[key] = value
+    text = element.text.strip() if element.text else ''
+    if text:
+        if not document:
+            return text
+        document['#text'] = text
+    return document or None
+
+
+def iter_xml_items(file_obj, tag):
+    """Yield each ``tag`` element below the root as a dict, as soon as its end tag is read.
+
+    Converted elements are removed from the tree, so memory stays at one item however
+    large the document is.
+    """
+    prefixes = {'http://www.w3.org/XML/1998/namespace': 'xml'}
+    root = None
+    depth = 0
+    for event, element in ElementTree.iterparse(file_obj, events=('start-ns', 'start', 'end')):
+        if event == 'start-ns':
+            prefix, uri = element
+            prefixes.setdefault(uri, prefix)
+        elif event == 'start':
+            if root is None:
+                root = element
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 1:
+                if element.tag.split('}')[-1] == tag:
+                    yield xml_element_to_dict(element, prefixes)
+                root.remove(element)
+
+
+# description of each metric NVDLoader records, the first line of its Prometheus exposition
+METRIC_HELP = {
+    'nvd_stage_seconds': 'Duration of one download, extract, file ingest or bulk request, by stage',
+    'nvd_stage_seconds_total': 'Cumulative time spent in each stage, including parse and serialize time interleaved with sending',
+    'nvd_download_bytes_total': 'Bytes written by feed downloads',
+    'nvd_documents_total': 'Documents read from source files',
+    'nvd_documents_sent_total': 'Documents Elasticsearch acknowledged',
+    'nvd_documents_failed_total': 'Document rejections Elasticsearch returned, by status; a retried document counts once per rejection',
+    'nvd_documents_coalesced_total': 'Superseded CVE versions coalesce_feeds kept from being sent',
+    'nvd_bulk_bytes_total': 'Bytes of _bulk request bodies sent',
+    'nvd_bulk_requests_total': 'Bulk requests sent',
+    'nvd_retries_total': 'Documents sent again after a retryable failure',
+    'nvd_dead_letters_total': 'Documents written to a dead letter file',
+    'nvd_documents_per_second': 'Documents per second of the last ingested file',
+    'nvd_queue_bytes': 'Bytes of built but unsent actions held by BoundedActionBuffer',
+    'nvd_queue_items': 'Built but unsent actions held by BoundedActionBuffer',
+    'nvd_bulk_requests_in_flight': 'Bulk requests awaiting a response',
+    'nvd_files_total': 'Files in the current ingest',
+    'nvd_files_completed': 'Files of the current ingest that are done'
+}
+
+
+class IngestMetrics:
+    """Counters, gauges and histograms for an NVDLoader, exposed in the Prometheus text format.
+
+    Every event is also passed to the callbacks registered with add_hook as
+    ``hook(kind, name, value, labels)``. write_text writes a textfile collector file and
+    serve starts a /metrics endpoint on a background thread.
+    """
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+    def __init__(self, textfile_path=None):
+        self.textfile_path = textfile_path
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.hooks = []
+        self.lock = threading.Lock()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def emit(self, kind, name, value, labels):
+        for hook in self.hooks:
+            hook(kind, name, value, labels)
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+        self.emit('counter', name, value, labels)
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+        self.emit('gauge', name, value, labels)
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            histogram = series[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+        self.emit('histogram', name, value, labels)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, iterable, stage):
+        # Passes iterable through, adding the time spent producing each item to nvd_stage_seconds_total{stage}
+        elapsed = 0.0
+        iterator = iter(iterable)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield item
+        finally:
+            self.inc('nvd_stage_seconds_total', elapsed, stage=stage)
+
+    def value(self, name, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            for metrics in (self.counters, self.gauges):
+                if name in metrics:
+                    return metrics[name].get(key, 0)
+            histogram = self.histograms.get(name, {}).get(key)
+            return dict(histogram, buckets=list(histogram['buckets'])) if histogram else None
+
+    def render(self):
+        def series(name, key, extra=()):
+            escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            labels = ','.join(f'{label}="{escape(value)}"' for label, value in tuple(key) + tuple(extra))
+            return f'{name}{{{labels}}}' if labels else name
+
+        lines = []
+        with self.lock:
+            for kind, metrics in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted(metrics):
+                    lines.append(f'# HELP {name} {METRIC_HELP.get(name, name)}')
+                    lines.append(f'# TYPE {name} {kind}')
+                    for key, value in sorted(metrics[name].items()):
+                        lines.append(f'{series(name, key)} {value}')
+            for name in sorted(self.histograms):
+                lines.append(f'# HELP {name} {METRIC_HELP.get(name, name)}')
+                lines.append(f'# TYPE {name} histogram')
+                for key, histogram in sorted(self.histograms[name].items()):
+                    for bound, count in zip(self.buckets, histogram['buckets']):
+                        lines.append(f'{series(name + "_bucket", key, (("le", bound),))} {count}')
+                    lines.append(f'{series(name + "_bucket", key, (("le", "+Inf"),))} {histogram["count"]}')
+                    lines.append(f'{series(name + "_sum", key)} {histogram["sum"]}')
+                    lines.append(f'{series(name + "_count", key)} {histogram["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def write_text(self, path=None):
+        # write then rename, as the node exporter textfile collector expects
+        path = path or self.textfile_path
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.render())
+        os.replace(path + '.tmp', path)
+
+    def flush(self):
+        if self.textfile_path:
+            self.write_text()
+
+    def serve(self, port=9108, host='0.0.0.0'):
+        # Serves the metrics at http://host:port/metrics until the returned server is shut down
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                payload = metrics.render().encode('utf-8')
+                self.send_response(200 if self.path.split('?')[0] in ('/', '/metrics') else 404)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class BoundedActionBuffer:
+    """Build bulk actions on a background thread while the bulk helpers send them.
+
+    At most ``max_inflight_bytes`` of built but unsent actions are held at once; the
+    producer blocks once the budget is spent and resumes as the sender drains it.
+    Without ``size_of``, action sizes are estimated by encoding one action in
+    ``sample_every`` and charging the others the running mean.
+    """
+
+    def __init__(self, actions, max_inflight_bytes=50 * 1024 * 1024, size_of=None, metrics=None, sample_every=100):
+        self.actions = actions
+        self.sample_every = sample_every
+        self.sampled = 0
+        self.sampled_bytes = 0
+        self.seen = 0
+        self.metrics = metrics
+        self.max_inflight_bytes = max_inflight_bytes
+        self.size_of = size_of or self.action_size
+        self.inflight_bytes = 0
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.finished = False
+        self.stopped = False
+        self.error = None
+
+    def action_size(self, action):
+        # the budget only needs to be approximate, and encoding every source here would serialize each document twice
+        self.seen += 1
+        if self.sampled and (self.seen - 1) % self.sample_every:
+            return self.sampled_bytes // self.sampled
+        self.sampled += 1
+        self.sampled_bytes += len(dumps_json(action.get('_source', action)))
+        return self.sampled_bytes // self.sampled
+
+    def produce(self):
+        try:
+            for action in self.actions:
+                size = self.size_of(action)
+                with self.condition:
+                    while not self.stopped and self.queue and self.inflight_bytes + size > self.max_inflight_bytes:
+                        self.condition.wait()
+                    if self.stopped:
+                        return
+                    self.queue.append((action, size))
+                    self.inflight_bytes += size
+                    self.condition.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+
+    def __iter__(self):
+        producer = threading.Thread(target=self.produce, daemon=True)
+        producer.start()
+        taken = 0
+        try:
+            while True:
+                with self.condition:
+                    while not self.queue and not self.finished:
+                        self.condition.wait()
+                    if not self.queue:
+                        break
+                    action, size = self.queue.popleft()
+                    self.inflight_bytes -= size
+                    self.condition.notify_all()
+                    depth = (len(self.queue), self.inflight_bytes)
+                taken += 1
+                # queue depth is sampled rather than reported on every action
+                if self.metrics is not None and taken % 100 == 1:
+                    self.metrics.set('nvd_queue_items', depth[0])
+                    self.metrics.set('nvd_queue_bytes', depth[1])
+                yield action
+            if self.error is not None:
+                raise self.error
+        finally:
+            with self.condition:
+                self.stopped = True
+                self.condition.notify_all()
+            producer.join()
+
+
+# item statuses worth sending again; connection failures are reported with the status 'N/A'
+RETRYABLE_BULK_STATUSES = (429, 503, 'N/A')
+
+
+class DeadLetterFile:
+    """Gzip compressed NDJSON of the bulk action and source lines that failed permanently.
+
+    The file is a valid ``_bulk`` body once decompressed, and NVDLoader.replay_dead_letters
+    sends it again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.file = None
+        self.lock = threading.Lock()
+
+    def write(self, lines):
+        with self.lock:
+            if self.file is None:
+                self.file = gzip.open(self.path, 'ab')
+            for line in lines:
+                self.file.write(line + b'\n')
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class CveStateStore:
+    """SQLite map of CVE ID to the lastModifiedDate and content hash last sent to Elasticsearch."""
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS cve_state (cve_id TEXT PRIMARY KEY, last_modified TEXT, content_hash TEXT)')
+
+    def content_hash(self, item):
+        return hashlib.blake2b(json.dumps(item, sort_keys=True, separators=(',', ':')).encode('utf-8'), digest_size=16).hexdigest()
+
+    def classify(self, cve_id, content_hash):
+        row = self.connection.execute('SELECT content_hash FROM cve_state WHERE cve_id = ?', (cve_id,)).fetchone()
+        if row is None:
+            return 'new'
+        if row[0] == content_hash:
+            return 'unchanged'
+        return 'changed'
+
+    def update(self, rows):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO cve_state (cve_id, last_modified, content_hash) VALUES (?, ?, ?)', rows)
+
+    def close(self):
+        self.connection.close()
+
+
+def cvss_vector_fields(vector):
+    # CVSS:3.1/AV:N/AC:L/PR:N/... -> {'version': '3.1', 'AV': 'N', 'AC': 'L', 'PR': 'N', ...}; v2 vectors carry no version prefix
+    fields = {}
+    for part in vector.split('/'):
+        key, _, value = part.partition(':')
+        if key == 'CVSS':
+            fields['version'] = value
+        elif key and value:
+            fields[key] = value
+    return fields
+
+
+def cvss_severity_bucket(score, version):
+    # NVD's qualitative ratings; v2 has no critical or none band
+    if score is None:
+        return None
+    if version >= 3:
+        if score == 0:
+            return 'none'
+        if score >= 9.0:
+            return 'critical'
+    if score >= 7.0:
+        return 'high'
+    if score >= 4.0:
+        return 'medium'
+    return 'low'
+
+
+def encode_cve_id(cve_id):
+    # CVE-2021-44228 -> 202100044228; sequence numbers stay below 10**8
+    _, year, number = cve_id.split('-')
+    return int(year) * 100000000 + int(number)
+
+
+def decode_cve_id(number):
+    year, sequence = divmod(int(number), 100000000)
+    return f'CVE-{year}-{sequence:04d}'
+
+
+def pack_cve_ids(ids):
+    # sorted unique IDs stored as zlib compressed deltas, mostly ones, then base64 for the JSON manifest
+    ids = np.unique(np.asarray(ids, dtype=np.int64))
+    return base64.b64encode(zlib.compress(np.diff(ids, prepend=0).astype('<i8').tobytes())).decode('ascii')
+
+
+def unpack_cve_ids(packed):
+    return np.cumsum(np.frombuffer(zlib.decompress(base64.b64decode(packed)), dtype='<i8'))
+
+
+def file_sha256(file_path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def mask_digest(keep):
+    # a coalesce_feeds mask, by its length and packed bits
+    keep = np.asarray(keep, dtype=bool)
+    return hashlib.sha256(str(len(keep)).encode('ascii') + b':' + np.packbits(keep).tobytes()).hexdigest()
+
+
+def file_document_stats(file_path):
+    # Manifest entry for one feed file; module level so it can run in a worker process
+    with open_feed(file_path) as f:
+        ids = np.fromiter((encode_cve_id(item['cve']['CVE_data_meta']['ID']) for item in iter_json_array(f, 'CVE_Items')), dtype=np.int64)
+    stat = os.stat(file_path)
+    unique_ids = np.unique(ids)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': file_sha256(file_path), 'documents': int(len(ids)), 
+            'unique_cve_ids': int(len(unique_ids)), 'cve_ids': pack_cve_ids(unique_ids)}
+
+
+CPE_VERSION_BOUNDS = ('versionStartIncluding', 'versionStartExcluding', 'versionEndIncluding', 'versionEndExcluding')
+CPE23_FIELDS = ('part', 'vendor', 'product', 'version', 'update')
+# spelled out pre-release tags, lowest first; a version carrying one sorts below the release, single letters as in 1.0.2k sort above it
+PRE_RELEASE_TAGS = ('dev', 'alpha', 'beta', 'pre', 'preview', 'rc')
+
+
+def cpe_strings(values):
+    # pyarrow backed strings run the regular expressions below in RE2 over the whole column, object strings fall back to re per value
+    return pd.Series(values, dtype=object).astype(pd.ArrowDtype(pa.string()) if pa is not None else object)
+
+
+def cpe_version_keys(versions):
+    # Versions -> keywords that sort in version order: 2.14.1 -> D12.D214.D11.B, 2.0-beta9 -> D12.A2.D19.B
+    # Each component starts with its class, A for a PRE_RELEASE_TAGS tag and its rank, C for other letters and D for a number
+    # with its digit count in front, as ~ repeated once per extra digit of the count and then the count, so numbers of any
+    # length compare by value; B ends every key, which puts 2.0rc1 < 2.0 < 2.0k < 2.0.1. Trailing zeros are dropped,
+    # 2.0 and 2.0.0 share a key, and so are zeros before a tag. '*', '-' and empty versions have no key
+    # the patterns avoid lookarounds, which RE2 does not support; each distinct version is encoded once
+    codes, uniques = pd.factorize(pd.Series(versions, dtype=object))
+    versions = cpe_strings(uniques)
+    keys = versions.str.lower().str.replace(r'([0-9])([a-z])', r'\1.\2', regex=True).str.replace(r'([a-z])([0-9])', r'\1.\2', regex=True)
+    keys = keys.str.replace(r'[^0-9a-z]+', '.', regex=True).str.strip('.').str.replace(r'(^|\.)0+([0-9])', r'\1\2', regex=True)
+    tags = '|'.join(PRE_RELEASE_TAGS)
+    keys = keys.str.replace(r'(\.0)+$', '', regex=True).str.replace(rf'(\.0)+\.({tags})(\.|$)', r'.\2\3', regex=True)
+    # components are fenced by dots of their own, .2..0..rc..1., so neighbouring matches never share one
+    keys = '.' + keys.str.replace('.', '..', regex=False) + '.'
+    for rank, tag in enumerate(PRE_RELEASE_TAGS):
+        keys = keys.str.replace(f'.{tag}.', f'.A{rank}.', regex=False)
+    keys = keys.str.replace(r'\.([a-z]+)\.', r'.C\1.', regex=True)
+    # one pass per digit count, shortest first, until no bare number is left
+    length = 1
+    while keys.str.contains(r'\.[0-9]', regex=True).any():
+        count = str(length)
+        keys = keys.str.replace(rf'\.([0-9]{{{length}}})\.', rf'.D{"~" * (len(count) - 1)}{count}\1.', regex=True)
+        length += 1
+    keys = keys.str.replace('..', '.', regex=False).str.strip('.') + '.B'
+    keys = np.where((versions.notna() & ~versions.isin(['*', '-', ''])).to_numpy(dtype=bool, na_value=False), keys.to_numpy(dtype=object, na_value=None), None)
+    # missing versions have code -1, which picks the appended None
+    return pd.Series(np.append(keys, None)[codes], dtype=object)
+
+
+def parse_cpe23_uris(uris):
+    # cpe:2.3:part:vendor:product:version:update:... split for a whole batch at once; colons escaped as \: stay inside their field
+    if not len(uris):
+        return pd.DataFrame(columns=list(CPE23_FIELDS) + ['version_key'])
+    fields = cpe_strings(uris).str.replace('\\:', '\x00', regex=False).str.split(':', n=7, expand=True).reindex(columns=range(7))
+    frame = pd.DataFrame({field: cpe_strings(fields[position + 2]).str.replace('\x00', ':', regex=False).str.replace(r'\\(.)', r'\1', regex=True) 
+                          for position, field in enumerate(CPE23_FIELDS)})
+    frame = frame.where((fields[0] == 'cpe') & (fields[1] == '2.3'), axis=0)
+    frame['version_key'] = cpe_version_keys(frame['version'])
+    return frame
+
+
+def configuration_matches(item):
+    # every cpe_match of a CVE item, including the ones in child nodes
+    nodes = list((item.get('configurations') or {}).get('nodes') or [])
+    matches = []
+    while nodes:
+        node = nodes.pop()
+        nodes.extend(node.get('children') or [])
+        matches.extend(node.get('cpe_match') or [])
+    return matches
+
+
+class CpeCveIndex:
+    """CPE URI to CVE inverted index, built from CVE items as they pass through an ingest."""
+
+    def __init__(self):
+        # cpe23Uri -> set of (encoded CVE ID, version bounds); bounds tuples are shared between entries
+        self.entries = {}
+        self.bounds = {}
+
+    def add(self, item):
+        cve_id = encode_cve_id(item['cve']['CVE_data_meta']['ID'])
+        for match in configuration_matches(item):
+            # non-vulnerable matches only name the platform a vulnerable product runs on
+            if not match.get('vulnerable') or not match.get('cpe23Uri'):
+                continue
+            bounds = tuple(match.get(bound) for bound in CPE_VERSION_BOUNDS)
+            bounds = self.bounds.setdefault(bounds, bounds) if any(bounds) else None
+            self.entries.setdefault(sys.intern(match['cpe23Uri']), set()).add((cve_id, bounds))
+
+    def observe(self, items, item_of=None):
+        for item in items:
+            self.add(item if item_of is None else item_of(item))
+            yield item
+
+    def merge(self, entries):
+        for uri, matches in entries.items():
+            self.entries.setdefault(sys.intern(uri), set()).update(matches)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def version_keys(self):
+        # cpe_version_keys of every distinct bound in the index, encoded in one pass
+        values = sorted({value for matches in self.entries.values() for _, bounds in matches if bounds is not None for value in bounds if value is not None})
+        return {value: key for value, key in zip(values, cpe_version_keys(values)) if key is not None}
+
+    def documents(self):
+        # each range keeps the raw bounds and, under cpe, their version keys as in the cpe_match fields of the nvd index
+        keys = self.version_keys()
+        for uri, matches in self.entries.items():
+            ranges = []
+            for cve_id, bounds in sorted(matches, key=lambda match: match[0]):
+                if bounds is None:
+                    continue
+                present = [(bound, value) for bound, value in zip(CPE_VERSION_BOUNDS, bounds) if value is not None]
+                ranges.append(dict(cve_id=decode_cve_id(cve_id), cpe={bound: keys[value] for bound, value in present if value in keys}, **dict(present)))
+            cve_ids = sorted({cve_id for cve_id, _ in matches})
+            yield {'cpe23Uri': uri, 'cve_ids': [decode_cve_id(cve_id) for cve_id in cve_ids], 'cve_count': len(cve_ids), 'ranges': ranges}
+
+    def actions(self, target_index):
+        # the URI is the document ID, so a product lookup is a single get
+        for document in self.documents():
+            yield {'_id': document['cpe23Uri'], '_index': target_index, '_source': document}
+
+
+class CpeLookupFile:
+    """SQLite copy of the cpe_to_cve index for local lookups, CVE IDs stored with pack_cve_ids."""
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS cpe_to_cve (cpe23Uri TEXT PRIMARY KEY, cve_ids TEXT, ranges TEXT)')
+
+    def write(self, documents, batch_size=10000):
+        # rows are replaced per URI, so URIs not seen by this build keep what an earlier build wrote
+        rows = ((document['cpe23Uri'], pack_cve_ids([encode_cve_id(cve_id) for cve_id in document['cve_ids']]), dumps_json(document['ranges']).decode('utf-8')) 
+                for document in documents)
+        count = 0
+        with self.connection:
+            for batch in iter(lambda: list(itertools.islice(rows, batch_size)), []):
+                self.connection.executemany('INSERT OR REPLACE INTO cpe_to_cve (cpe23Uri, cve_ids, ranges) VALUES (?, ?, ?)', batch)
+                count += len(batch)
+        return count
+
+    def get(self, cpe23Uri):
+        row = self.connection.execute('SELECT cve_ids, ranges FROM cpe_to_cve WHERE cpe23Uri = ?', (cpe23Uri,)).fetchone()
+        if row is None:
+            return None
+        cve_ids = [decode_cve_id(cve_id) for cve_id in unpack_cve_ids(row[0])]
+        return {'cpe23Uri': cpe23Uri, 'cve_ids': cve_ids, 'cve_count': len(cve_ids), 'ranges': loads_json(row[1])}
+
+    def close(self):
+        self.connection.close()
+
+
+def file_cve_versions(file_path):
+    # encoded CVE ID and lastModifiedDate of every item in file order, dates as int64 nanoseconds with missing ones oldest;
+    # module level so it can run in a worker process
+    ids, modified = [], []
+    with open_feed(file_path) as f:
+        for item in iter_json_array(f, 'CVE_Items'):
+            ids.append(encode_cve_id(item['cve']['CVE_data_meta']['ID']))
+            modified.append(item.get('lastModifiedDate'))
+    return np.asarray(ids, dtype=np.int64), modified_nanoseconds(modified)
+
+
+def modified_nanoseconds(dates):
+    dates = pd.to_datetime(pd.Series(dates, dtype=object), utc=True, format='ISO8601', errors='coerce')
+    return dates.dt.tz_localize(None).to_numpy(dtype='datetime64[ns]').view(np.int64)
+
+
+class IngestCheckpoint:
+    """SQLite record, per target index and source file, of how many items Elasticsearch has acknowledged.
+
+    Offsets only count for the file content they were recorded against; a file with a
+    different checksum starts again from the first item.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # worker processes of parallel_ingest_json_dataset share the file, so wait on each other's writes
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS ingest_checkpoint (target_index TEXT, source TEXT, checksum TEXT, offset INTEGER, complete INTEGER, '
+                                'PRIMARY KEY (target_index, source))')
+
+    def offset(self, target_index, source, checksum):
+        # Returns (offset, complete) for the source, (0, False) when it was never seen or has changed since
+        row = self.connection.execute('SELECT checksum, offset, complete FROM ingest_checkpoint WHERE target_index = ? AND source = ?', (target_index, source)).fetchone()
+        if row is None or row[0] != checksum:
+            return 0, False
+        return row[1], bool(row[2])
+
+    def save(self, target_index, source, checksum, offset, complete=False):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO ingest_checkpoint (target_index, source, checksum, offset, complete) VALUES (?, ?, ?, ?, ?)', 
+                                    (target_index, source, checksum, offset, int(complete)))
+
+    def reset(self, target_index, sources):
+        with self.connection:
+            self.connection.executemany('DELETE FROM ingest_checkpoint WHERE target_index = ? AND source = ?', [(target_index, source) for source in sources])
+
+    def close(self):
+        self.connection.close()
+
+
+class ColumnarCache:
+    """Arrow IPC files of parsed sources, one per source file, checksum and cache version.
+
+    Each row holds the document ID, a few string columns for analysis and the document
+    itself as encoded JSON. Files are read through a memory map; with compression=None
+    the document bytes are used in place, without a copy.
+    """
+    # part of every file name; bump it whenever the cache schema or the documents read_cve_items builds change,
+    # so caches written by an earlier version are rebuilt instead of serving documents without the new fields
+    # 2: CVE items carry the cvss fields of add_cvss_fields
+    # 3: version keys of the cpe fields in the cpe_version_keys encoding with pre-release and length prefixed numbers
+    version = 3
+
+    def __init__(self, cache_dir, compression='zstd', batch_size=10000):
+        if pa is None:
+            raise ImportError("parse_method='cache' needs pyarrow, pip install pyarrow")
+        self.cache_dir = cache_dir
+        self.compression = compression
+        self.batch_size = batch_size
+
+    def path(self, file_path, key):
+        return os.path.join(self.cache_dir, f'{os.path.basename(file_path)}.{key}.v{self.version}-{file_sha256(file_path)[:16]}.arrow')
+
+    def record_batch(self, items, schema, id_of, columns):
+        arrays = [pa.array([None if id_of(item) is None else str(id_of(item)) for item in items], pa.string())]
+        arrays += [pa.array([column(item) for item in items], pa.string()) for column in columns.values()]
+        arrays.append(pa.array([dumps_json(item) for item in items], pa.large_binary()))
+        return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+    def write(self, path, items, id_of, columns):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        schema = pa.schema([('id', pa.string())] + [(name, pa.string()) for name in columns] + [('document', pa.large_binary())])
+        options = pa.ipc.IpcWriteOptions(compression=self.compression)
+        with pa.OSFile(path + '.tmp', 'wb') as sink, pa.ipc.new_file(sink, schema, options=options) as writer:
+            batch = []
+            for item in items:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    writer.write_batch(self.record_batch(batch, schema, id_of, columns))
+                    batch = []
+            if batch:
+                writer.write_batch(self.record_batch(batch, schema, id_of, columns))
+        os.replace(path + '.tmp', path)
+        # caches of earlier versions of the same source, or written by an earlier cache version, are dropped
+        prefix = os.path.basename(path).rsplit('.', 2)[0] + '.'
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(prefix) and name.endswith('.arrow') and name != os.path.basename(path):
+                os.remove(os.path.join(self.cache_dir, name))
+
+    def rows(self, path):
+        # Yields (id, document) with the document as a memoryview of its encoded JSON, valid until the next row
+        with pa.memory_map(path, 'r') as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                documents = batch.column('document')
+                offsets = np.frombuffer(documents.buffers()[1], dtype=np.int64)[documents.offset:documents.offset + len(documents) + 1]
+                data = memoryview(documents.buffers()[2])
+                for j, _id in enumerate(batch.column('id').to_pylist()):
+                    yield _id, data[offsets[j]:offsets[j + 1]]
+
+    def documents(self, path):
+        for _, document in self.rows(path):
+            yield loads_json(document)
+
+    def table(self, path, columns=None):
+        table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+        return table.select(columns) if columns else table
+
+
+class AdaptiveBulkController:
+    """Size bulk requests and their concurrency from the latency, took and rejections the cluster reports.
+
+    Batches grow additively while requests finish under ``target_latency`` and shrink
+    multiplicatively on rejections or slow responses. A batch counts as full when it
+    reached either the document or the byte limit. Concurrency only grows once a batch
+    has reached its upper bound and the cluster itself (``took``) still has headroom.
+    """
+
+    def __init__(self, chunk_docs=500, chunk_bytes=5 * 1024 * 1024, concurrency=2, min_docs=50, max_docs=10000, 
+                 min_bytes=512 * 1024, max_bytes=50 * 1024 * 1024, min_concurrency=1, max_concurrency=8, target_latency=1.0):
+        self.chunk_docs = chunk_docs
+        self.chunk_bytes = chunk_bytes
+        self.concurrency = concurrency
+        self.min_docs = min_docs
+        self.max_docs = max_docs
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.lock = threading.Lock()
+        self.history = []
+
+    def record(self, latency, took, documents, rejected, size=0):
+        # size is the request body in bytes; chunks of large documents are cut at chunk_bytes long before chunk_docs
+        full = documents >= self.chunk_docs * 0.9 or size >= self.chunk_bytes * 0.9
+        with self.lock:
+            if rejected:
+                self.chunk_docs = max(self.min_docs, self.chunk_docs // 2)
+                self.chunk_bytes = max(self.min_bytes, self.chunk_bytes // 2)
+                self.concurrency = max(self.min_concurrency, self.concurrency - 1)
+            elif latency > self.target_latency * 1.5:
+                self.chunk_docs = max(self.min_docs, int(self.chunk_docs * 0.75))
+                self.chunk_bytes = max(self.min_bytes, int(self.chunk_bytes * 0.75))
+            elif latency < self.target_latency and full:
+                if self.chunk_docs < self.max_docs or self.chunk_bytes < self.max_bytes:
+                    self.chunk_docs = min(self.max_docs, self.chunk_docs + max(self.min_docs, self.chunk_docs // 4))
+                    self.chunk_bytes = min(self.max_bytes, self.chunk_bytes + max(self.min_bytes, self.chunk_bytes // 4))
+                elif took / 1000 < self.target_latency / 2:
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+            self.history.append({'latency': round(latency, 3), 'took': took, 'documents': documents, 'bytes': size, 'rejected': rejected, 
+                                 'chunk_docs': self.chunk_docs, 'chunk_bytes': self.chunk_bytes, 'concurrency': self.concurrency})
+
+
+# each worker process of NVDLoader.parallel_ingest_json_dataset keeps its own loader and Elasticsearch client
+worker_loader = None
+
+
+def init_ingest_worker(instance_type, elastic_url=None):
+    global worker_loader
+    worker_loader = NVDLoader(instance_type=instance_type, elastic_url=elastic_url)
+
+
+def ingest_file_worker(file, target_index, data_path, options):
+    dead_letter_path = options.pop('dead_letter_path', None)
+    dead_letter = DeadLetterFile(dead_letter_path) if dead_letter_path else None
+    checkpoint_path = options.pop('checkpoint_path', None)
+    checkpoint = IngestCheckpoint(checkpoint_path) if checkpoint_path else None
+    # the worker's part of the CPE index goes back to the parent with the file result, and so do its bulk request timings
+    cpe_to_cve = CpeCveIndex() if options.pop('cpe_to_cve', False) else None
+    bulk_seconds = []
+
+    def record_bulk_seconds(kind, name, value, labels):
+        if kind == 'histogram' and name == 'nvd_stage_seconds' and labels.get('stage') == 'bulk':
+            bulk_seconds.append(value)
+
+    worker_loader.metrics.add_hook(record_bulk_seconds)
+    try:
+        result = worker_loader.ingest_file(file, target_index, data_path=data_path, dead_letter=dead_letter, checkpoint=checkpoint, cpe_to_cve=cpe_to_cve, **options)
+        if cpe_to_cve is not None:
+            result['cpe_to_cve'] = cpe_to_cve.entries
+        result['bulk_seconds'] = bulk_seconds
+        return result
+    finally:
+        worker_loader.metrics.hooks.remove(record_bulk_seconds)
+        if dead_letter is not None:
+            dead_letter.close()
+        if checkpoint is not None:
+            checkpoint.close()
+
+
+# curated mappings applied when the loader creates an index; anything not listed stays in _source unindexed
+CVSS_V3_MAPPING = {
+    'properties': {
+        'version': {'type': 'keyword'},
+        'vectorString': {'type': 'text'},
+        'attackVector': {'type': 'keyword'},
+        'attackComplexity': {'type': 'keyword'},
+        'privilegesRequired': {'type': 'keyword'},
+        'userInteraction': {'type': 'keyword'},
+        'scope': {'type': 'keyword'},
+        'confidentialityImpact': {'type': 'keyword'},
+        'integrityImpact': {'type': 'keyword'},
+        'availabilityImpact': {'type': 'keyword'},
+        'baseScore': {'type': 'float'},
+        'baseSeverity': {'type': 'keyword'}
+    }
+}
+CVSS_V2_MAPPING = {
+    'properties': {
+        'version': {'type': 'keyword'},
+        'vectorString': {'type': 'text'},
+        'accessVector': {'type': 'keyword'},
+        'accessComplexity': {'type': 'keyword'},
+        'authentication': {'type': 'keyword'},
+        'confidentialityImpact': {'type': 'keyword'},
+        'integrityImpact': {'type': 'keyword'},
+        'availabilityImpact': {'type': 'keyword'},
+        'baseScore': {'type': 'float'}
+    }
+}
+CVSS_FIELDS_MAPPING = {
+    'properties': {
+        'v3': {'properties': {field: {'type': 'keyword'} for field in ('version', 'AV', 'AC', 'PR', 'UI', 'S', 'C', 'I', 'A', 'severity_bucket')}},
+        'v2': {'properties': {field: {'type': 'keyword'} for field in ('AV', 'AC', 'Au', 'C', 'I', 'A', 'severity_bucket')}},
+        'severity_bucket': {'type': 'keyword'}
+    }
+}
+CPE_FIELDS_MAPPING = {'properties': {field: {'type': 'keyword'} for field in CPE23_FIELDS + ('version_key',) + CPE_VERSION_BOUNDS}}
+# AND configurations keep their vulnerable cpe_match entries one level down, under children
+# cpe_match is nested so a range query on the version keys of cpe sees the bounds of one match together, not those of its siblings
+CONFIGURATION_NODE_PROPERTIES = {
+    'operator': {'type': 'keyword'},
+    'cpe_match': {'type': 'nested', 'properties': dict({'vulnerable': {'type': 'boolean'}, 'cpe23Uri': {'type': 'keyword', 'doc_values': False}, 'cpe': CPE_FIELDS_MAPPING}, 
+                                     **{bound: {'type': 'keyword'} for bound in CPE_VERSION_BOUNDS})}
+}
+INDEX_MAPPINGS = {
+    'nvd': {
+        'dynamic': False,
+        'properties': {
+            'cvss': CVSS_FIELDS_MAPPING,
+            'cve': {
+                'properties': {
+                    'CVE_data_meta': {'properties': {'ID': {'type': 'keyword'}, 'ASSIGNER': {'type': 'keyword'}}},
+                    'problemtype': {'properties': {'problemtype_data': {'properties': {'description': {'properties': {'value': {'type': 'keyword'}}}}}}},
+                    'references': {'type': 'object', 'enabled': False},
+                    'description': {'properties': {'description_data': {'properties': {'value': {'type': 'text'}}}}}
+                }
+            },
+            'configurations': {
+                'properties': {
+                    'nodes': {
+                        'properties': dict(CONFIGURATION_NODE_PROPERTIES, children={'properties': CONFIGURATION_NODE_PROPERTIES})
+                    }
+                }
+            },
+            'impact': {
+                'properties': {
+                    'baseMetricV3': {
+                        'properties': {
+                            'cvssV3': CVSS_V3_MAPPING,
+                            'exploitabilityScore': {'type': 'float'},
+                            'impactScore': {'type': 'float'}
+                        }
+                    },
+                    'baseMetricV2': {
+                        'properties': {
+                            'cvssV2': CVSS_V2_MAPPING,
+                            'severity': {'type': 'keyword'},
+                            'exploitabilityScore': {'type': 'float'},
+                            'impactScore': {'type': 'float'},
+                            'acInsufInfo': {'type': 'boolean'},
+                            'obtainAllPrivilege': {'type': 'boolean'},
+                            'obtainUserPrivilege': {'type': 'boolean'},
+                            'obtainOtherPrivilege': {'type': 'boolean'},
+                            'userInteractionRequired': {'type': 'boolean'}
+                        }
+                    }
+                }
+            },
+            'publishedDate': {'type': 'date'},
+            'lastModifiedDate': {'type': 'date'}
+        }
+    },
+    'cpe_match': {
+        'dynamic': False,
+        'properties': {
+            'cpe23Uri': {'type': 'keyword'},
+            'versionStartIncluding': {'type': 'keyword'},
+            'versionStartExcluding': {'type': 'keyword'},
+            'versionEndIncluding': {'type': 'keyword'},
+            'versionEndExcluding': {'type': 'keyword'},
+            'cpe': CPE_FIELDS_MAPPING,
+            'cpe_name': {'properties': {'cpe23Uri': {'type': 'keyword', 'doc_values': False}}}
+        }
+    },
+    'cpe_to_cve': {
+        'dynamic': False,
+        'properties': {
+            'cpe23Uri': {'type': 'keyword'},
+            'cve_ids': {'type': 'keyword'},
+            'cve_count': {'type': 'integer'},
+            # nested like cpe_match, so a range query on the version keys sees the bounds of one range together
+            'ranges': {'type': 'nested', 'properties': dict({'cpe': {'properties': {bound: {'type': 'keyword'} for bound in CPE_VERSION_BOUNDS}}}, 
+                                                            **{field: {'type': 'keyword'} for field in ('cve_id',) + CPE_VERSION_BOUNDS})}
+        }
+    },
+    'cpe_dictionary': {
+        'dynamic': False,
+        'properties': {
+            '@name': {'type': 'keyword'},
+            '@deprecated': {'type': 'boolean'},
+            '@deprecation_date': {'type': 'date'},
+            'title': {'properties': {'#text': {'type': 'text'}}},
+            'cpe-23:cpe23-item': {'properties': {'@name': {'type': 'keyword'}}},
+            'cpe': CPE_FIELDS_MAPPING,
+            'references': {'type': 'object', 'enabled': False}
+        }
+    }
+}
+
 
 class NVDLoader:
     
-    def __init__(self, instance_type='local'):
+    def __init__(self, instance_type='local', elastic_url=None):
         if instance_type == 'local':
             try:
                 self.elastic_user = 'elastic'
                 self.elastic_password = 'elastic_playground'
-                self.elastic_url = 'https://localhost:9200'
+                self.elastic_url = elastic_url or 'https://localhost:9200'
                 self.client = Elasticsearch(self.elastic_url, basic_auth=(self.elastic_user, self.elastic_password),verify_certs=False)
             except Exception as e:
                 logging.warning('You must add credentials to the class init')
@@ -32,7 +1105,11 @@ class NVDLoader:
                 logging.warning('You must add ELASTIC_USER, ELASTIC_CLOUD_PASSWORD and ELASTIC_CLOUD_ID to the container environment variables')
                 logging.warning(e)
                 sys.exit
-            self.instance_type = instance_type
+        self.instance_type = instance_type
+        # counters, gauges and histograms of every load, see IngestMetrics
+        self.metrics = IngestMetrics()
+        # parse_method='cache' keeps parsed sources here, see ColumnarCache
+        self.cache_dir = os.path.join(os.curdir, 'demo', 'data', 'cache')
         self.two_hour_stream_feeds = {
             'CVE-Modified':'https://nvd.nist.gov/feeds/json/cve/1.1/nvdcve-1.1-modified.json.zip',
             'CVE-Recent':'https://nvd.nist.gov/feeds/json/cve/1.1/nvdcve-1.1-recent.json.zip'
@@ -107,17 +1184,213 @@ class NVDLoader:
             "Sun Solaris 8":"https://csrc.nist.gov/CSRC/media/Projects/national-vulnerability-database/documents/CCE/cce-solaris8-5.20090506.xls",
             "Sun Solaris 9":"https://csrc.nist.gov/CSRC/media/Projects/national-vulnerability-database/documents/CCE/cce-solaris9-5.20090506.xls"
         }
+        self.index_mappings = INDEX_MAPPINGS
     
-    def download_files(self, dictionary, output_path=os.path.join(os.curdir, 'demo', 'data'), verbose=False):
+    def partial_download(self, destination, resume=True):
+        # (partial path, offset, request headers) for a download into destination through a .part file
+        # A partial file is only resumed with the validator it was started under, sent as If-Range, so a feed NVD
+        # regenerated in the meantime comes back whole with a 200 instead of being appended to the old bytes;
+        # a partial file without a validator is discarded
+        partial = destination + '.part'
+        validator = None
+        if resume == True and os.path.isfile(partial) and os.path.isfile(partial + '.validator'):
+            with open(partial + '.validator', 'r') as f:
+                validator = f.read().strip()
+        if not validator:
+            self.discard_partial(partial)
+            return partial, 0, {}
+        offset = os.path.getsize(partial)
+        return partial, offset, ({'Range': f'bytes={offset}-', 'If-Range': validator} if offset else {})
+
+    def record_validator(self, partial, headers):
+        # kept beside a download that starts from byte 0; weak ETags cannot be used in If-Range, Last-Modified then stands in
+        etag = headers.get('ETag')
+        validator = etag if etag and not etag.startswith('W/') else headers.get('Last-Modified')
+        if validator:
+            with open(partial + '.validator', 'w') as f:
+                f.write(validator)
+        elif os.path.isfile(partial + '.validator'):
+            os.remove(partial + '.validator')
+
+    def discard_partial(self, partial):
+        for path in (partial, partial + '.validator'):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def partial_is_complete(self, offset, headers):
+        # a 416 to a validated range means the partial file already holds the whole resource, if its size matches
+        total = (headers.get('Content-Range') or '').rpartition('/')[2]
+        return total.isdigit() and int(total) == offset
+
+    def partial_response(self, partial, offset, status, headers):
+        # (mode, offset) for the response to partial_download's request: 'ab' appends a resumed body at offset, 'wb' writes
+        # a whole one from 0, 'complete' means the partial file already holds everything and 'restart' that it was
+        # discarded and the download has to start over without resuming
+        if status == 416:
+            if self.partial_is_complete(offset, headers):
+                return 'complete', offset
+            self.discard_partial(partial)
+            return 'restart', 0
+        if offset and status == 206:
+            return 'ab', offset
+        self.record_validator(partial, headers)
+        return 'wb', 0
+
+    def finish_download(self, partial, destination, written, offset, start, verbose=False):
+        # moves the finished .part file into place and records the download's stats and metrics
+        os.replace(partial, destination)
+        self.discard_partial(partial)
+        target_file = os.path.basename(destination)
+        seconds = time.perf_counter() - start
+        stats = {'file': target_file, 'bytes': written, 'resumed_from': offset, 'seconds': round(seconds, 3),
+                 'mb_per_second': round(written / (1024 * 1024) / seconds, 2) if seconds else 0.0}
+        self.metrics.inc('nvd_download_bytes_total', written, file=target_file)
+        self.metrics.observe('nvd_stage_seconds', seconds, stage='download')
+        if verbose == True:
+            print(f"Fetched {target_file}: {stats['bytes']} bytes in {stats['seconds']}s ({stats['mb_per_second']} MB/s)")
+        return stats
+
+    def download_file(self, session, target, output_path, chunk_size=1024 * 1024, resume=True, verbose=False):
+        # Streams target to disk through a .part file, resuming a previous partial download with a Range request
+        destination = os.path.join(output_path, target.split('/')[-1])
+        partial, offset, headers = self.partial_download(destination, resume=resume)
+        start = time.perf_counter()
+        written = 0
+        with session.get(target, headers=headers, stream=True, timeout=60) as response:
+            if response.status_code != 416:
+                response.raise_for_status()
+            mode, offset = self.partial_response(partial, offset, response.status_code, response.headers)
+            if mode == 'restart':
+                return self.download_file(session, target, output_path, chunk_size=chunk_size, resume=False, verbose=verbose)
+            if mode != 'complete':
+                with open(partial, mode) as f:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+                        written += len(chunk)
+        return self.finish_download(partial, destination, written, offset, start, verbose=verbose)
+
+    def download_files(self, dictionary, output_path=os.path.join(os.curdir, 'demo', 'data'), verbose=False, max_workers=4, chunk_size=1024 * 1024, resume=True):
         if not os.path.isdir(output_path):
             os.mkdir(output_path)
+        report = {}
+        with requests.Session() as session:
+            adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {}
+                for key in dictionary:
+                    target = dictionary[key]
+                    if verbose == True:
+                        print(f"Now Fetching {target.split('/')[-1]}")
+                    futures[key] = executor.submit(self.download_file, session, target, output_path, chunk_size=chunk_size, resume=resume, verbose=verbose)
+                for key, future in futures.items():
+                    report[key] = future.result()
+        return report
+
+    async def async_download_file(self, session, target, output_path, chunk_size=1024 * 1024, resume=True, verbose=False):
+        # aiohttp counterpart of download_file, with the same .part file and validated Range resume
+        # disk writes run on the default executor so a slow disk never stalls the event loop's other downloads and bulk requests
+        destination = os.path.join(output_path, target.split('/')[-1])
+        partial, offset, headers = self.partial_download(destination, resume=resume)
+        start = time.perf_counter()
+        written = 0
+        async with session.get(target, headers=headers) as response:
+            if response.status != 416:
+                response.raise_for_status()
+            mode, offset = self.partial_response(partial, offset, response.status, response.headers)
+            if mode == 'restart':
+                return await self.async_download_file(session, target, output_path, chunk_size=chunk_size, resume=False, verbose=verbose)
+            if mode != 'complete':
+                f = await asyncio.to_thread(open, partial, mode)
+                try:
+                    async for chunk in response.content.iter_chunked(chunk_size):
+                        await asyncio.to_thread(f.write, chunk)
+                        written += len(chunk)
+                finally:
+                    await asyncio.to_thread(f.close)
+        return self.finish_download(partial, destination, written, offset, start, verbose=verbose)
+
+    def create_index_if_missing(self, target_index, mappings=None, settings=None):
+        if target_index in [x['index'] for x in self.client.cat.indices(format='json')]:
+            return False
+        self.client.indices.create(index=target_index, mappings=mappings, settings=settings)
+        return True
+
+    def feed_meta_url(self, target):
+        # nvdcve-1.1-2022.json.zip -> nvdcve-1.1-2022.meta
+        return target.rsplit('.', 2)[0] + '.meta'
+
+    def fetch_feed_meta(self, target, session=None):
+        response = (session or requests).get(self.feed_meta_url(target), timeout=60)
+        response.raise_for_status()
+        meta = {}
+        for line in response.text.splitlines():
+            if ':' in line:
+                key, value = line.split(':', 1)
+                meta[key.strip()] = value.strip()
+        return meta
+
+    def load_feed_state(self, state_path=os.path.join(os.curdir, 'demo', 'data', 'feed_state.json')):
+        if not os.path.isfile(state_path):
+            return {}
+        with open(state_path, 'r') as f:
+            return json.loads(f.read())
+
+    def save_feed_state(self, state, state_path=os.path.join(os.curdir, 'demo', 'data', 'feed_state.json')):
+        # write then rename so an interrupted run never leaves a truncated state file
+        with open(state_path + '.tmp', 'w') as f:
+            f.write(json.dumps(state, indent=2, sort_keys=True))
+        os.replace(state_path + '.tmp', state_path)
+
+    def changed_feeds(self, dictionary, state_path=os.path.join(os.curdir, 'demo', 'data', 'feed_state.json'), verbose=False):
+        # Returns the feeds whose .meta differs from the state recorded at their last ingest, with the fresh metadata
+        state = self.load_feed_state(state_path)
+        changed = {}
+        metas = {}
+        with requests.Session() as session:
+            for key in dictionary:
+                target_file = dictionary[key].split('/')[-1]
+                meta = self.fetch_feed_meta(dictionary[key], session=session)
+                previous = state.get(target_file, {})
+                if all(previous.get(field) == meta.get(field) for field in ('lastModifiedDate', 'size', 'sha256')):
+                    if verbose == True:
+                        print(f'Skipping {target_file}, unchanged since {previous.get("lastModifiedDate")}')
+                else:
+                    changed[key] = dictionary[key]
+                    metas[key] = meta
+        return changed, metas
+
+    def record_feed_state(self, dictionary, metas, state_path=os.path.join(os.curdir, 'demo', 'data', 'feed_state.json')):
+        state = self.load_feed_state(state_path)
         for key in dictionary:
-            target = dictionary[key]
-            target_file = target.split('/')[-1]
-            if verbose == True:
-                print(f'Now Fetching {target_file}')
-            with open(os.path.join(output_path, target_file), "wb") as f:
-                f.write(requests.get(target).content)
+            state[dictionary[key].split('/')[-1]] = metas[key]
+        self.save_feed_state(state, state_path)
+
+    def refresh_feeds(self, dictionary, target_index='nvd', data_path=os.path.join(os.curdir, 'demo', 'data'), state_path=os.path.join(os.curdir, 'demo', 'data', 'feed_state.json'), 
+                      ingest_method='parallel_bulk', verbose=True):
+        # Downloads and ingests only the feeds whose .meta changed since they were last ingested
+        # a feed's state is only recorded once every one of its items was acknowledged, so a feed with errors is retried next time
+        changed, metas = self.changed_feeds(dictionary, state_path=state_path, verbose=verbose)
+        if not changed:
+            return f'0 of {len(dictionary)} feeds changed, nothing sent to elasticsearch'
+        self.download_files(changed, output_path=data_path, verbose=verbose)
+        self.create_index_if_missing(target_index, mappings=self.index_mappings['nvd'])
+        count = 0
+        failed = []
+        try:
+            for key in changed:
+                result = self.ingest_file(changed[key].split('/')[-1], target_index, data_path=data_path, verbose=verbose, ingest_method=ingest_method)
+                count += result['successes']
+                if result['errors'] or result['successes'] < result['documents']:
+                    failed.append(key)
+                    if verbose == True:
+                        print(f"{result['file']}: {len(result['errors'])} errors, its state is not recorded")
+                else:
+                    self.record_feed_state({key: changed[key]}, metas, state_path=state_path)
+        finally:
+            self.clean_download_directory(changed, output_path=data_path, clean_db=False, verbose=verbose)
+        return f'{len(changed)} of {len(dictionary)} feeds changed, {count} documents sent to elasticsearch, {len(failed)} feeds had errors and will be retried'
 
     def extract_archives(self, data_path, output_path=os.path.join(os.curdir, 'demo', 'data', 'db'), verbose=False):
         if not os.path.isdir(output_path):
@@ -127,7 +1400,8 @@ class NVDLoader:
             if not os.path.isdir(file) and file.endswith('zip'):
                 if verbose == True:
                     print(f'Extracting: {file} to {output_path}')
-                zipfile.ZipFile(os.path.join(data_path, file)).extractall(output_path)
+                with self.metrics.timer('nvd_stage_seconds', stage='extract'):
+                    zipfile.ZipFile(os.path.join(data_path, file)).extractall(output_path)
 
     def clean_download_directory(self, dictionary, output_path=os.path.join(os.curdir, 'demo', 'data'), clean_db=True, verbose=True):
         for key in dictionary:
@@ -138,203 +1412,1154 @@ class NVDLoader:
             if clean_db == True:
                 os.remove(os.path.join(os.path.join(output_path, 'db'), target_file.rstrip('.zip')))
 
-    def ingest_bulk_json_dataset(self, file_list, target_index, data_path=os.path.join(os.curdir, 'demo', 'data', 'db'), verbose=True, ingest_method='parallel_bulk'):
+    def cache_schema(self, key):
+        # the document ID and the string columns stored beside each cached source
+        if key == 'CVE_Items':
+            return self.cve_id, {'published_date': lambda item: item.get('publishedDate'), 'last_modified_date': lambda item: item.get('lastModifiedDate'), 
+                                 'severity_bucket': lambda item: (item.get('cvss') or {}).get('severity_bucket')}
+        elif key == 'matches':
+            return self.cpe_match_id, {'cpe23Uri': lambda match: match.get('cpe23Uri')}
+        elif key == 'cpe-item':
+            return (lambda item: item['@name']), {'cpe23Uri': lambda item: (item.get('cpe-23:cpe23-item') or {}).get('@name')}
+        elif key == 'cce':
+            return (lambda document: next((document[column] for column in ('CCE', 'CCE ID', 'CCE ID v5') if column in document), None)), {'data_file': lambda document: document.get('data_file')}
+        return (lambda item: None), {}
+
+    def cached_source(self, file_path, key, parse):
+        # Returns the cache and its file for file_path, calling parse() for the items only when no cache matches the source checksum
+        cache = ColumnarCache(self.cache_dir)
+        path = cache.path(file_path, key)
+        if not os.path.isfile(path):
+            id_of, columns = self.cache_schema(key)
+            cache.write(path, parse(), id_of, columns)
+        return cache, path
+
+    def json_source_parser(self, file_path, key):
+        # CVE items are cached as read_cve_items builds them, so every reader of the cache sees the same documents
+        if key == 'CVE_Items':
+            return lambda: self.read_cve_items(file_path)
+        return lambda: self.read_json_items(file_path, key)
+
+    def cached_frame(self, file_path, key='CVE_Items', columns=('id', 'published_date', 'last_modified_date')):
+        # DataFrame of the cached columns for analysis, without decoding the documents
+        cache, path = self.cached_source(file_path, key, self.json_source_parser(file_path, key))
+        return cache.table(path, list(columns) if columns else None).to_pandas()
+
+    def read_json_items(self, file_path, key, parse_method='stream'):
+        # 'stream' walks the array one item at a time, 'load' parses the whole file up front
+        # 'cache' reads the columnar cache of the file, building it with 'stream' the first time
+        # file_path may be an extracted .json file or the downloaded .json.zip archive
+        if parse_method == 'cache':
+            cache, path = self.cached_source(file_path, key, self.json_source_parser(file_path, key))
+            yield from cache.documents(path)
+            return
+        with open_feed(file_path) as f:
+            if parse_method == 'load':
+                yield from json.loads(f.read())[key]
+            else:
+                yield from iter_json_array(f, key)
+
+    def read_cve_items(self, file_path, parse_method='stream'):
+        # items are returned with the cvss fields of add_cvss_fields and the cpe fields of add_cpe_fields; cached items were stored with them
+        if parse_method == 'cache':
+            cache, path = self.cached_source(file_path, 'CVE_Items', self.json_source_parser(file_path, 'CVE_Items'))
+            return cache.documents(path)
+        items = map(self.add_cvss_fields, self.read_json_items(file_path, 'CVE_Items', parse_method=parse_method))
+        return self.with_cpe_fields(items, configuration_matches)
+
+    def add_cpe_fields(self, matches, uri_of=None):
+        # Parses the CPE URIs of a batch of matches in one pass and sets match['cpe'] to the part, vendor, product, version and update,
+        # the version_key of the version and the version key of each bound, so a version range check is a range query on keywords, e.g.
+        # {'range': {'cpe.versionEndExcluding': {'gt': key}}} with key = cpe_version_keys(['2.14.1'])[0]; in the nvd index the
+        # query goes inside a nested query on configurations.nodes.cpe_match or configurations.nodes.children.cpe_match
+        if not matches:
+            return matches
+        frame = parse_cpe23_uris([match.get('cpe23Uri') if uri_of is None else uri_of(match) for match in matches])
+        for bound in CPE_VERSION_BOUNDS:
+            values = [match.get(bound) for match in matches]
+            if any(values):
+                frame[bound] = cpe_version_keys(values).values
+        columns = {field: frame[field].to_numpy(dtype=object, na_value=None).tolist() for field in frame.columns}
+        for i, match in enumerate(matches):
+            match['cpe'] = {field: values[i] for field, values in columns.items() if isinstance(values[i], str)}
+        return matches
+
+    def with_cpe_fields(self, items, matches_of, uri_of=None, batch_size=1000, max_items=500):
+        # add_cpe_fields over batches of up to batch_size matches, matches_of(item) returning the match dicts of one item
+        # the column operations cost about the same for a small batch as for a large one, so items are held until a batch fills;
+        # the held items sit ahead of the BoundedActionBuffer budget, so a batch also ends at max_items items
+        batch, matches = [], []
+        for item in items:
+            batch.append(item)
+            matches.extend(matches_of(item))
+            if len(matches) >= batch_size or len(batch) >= max_items:
+                self.add_cpe_fields(matches, uri_of=uri_of)
+                yield from batch
+                batch, matches = [], []
+        self.add_cpe_fields(matches, uri_of=uri_of)
+        yield from batch
+
+    def add_cvss_fields(self, item):
+        # Splits the v3 and v2 vectors into one keyword per metric under item['cvss'], with severity buckets,
+        # so queries can use term filters such as {'term': {'cvss.v3.AV': 'N'}} instead of phrase matching vectorString
+        impact = item.get('impact') or {}
+        cvss = {}
+        for name, metric, key, version in (('v3', 'baseMetricV3', 'cvssV3', 3), ('v2', 'baseMetricV2', 'cvssV2', 2)):
+            vector = (impact.get(metric) or {}).get(key) or {}
+            if vector.get('vectorString'):
+                cvss[name] = cvss_vector_fields(vector['vectorString'])
+                cvss[name]['severity_bucket'] = cvss_severity_bucket(vector.get('baseScore'), version)
+        if cvss:
+            cvss['severity_bucket'] = cvss.get('v3', cvss.get('v2'))['severity_bucket']
+        item['cvss'] = cvss
+        return item
+
+    async def async_read_cve_items(self, file_path, parse_method='stream', batch_size=500, max_batches=4):
+        # Parses on a worker thread and hands items to the event loop in batches, so parsing overlaps fetching and sending
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=max_batches)
+        stopped = threading.Event()
+        done = object()
+
+        def put(batch):
+            if not stopped.is_set():
+                asyncio.run_coroutine_threadsafe(queue.put(batch), loop).result()
+
+        def produce():
+            try:
+                batch = []
+                for item in self.read_cve_items(file_path, parse_method=parse_method):
+                    if stopped.is_set():
+                        return
+                    batch.append(item)
+                    if len(batch) >= batch_size:
+                        put(batch)
+                        batch = []
+                if batch:
+                    put(batch)
+                put(done)
+            except BaseException as e:
+                put(e)
+
+        producer = loop.run_in_executor(None, produce)
+        try:
+            while True:
+                batch = await queue.get()
+                if batch is done:
+                    break
+                if isinstance(batch, BaseException):
+                    raise batch
+                for item in batch:
+                    yield item
+        finally:
+            # unblock a producer waiting on a full queue when the consumer stops early
+            stopped.set()
+            while not producer.done():
+                while not queue.empty():
+                    queue.get_nowait()
+                await asyncio.sleep(0.01)
+
+    def cve_actions(self, items, target_index):
+        for item in items:
+            record = {}
+            record['_id'] = item['cve']['CVE_data_meta']['ID']
+            #record['_op_type'] = 'insert'
+            record['_index'] = target_index
+            record['doc_type'] = 'cve'
+            record['_source']  = item
+            yield record
+
+    def count_items(self, items, counter):
+        for item in items:
+            counter['items'] += 1
+            yield item
+
+    def send_actions(self, actions, target_index, ingest_method='parallel_bulk', errors=None, verbose=True, chunk_size=500, max_chunk_bytes=100 * 1024 * 1024, 
+                     bulk_controller=None, max_retries=0, dead_letter=None):
+        # With max_retries or a dead_letter file every method retries 429/503 items with backoff and
+        # dead-letters what is left, instead of raising (bulk), dropping (streaming_bulk) or only collecting (parallel_bulk)
+        if max_retries or dead_letter is not None:
+            failed = []
+            successes = self.send_actions_for_retry(actions, target_index, failed, ingest_method=ingest_method, chunk_size=chunk_size, 
+                                                    max_chunk_bytes=max_chunk_bytes, bulk_controller=bulk_controller)
+            return successes + self.retry_failed_items(failed, errors=errors, dead_letter=dead_letter, max_retries=max_retries, chunk_size=chunk_size, verbose=verbose)
+        successes = 0
+        if ingest_method == 'adaptive_bulk':
+            # send_bulk_chunk records the metrics of the chunked paths
+            return self.adaptive_bulk(actions, controller=bulk_controller, errors=errors, verbose=verbose)
+        elif ingest_method == 'parallel_bulk':
+            for success, info in parallel_bulk(self.client, actions, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes, raise_on_error=False):
+                if not success:
+                    if verbose == True:
+                        print('A document failed:', info)
+                    if errors is not None:
+                        errors.append(info)
+                    self.metrics.inc('nvd_documents_failed_total', status=next(iter(info.values())).get('status', 500))
+                else:
+                    successes += 1
+        elif ingest_method == 'bulk':
+            successes, _ = bulk(self.client, actions, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes)
+        elif ingest_method == 'streaming_bulk':
+            for ok, info in streaming_bulk(client=self.client, index=target_index, actions=actions, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes):
+                successes += ok
+        elif ingest_method == 'singleton':
+            for action in actions:
+                self.client.index(index=action.get('_index', target_index), document=action['_source'], id=action.get('_id'))
+                successes += 1
+        self.metrics.inc('nvd_documents_sent_total', successes)
+        return successes
+
+    def action_lines(self, action):
+        header, source = expand_action(action)
+        lines = [dumps_json(header)]
+        if source is not None:
+            lines.append(dumps_json(source))
+        return lines
+
+    def adaptive_chunks(self, actions, controller):
+        # Serializes actions into NDJSON lines, cutting a chunk at the controller's current document or byte limit
+        chunk = []
+        size = 0
+        serialize_seconds = 0.0
+        for action in actions:
+            start = time.perf_counter()
+            lines = self.action_lines(action)
+            serialize_seconds += time.perf_counter() - start
+            line_bytes = sum(len(line) + 1 for line in lines)
+            if chunk and (len(chunk) >= controller.chunk_docs or size + line_bytes > controller.chunk_bytes):
+                self.metrics.inc('nvd_stage_seconds_total', serialize_seconds, stage='serialize')
+                serialize_seconds = 0.0
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append(lines)
+            size += line_bytes
+        if chunk:
+            self.metrics.inc('nvd_stage_seconds_total', serialize_seconds, stage='serialize')
+            yield chunk
+
+    def send_bulk_chunk(self, chunk, controller=None):
+        # Returns (successes, failed) where failed holds (status, item, lines) for each rejected document
+        start = time.perf_counter()
+        self.metrics.inc('nvd_bulk_requests_total')
+        size = len(chunk.body) if isinstance(chunk, NdjsonChunk) else sum(len(line) + 1 for lines in chunk for line in lines)
+        self.metrics.inc('nvd_bulk_bytes_total', size)
+        try:
+            if isinstance(chunk, NdjsonChunk):
+                response = self.client.bulk(operations=chunk.body)
+            else:
+                response = self.client.bulk(operations=[line for lines in chunk for line in lines])
+        except ElasticsearchConnectionError as e:
+            status = 'N/A'
+            error = str(e)
+        except ApiError as e:
+            if e.meta.status not in RETRYABLE_BULK_STATUSES:
+                raise
+            status = e.meta.status
+            error = str(e)
+        else:
+            latency = time.perf_counter() - start
+            successes = 0
+            failed = []
+            for position, result in enumerate(response['items']):
+                op_type, item = result.popitem()
+                status = item.get('status', 500)
+                if 200 <= status < 300:
+                    successes += 1
+                else:
+                    failed.append((status, {op_type: item}, chunk[position]))
+            if controller is not None:
+                controller.record(latency, response.get('took', 0), len(chunk), any(status == 429 for status, _, _ in failed), size=size)
+            self.metrics.observe('nvd_stage_seconds', latency, stage='bulk')
+            self.record_send_results(successes, failed)
+            return successes, failed
+        if controller is not None:
+            controller.record(time.perf_counter() - start, 0, len(chunk), True, size=size)
+        self.metrics.observe('nvd_stage_seconds', time.perf_counter() - start, stage='bulk')
+        # every item of the chunk failed with the request; each keeps its action's _index and _id so callers can tell which documents did not arrive
+        failed = []
+        for lines in chunk:
+            op_type, meta = next(iter(loads_json(lines[0]).items()))
+            failed.append((status, {op_type: dict(meta, status=status, error=error)}, lines))
+        self.record_send_results(0, failed)
+        return 0, failed
+
+    def send_chunks(self, chunks, concurrency=4, controller=None, errors=None, verbose=False, failed=None):
+        # Keeps up to concurrency bulk requests in flight, or controller.concurrency re-read before every chunk
+        # failed items go to errors, or as (status, item, lines) to failed when the caller retries them
+        successes = 0
+        pending = set()
+
+        def collect(done):
+            nonlocal successes
+            for future in done:
+                sent, chunk_failed = future.result()
+                successes += sent
+                for status, info, lines in chunk_failed:
+                    if failed is not None:
+                        failed.append((status, info, lines))
+                        continue
+                    if verbose == True:
+                        print('A document failed:', info)
+                    if errors is not None:
+                        errors.append(info)
+
+        with ThreadPoolExecutor(max_workers=controller.max_concurrency if controller else concurrency) as executor:
+            for chunk in chunks:
+                while len(pending) >= (controller.concurrency if controller else concurrency):
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending.add(executor.submit(self.send_bulk_chunk, chunk, controller))
+                self.metrics.set('nvd_bulk_requests_in_flight', len(pending))
+            done, pending = wait(pending)
+            collect(done)
+            self.metrics.set('nvd_bulk_requests_in_flight', 0)
+        return successes
+
+    def adaptive_bulk(self, actions, controller=None, errors=None, verbose=False, failed=None):
+        controller = controller or AdaptiveBulkController()
+        return self.send_chunks(self.adaptive_chunks(actions, controller), controller=controller, errors=errors, verbose=verbose, failed=failed)
+
+    def ndjson_chunks(self, items, target_index, id_of, chunk_size=500, max_chunk_bytes=100 * 1024 * 1024, source_of=None):
+        # Encodes items straight into _bulk bodies, with no action dict per document and no second serialization
+        # source_of returns an item's already encoded JSON, as the columnar cache stores it
+        header_prefix = b'{"index":{"_index":' + dumps_json(target_index) + b',"_id":'
+        body = bytearray()
+        offsets = []
+        serialize_seconds = 0.0
+        for item in items:
+            start = time.perf_counter()
+            offsets.append(len(body))
+            body += header_prefix
+            body += dumps_json(id_of(item))
+            body += b'}}\n'
+            body += source_of(item) if source_of is not None else dumps_json(item)
+            body += b'\n'
+            serialize_seconds += time.perf_counter() - start
+            if len(offsets) >= chunk_size or len(body) >= max_chunk_bytes:
+                self.metrics.inc('nvd_stage_seconds_total', serialize_seconds, stage='serialize')
+                serialize_seconds = 0.0
+                yield NdjsonChunk(bytes(body), offsets)
+                body = bytearray()
+                offsets = []
+        if offsets:
+            self.metrics.inc('nvd_stage_seconds_total', serialize_seconds, stage='serialize')
+            yield NdjsonChunk(bytes(body), offsets)
+
+    def cve_id(self, item):
+        return item['cve']['CVE_data_meta']['ID']
+
+    def benchmark_serialization(self, file, data_path=os.path.join(os.curdir, 'demo', 'data', 'db'), target_index='nvd', repetitions=3, chunk_size=500):
+        # Compares the client side CPU cost of building _bulk bodies through action dicts and the client serializer with ndjson_chunks
+        items = list(self.read_cve_items(os.path.join(data_path, file)))
+        serializer = self.client.transport.serializers.get_serializer('application/json')
+
+        def action_path():
+            for chunk_start in range(0, len(items), chunk_size):
+                body = []
+                for action in self.cve_actions(items[chunk_start:chunk_start + chunk_size], target_index):
+                    header, source = expand_action(action)
+                    body.append(serializer.dumps(header))
+                    body.append(serializer.dumps(source))
+                b'\n'.join(body)
+
+        def ndjson_path():
+            for chunk in self.ndjson_chunks(items, target_index, self.cve_id, chunk_size=chunk_size):
+                pass
+
+        report = {'file': file, 'documents': len(items), 'encoder': 'orjson' if orjson is not None else 'json'}
+        for name, path in (('action_dicts', action_path), ('ndjson', ndjson_path)):
+            timings = []
+            for repetition in range(repetitions):
+                start = time.process_time()
+                path()
+                timings.append(time.process_time() - start)
+            best = min(timings)
+            report[name] = {'cpu_seconds': round(best, 4), 'docs_per_second': round(len(items) / best, 2) if best else 0.0}
+        report['speedup'] = round(report['action_dicts']['cpu_seconds'] / report['ndjson']['cpu_seconds'], 2) if report['ndjson']['cpu_seconds'] else 0.0
+        return report
+
+    def tracked_actions(self, actions, sent):
+        # the bulk helpers report results in the order they consumed actions, so sent pairs each result with its action
+        for action in actions:
+            sent.append(action)
+            yield action
+
+    def send_actions_for_retry(self, actions, target_index, failed, ingest_method='parallel_bulk', chunk_size=500, max_chunk_bytes=100 * 1024 * 1024, bulk_controller=None):
+        # Sends actions without raising or dropping failures; every failed item lands in failed as (status, item, lines)
+        successes = 0
+        if ingest_method == 'adaptive_bulk':
+            return self.adaptive_bulk(actions, controller=bulk_controller, failed=failed)
+        rejected = len(failed)
+        if ingest_method == 'singleton':
+            for action in actions:
+                try:
+                    self.client.index(index=action.get('_index', target_index), document=action['_source'], id=action.get('_id'))
+                    successes += 1
+                except ElasticsearchConnectionError as e:
+                    failed.append(('N/A', {'index': {'_id': action.get('_id'), 'status': 'N/A', 'error': str(e)}}, self.action_lines(action)))
+                except ApiError as e:
+                    failed.append((e.meta.status, {'index': {'_id': action.get('_id'), 'status': e.meta.status, 'error': str(e)}}, self.action_lines(action)))
+            self.record_send_results(successes, failed[rejected:])
+            return successes
+        sent = deque()
+        options = {'chunk_size': chunk_size, 'max_chunk_bytes': max_chunk_bytes, 'raise_on_error': False, 'raise_on_exception': False}
+        if ingest_method == 'parallel_bulk':
+            results = parallel_bulk(self.client, self.tracked_actions(actions, sent), **options)
+        else:
+            # bulk is streaming_bulk with the results gathered at the end, so both share this path
+            results = streaming_bulk(client=self.client, index=target_index, actions=self.tracked_actions(actions, sent), **options)
+        for ok, info in results:
+            action = sent.popleft()
+            if ok:
+                successes += 1
+            else:
+                item = next(iter(info.values()))
+                failed.append((item.get('status', 500), info, self.action_lines(action)))
+        self.record_send_results(successes, failed[rejected:])
+        return successes
+
+    def record_send_results(self, successes, failed):
+        self.metrics.inc('nvd_documents_sent_total', successes)
+        for status, _, _ in failed:
+            self.metrics.inc('nvd_documents_failed_total', status=status)
+
+    def retry_failed_items(self, failed, errors=None, dead_letter=None, max_retries=5, initial_backoff=1.0, max_backoff=60.0, chunk_size=500, verbose=True):
+        # Re-sends 429/503/connection failures with full-jitter exponential backoff; the rest go to errors and the dead letter file
+        successes = 0
+        attempt = 0
+        while failed:
+            retryable = []
+            for status, info, lines in failed:
+                if status in RETRYABLE_BULK_STATUSES and attempt < max_retries:
+                    retryable.append(lines)
+                    continue
+                item = next(iter(info.values()))
+                item.pop('exception', None)
+                item.pop('data', None)
+                if verbose == True:
+                    print('A document failed:', info)
+                if errors is not None:
+                    errors.append(info)
+                if dead_letter is not None:
+                    dead_letter.write(lines)
+                    self.metrics.inc('nvd_dead_letters_total')
+            if not retryable:
+                break
+            self.metrics.inc('nvd_retries_total', len(retryable))
+            time.sleep(random.uniform(0, min(max_backoff, initial_backoff * 2 ** attempt)))
+            attempt += 1
+            failed = []
+            for start in range(0, len(retryable), chunk_size):
+                sent, chunk_failed = self.send_bulk_chunk(retryable[start:start + chunk_size])
+                successes += sent
+                failed.extend(chunk_failed)
+        return successes
+
+    def replay_dead_letters(self, path, dead_letter_path=None, max_retries=5, chunk_size=500, verbose=True):
+        # Sends the contents of a dead letter file again; items that still fail go to dead_letter_path when given
+        dead_letter = DeadLetterFile(dead_letter_path) if dead_letter_path else None
+        errors = []
+        failed = []
+        successes = 0
+        chunk = []
+        try:
+            with gzip.open(path, 'rb') as f:
+                lines = (line.rstrip(b'\n') for line in f)
+                for header in lines:
+                    if not header:
+                        continue
+                    entry = [header]
+                    if 'delete' not in json.loads(header):
+                        entry.append(next(lines))
+                    chunk.append(entry)
+                    if len(chunk) >= chunk_size:
+                        sent, chunk_failed = self.send_bulk_chunk(chunk)
+                        successes += sent
+                        failed.extend(chunk_failed)
+                        chunk = []
+            if chunk:
+                sent, chunk_failed = self.send_bulk_chunk(chunk)
+                successes += sent
+                failed.extend(chunk_failed)
+            successes += self.retry_failed_items(failed, errors=errors, dead_letter=dead_letter, max_retries=max_retries, chunk_size=chunk_size, verbose=verbose)
+        finally:
+            if dead_letter is not None:
+                dead_letter.close()
+        return {'successes': successes, 'errors': errors}
+
+    @contextmanager
+    def bulk_load_settings(self, target_index, mappings=None, force_merge=False, max_num_segments=1, wait_for_status='yellow', timeout='60s', verbose=True):
+        # Disables refresh, replicas and per-request translog fsync for the load, then restores the previous values,
+        # refreshes and, once the load succeeded, optionally force merges and waits for wait_for_status
+        # A missing index is created first and its settings read back, so replicas return to what the cluster and any
+        # template gave it; the yellow default does not wait out the timeout for replicas a single node cannot assign
+        load_settings = {'index.refresh_interval': '-1', 'index.number_of_replicas': 0, 'index.translog.durability': 'async'}
+        self.create_index_if_missing(target_index, mappings=mappings)
+        current = self.client.indices.get_settings(index=target_index, flat_settings=True)[target_index]['settings']
+        self.client.indices.put_settings(index=target_index, settings=load_settings)
+        # settings that were never set explicitly are put back to their defaults with None
+        original = {key: current.get(key) for key in load_settings}
+        if verbose == True:
+            print(f'{target_index} prepared for bulk loading, settings will be restored to {original}')
+        try:
+            yield
+        finally:
+            self.client.indices.put_settings(index=target_index, settings=original)
+            self.client.indices.refresh(index=target_index)
+        if force_merge == True:
+            self.client.indices.forcemerge(index=target_index, max_num_segments=max_num_segments)
+        if wait_for_status:
+            try:
+                self.client.cluster.health(index=target_index, wait_for_status=wait_for_status, timeout=timeout)
+            except ApiError as e:
+                logging.warning(f'{target_index} did not reach {wait_for_status} within {timeout}')
+                logging.warning(e)
+
+    def ingest_file(self, file, target_index, data_path=os.path.join(os.curdir, 'demo', 'data', 'db'), verbose=True, ingest_method='parallel_bulk', parse_method='stream', 
+                    max_inflight_bytes=50 * 1024 * 1024, chunk_size=500, max_chunk_bytes=100 * 1024 * 1024, bulk_controller=None, max_retries=0, dead_letter=None, 
+                    checkpoint=None, checkpoint_every=5000, cpe_to_cve=None, keep=None):
+        # With an IngestCheckpoint the file is sent in segments of checkpoint_every items, each one fully acknowledged
+        # before its end offset is recorded, and items below the recorded offset are skipped
+        # a segment with failed items that no dead letter file took holds the offset at its start and keeps the file from
+        # being marked complete, so a resume sends it again; the rest of the file is still sent in this run
+        # a CpeCveIndex in cpe_to_cve sees every item of the file, including the ones a resume skips: a file the checkpoint
+        # marks complete is still read through it, without sending, so the published index covers the whole file_list
+        # keep is this file's mask from coalesce_feeds, items marked False are dropped before anything else sees them
+        start = time.perf_counter()
+        errors = []
+        file_count = {'items': 0}
+        file_path = os.path.join(data_path, file)
+        if ingest_method == 'ndjson_bulk' and parse_method == 'cache':
+            # cached documents are already encoded JSON and go into the bodies as they are
+            cache, path = self.cached_source(file_path, 'CVE_Items', self.json_source_parser(file_path, 'CVE_Items'))
+            items = cache.rows(path)
+            id_of, source_of = (lambda row: row[0]), (lambda row: row[1])
+        else:
+            items = self.read_cve_items(file_path, parse_method=parse_method)
+            id_of, source_of = self.cve_id, None
+        items = self.metrics.timed(items, 'parse')
+        if keep is not None:
+            items = itertools.compress(items, keep)
+        if cpe_to_cve is not None:
+            items = cpe_to_cve.observe(items, item_of=(lambda row: loads_json(row[1])) if source_of is not None else None)
+
+        def send(items):
+            if ingest_method == 'ndjson_bulk':
+                # items are encoded straight into pre-serialized bodies, the budget then counts encoded bytes
+                chunks = self.ndjson_chunks(items, target_index, id_of, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes, source_of=source_of)
+                if max_inflight_bytes:
+                    chunks = BoundedActionBuffer(chunks, max_inflight_bytes=max_inflight_bytes, size_of=lambda chunk: len(chunk.body), metrics=self.metrics)
+                retrying = bool(max_retries or dead_letter is not None)
+                failed = []
+                successes = self.send_chunks(chunks, controller=bulk_controller, errors=errors, verbose=verbose, failed=failed if retrying else None)
+                if retrying:
+                    successes += self.retry_failed_items(failed, errors=errors, dead_letter=dead_letter, max_retries=max_retries, chunk_size=chunk_size, verbose=verbose)
+                return successes
+            actions = self.cve_actions(items, target_index)
+            if max_inflight_bytes:
+                actions = BoundedActionBuffer(actions, max_inflight_bytes=max_inflight_bytes, metrics=self.metrics)
+            return self.send_actions(actions, target_index, ingest_method=ingest_method, errors=errors, verbose=verbose, 
+                                     chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes, bulk_controller=bulk_controller, 
+                                     max_retries=max_retries, dead_letter=dead_letter)
+
+        if checkpoint is None:
+            successes = send(self.count_items(items, file_count))
+            return self.record_file_result({'file': file, 'documents': file_count['items'], 'successes': successes, 'errors': errors, 'seconds': time.perf_counter() - start})
+        source = os.path.abspath(file_path)
+        checksum = file_sha256(file_path)
+        if keep is not None:
+            # offsets count the items left after the mask, so they only hold for the same mask
+            checksum += '-' + mask_digest(keep)[:16]
+        offset, complete = checkpoint.offset(target_index, source, checksum)
+        resumed_from = offset
+        successes = 0
+        if not complete:
+            if verbose == True and offset:
+                print(f'Resuming {file} at item {offset}')
+            items = self.count_items(itertools.islice(items, offset, None), file_count)
+            failed_at = None
+            while True:
+                before = file_count['items']
+                rejected = len(errors)
+                segment = itertools.islice(items, checkpoint_every)
+                first = next(segment, None)
+                if first is None:
+                    break
+                successes += send(itertools.chain([first], segment))
+                if failed_at is None and dead_letter is None and len(errors) > rejected:
+                    failed_at = offset
+                offset += file_count['items'] - before
+                if failed_at is None:
+                    checkpoint.save(target_index, source, checksum, offset)
+            if failed_at is None:
+                checkpoint.save(target_index, source, checksum, offset, complete=True)
+            elif verbose == True:
+                print(f'{file} had failed items, its checkpoint stays at item {failed_at}')
+        else:
+            if verbose == True:
+                print(f'Skipping {file}, already acknowledged up to item {offset}')
+            if cpe_to_cve is not None:
+                deque(items, maxlen=0)
+        return self.record_file_result({'file': file, 'documents': file_count['items'], 'successes': successes, 'errors': errors, 
+                                        'seconds': time.perf_counter() - start, 'resumed_from': resumed_from})
+
+    def record_file_result(self, result):
+        # per-file metrics, written out to the metrics textfile after every file
+        self.metrics.inc('nvd_documents_total', result['documents'])
+        self.metrics.observe('nvd_stage_seconds', result['seconds'], stage='file')
+        self.metrics.set('nvd_documents_per_second', round(result['documents'] / result['seconds'], 2) if result['seconds'] else 0.0)
+        self.metrics.flush()
+        return result
+
+    def open_ingest_checkpoint(self, file_list, target_index, data_path=os.path.join(os.curdir, 'demo', 'data', 'db'), resume=False, checkpoint_path=None):
+        # resume=True continues from checkpoint_path, demo/data/ingest_checkpoint.sqlite by default
+        # a checkpoint_path without resume records a fresh run of file_list, forgetting earlier offsets for these files
+        if resume == False and not checkpoint_path:
+            return None
+        checkpoint = IngestCheckpoint(checkpoint_path or os.path.join(os.curdir, 'demo', 'data', 'ingest_checkpoint.sqlite'))
+        if resume == False:
+            checkpoint.reset(target_index, [os.path.abspath(os.path.join(data_path, file)) for file in file_list])
+        return checkpoint
+
+    def ingest_bulk_json_dataset(self, file_list, target_index, data_path=os.path.join(os.curdir, 'demo', 'data', 'db'), verbose=True, ingest_method='parallel_bulk', parse_method='stream', 
+                                 max_inflight_bytes=50 * 1024 * 1024, chunk_size=500, max_chunk_bytes=100 * 1024 * 1024, bulk_controller=None, 
+                                 max_retries=0, dead_letter_path=None, bulk_load=False, force_merge=False, concurrency=4, resume=False, checkpoint_path=None, 
+                                 checkpoint_every=5000, cpe_index=None, cpe_lookup_path=None, coalesce=False):
+        # ingest_method='adaptive_bulk' tunes batch size and concurrency as it goes; pass an AdaptiveBulkController to set its bounds
+        # max_retries and dead_letter_path turn on the retry layer, see send_actions
+        # bulk_load applies bulk_load_settings to target_index for the duration of the load
+        # ingest_method='async' keeps `concurrency` bulk requests in flight from a single event loop, see async_ingest_json_dataset
+        # resume=True continues each file from its last acknowledged item, see open_ingest_checkpoint
+        # cpe_index and cpe_lookup_path build the CPE to CVE index from the same pass over the files, see publish_cpe_index
+        # coalesce=True sends each CVE once, in its newest version across file_list, see coalesce_feeds; a resume whose file_list gives a file
+        # a different mask sends that file again from its first item
+        if ingest_method == 'adaptive_bulk' and bulk_controller is None:
+            bulk_controller = AdaptiveBulkController()
+        if ingest_method == 'async' and (resume or checkpoint_path):
+            raise ValueError("resume and checkpoint_path need a per-file ingest_method, not 'async'")
+        checkpoint = self.open_ingest_checkpoint(file_list, target_index, data_path=data_path, resume=resume, checkpoint_path=checkpoint_path)
+        dead_letter = DeadLetterFile(dead_letter_path) if dead_letter_path and ingest_method != 'async' else None
+        cpe_to_cve = CpeCveIndex() if cpe_index or cpe_lookup_path else None
+        keep = self.coalesce_feeds(file_list, data_path=data_path, parse_method=parse_method, verbose=verbose) if coalesce == True else {}
         task_queue = len(file_list)
         i = 0
         count = 0
         errors = []
-        if not target_index in [x['index'] for x in self.client.cat.indices(format='json')]:
-            self.client.indices.create(index=target_index)
-        for file in file_list:
-            data = []
-            if file.endswith('son'):
-                i += 1
-                if verbose == True:
-                    print(f'round: {i}: Now ingesting {file} from {data_path} to {target_index}')
-                with open(os.path.join(data_path, file), 'r') as f: 
-                    cve_data = json.loads(f.read())
-                items = cve_data['CVE_Items']
-                count += len(items)
-                for item in items:
-                    record = {}
-                    record['_id'] = item['cve']['CVE_data_meta']['ID']
-                    #record['_op_type'] = 'insert'
-                    record['_index'] = target_index
-                    record['doc_type'] = 'cve'
-                    record['_source']  = item
-                    data.append(record)
-                if ingest_method == 'parallel_bulk':
-                    for success, info in parallel_bulk(self.client, data):
-                        if not success:
+        if bulk_load == False:
+            self.create_index_if_missing(target_index, mappings=self.index_mappings['nvd'])
+        with self.bulk_load_settings(target_index, mappings=self.index_mappings['nvd'], force_merge=force_merge, verbose=verbose) if bulk_load == True else nullcontext():
+            try:
+                if ingest_method == 'async':
+                    report = run_coroutine(self.async_ingest_json_dataset(file_list, target_index, data_path=data_path, verbose=verbose, concurrency=concurrency, 
+                                                                          parse_method=parse_method, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes, 
+                                                                          max_retries=max_retries, dead_letter_path=dead_letter_path, cpe_to_cve=cpe_to_cve, 
+                                                                          keep=keep))
+                    count = report['successes']
+                    errors.extend(report['errors'])
+                else:
+                    self.metrics.set('nvd_files_total', len([file for file in file_list if file.endswith('son') or file.endswith('.json.zip')]))
+                    self.metrics.set('nvd_files_completed', 0)
+                    for file in file_list:
+                        if file.endswith('son') or file.endswith('.json.zip'):
+                            i += 1
                             if verbose == True:
-                                print('A document failed:', info)
-                            errors.append(info)
-                elif ingest_method == 'bulk':
-                    bulk(self.client, data)
-                elif ingest_method == 'streaming_bulk':
-                    successes = 0
-                    for ok, success in streaming_bulk(client=self.client, index=target_index, actions=data):
-                        successes += ok
-                elif ingest_method == 'singleton':
-                    for item in items:
-                        self.client.index(index=target_index, document=item, id=item['cve']['CVE_data_meta']['ID'])
-                if verbose == True:
-                    if i % 2 == 0:
-                        print(f'The ingest process is %{round((i/task_queue) * 100, 2)} complete')
+                                print(f'round: {i}: Now ingesting {file} from {data_path} to {target_index}')
+                            result = self.ingest_file(file, target_index, data_path=data_path, verbose=verbose, ingest_method=ingest_method, parse_method=parse_method, 
+                                                      max_inflight_bytes=max_inflight_bytes, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes, bulk_controller=bulk_controller, 
+                                                      max_retries=max_retries, dead_letter=dead_letter, checkpoint=checkpoint, checkpoint_every=checkpoint_every, 
+                                                      cpe_to_cve=cpe_to_cve, keep=keep.get(file))
+                            count += result['successes']
+                            errors.extend(result['errors'])
+                            self.metrics.set('nvd_files_completed', i)
+                            if verbose == True:
+                                if i % 2 == 0:
+                                    print(f'The ingest process is %{round((i/task_queue) * 100, 2)} complete')
+            finally:
+                if dead_letter is not None:
+                    dead_letter.close()
+                if checkpoint is not None:
+                    checkpoint.close()
+        if cpe_to_cve is not None:
+            self.publish_cpe_index(cpe_to_cve, target_index=cpe_index, lookup_path=cpe_lookup_path, verbose=verbose, chunk_size=chunk_size)
         if ingest_method in ['singleton','bulk', 'streaming_bulk']:
             return f'{count} documents sent to elasticsearch'
-        elif ingest_method == 'parallel_bulk':
+        elif ingest_method in ['parallel_bulk', 'adaptive_bulk', 'ndjson_bulk', 'async']:
             return f'{count} documents sent to elasticsearch, {len(errors)} networking errors were detected during the transfer'
 
-    def document_total_for_directory(self, file_list, data_path=os.path.join(os.curdir, 'demo', 'data', 'db'), verbose=True):
-        i=0
-        document_sum = 0
-        cve_ids = []
-        for file in file_list:
-            i += 1
-            if file.endswith('son'):
-                if verbose == True:
-                    print(f'round: {i}: Now counting CVE items in {file} from {data_path}')
-                with open(os.path.join(data_path, file), 'r') as f: 
-                    cve_data = json.loads(f.read())
-                items = cve_data['CVE_Items']
-                for item in items:
-                    cve_ids.append(item['cve']['CVE_data_meta']['ID'])
-                document_sum += len(items)
-        return {'total_read_documents':document_sum, 'unique_cve_ids':len(set(cve_ids))}
-
-    def test_ingest_methods(self, file_list=sorted(os.listdir(os.path.join(os.curdir, 'demo', 'data', 'db'))), data_path=os.path.join(os.curdir, 'demo', 'data', 'db'), sleep_time_between_tests=180, skip_singleton=False):
-        document_data = self.document_total_for_directory(file_list=file_list, data_path=data_path, verbose=False)
-        report = {}
-        for technique in ['singleton', 'bulk', 'parallel_bulk', 'streaming_bulk']:
-            print(f'Now testing {technique} ingest technique')
-            if skip_singleton == True:
-                if technique == 'singleton':
-                    pass
-                else:
+    def async_client(self):
+        # elastic_url may be a list of nodes; the client spreads requests across all of them
+        if self.instance_type == 'elastic_cloud':
+            return AsyncElasticsearch(cloud_id=self.elastic_cloud_id, http_auth=(self.elastic_user, self.elastic_password))
+        return AsyncElasticsearch(self.elastic_url, basic_auth=(self.elastic_user, self.elastic_password), verify_certs=False)
+
+    async def async_ingest_json_dataset(self, file_list, target_index, data_path=os.path.join(os.curdir, 'demo', 'data', 'db'), verbose=True, concurrency=4, 
+                                        parse_method='stream', chunk_size=500, max_chunk_bytes=100 * 1024 * 1024, max_retries=0, dead_letter_path=None, dictionary=None, 
+                                        cpe_to_cve=None, keep=None):
+        # One event loop keeps `concurrency` bulk requests in flight, fed from every file at once through a shared queue
+        # With a feed dictionary the files are downloaded into data_path first, each one parsed as soon as its download completes
+        # keep maps file names to coalesce_feeds masks
+        if aiohttp is None:
+            raise ImportError("ingest_method='async' needs aiohttp, pip install elasticsearch[async]")
+        client = self.async_client()
+        dead_letter = DeadLetterFile(dead_letter_path) if dead_letter_path else None
+        queue = asyncio.Queue(maxsize=chunk_size * concurrency * 2)
+        report = {'documents': 0, 'successes': 0, 'errors': [], 'files': {}}
+
+        async def produce(file_path):
+            count = 0
+            mask = (keep or {}).get(os.path.basename(file_path))
+            position = -1
+            async for item in self.async_read_cve_items(file_path, parse_method=parse_method):
+                position += 1
+                if mask is not None and (position >= len(mask) or not mask[position]):
+                    continue
+                if cpe_to_cve is not None:
+                    cpe_to_cve.add(item)
+                await queue.put({'_id': self.cve_id(item), '_index': target_index, '_source': item})
+                count += 1
+            report['documents'] += count
+            report['files'][os.path.basename(file_path)] = count
+            if verbose == True:
+                print(f'{os.path.basename(file_path)}: {count} documents queued for {target_index}')
+
+        async def fetch_and_produce(session, target):
+            stats = await self.async_download_file(session, target, data_path, verbose=verbose)
+            await produce(os.path.join(data_path, stats['file']))
+
+        async def drain(pending):
+            while True:
+                action = await queue.get()
+                if action is None:
+                    return
+                pending.setdefault(action['_id'], deque()).append(action)
+                yield action
+
+        async def consume():
+            # the helper only reports failed items, so actions are held by _id until their result comes back
+            pending = {}
+            async for ok, info in async_streaming_bulk(client, drain(pending), chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes, raise_on_error=False, 
+                                                       raise_on_exception=False, max_retries=max_retries, initial_backoff=1, max_backoff=60):
+                _, item = next(iter(info.items()))
+                sent = pending.get(item.get('_id'))
+                action = sent.popleft() if sent else None
+                if sent is not None and not sent:
+                    del pending[item.get('_id')]
+                if ok:
+                    report['successes'] += 1
+                    continue
+                report['errors'].append(info)
+                if dead_letter is not None and action is not None:
+                    dead_letter.write(self.action_lines(action))
+                    self.metrics.inc('nvd_dead_letters_total')
+
+        start = time.perf_counter()
+        consumers = [asyncio.create_task(consume()) for _ in range(concurrency)]
+        try:
+            if dictionary:
+                os.makedirs(data_path, exist_ok=True)
+                async with aiohttp.ClientSession() as session:
+                    await asyncio.gather(*(fetch_and_produce(session, dictionary[key]) for key in dictionary))
+            else:
+                await asyncio.gather(*(produce(os.path.join(data_path, file)) for file in file_list if file.endswith('son') or file.endswith('.json.zip')))
+            for _ in consumers:
+                await queue.put(None)
+            await asyncio.gather(*consumers)
+        except BaseException:
+            for consumer in consumers:
+                consumer.cancel()
+            raise
+        finally:
+            await client.close()
+            if dead_letter is not None:
+                dead_letter.close()
+        report['seconds'] = time.perf_counter() - start
+        report['docs_per_second'] = round(report['documents'] / report['seconds'], 2) if report['seconds'] else 0.0
+        self.metrics.inc('nvd_documents_sent_total', report['successes'])
+        for info in report['errors']:
+            self.metrics.inc('nvd_documents_failed_total', status=next(iter(info.values())).get('status', 500))
+        self.record_file_result({'documents': report['documents'], 'seconds': report['seconds']})
+        return report
+
+    def parallel_ingest_json_dataset(self, file_list, target_index, data_path=os.path.join(os.curdir, 'demo', 'data', 'db'), processes=os.cpu_count(), verbose=True, 
+                                     ingest_method='streaming_bulk', parse_method='stream', max_inflight_bytes=50 * 1024 * 1024, chunk_size=500, max_chunk_bytes=100 * 1024 * 1024, 
+                                     max_retries=0, dead_letter_path=None, bulk_load=False, force_merge=False, resume=False, checkpoint_path=None, checkpoint_every=5000, 
+                                     cpe_index=None, cpe_lookup_path=None, coalesce=False):
+        # Spreads the files across worker processes, each with its own client, so parsing and serialization use every core
+        # with dead_letter_path each file gets its own dead letter file, e.g. dead_letters-nvdcve-1.1-2020.ndjson.gz
+        # resume and checkpoint_path work as in ingest_bulk_json_dataset, the workers share one checkpoint file
+        # with cpe_index or cpe_lookup_path each worker indexes the CPEs of its files and the parent merges and publishes them
+        # with coalesce=True the parent runs coalesce_feeds and each worker gets its file's mask
+        if bulk_load == False:
+            self.create_index_if_missing(target_index, mappings=self.index_mappings['nvd'])
+        files = [file for file in file_list if file.endswith('son') or file.endswith('.json.zip')]
+        # largest files first so a big year does not start last and hold up the pool
+        files.sort(key=lambda file: os.path.getsize(os.path.join(data_path, file)), reverse=True)
+        options = {'verbose': False, 'ingest_method': ingest_method, 'parse_method': parse_method, 'max_inflight_bytes': max_inflight_bytes, 
+                   'chunk_size': chunk_size, 'max_chunk_bytes': max_chunk_bytes, 'max_retries': max_retries, 'checkpoint_every': checkpoint_every, 
+                   'cpe_to_cve': bool(cpe_index or cpe_lookup_path)}
+        cpe_to_cve = CpeCveIndex() if cpe_index or cpe_lookup_path else None
+        keep = self.coalesce_feeds(file_list, data_path=data_path, parse_method=parse_method, processes=processes, verbose=verbose) if coalesce == True else {}
+        checkpoint = self.open_ingest_checkpoint(files, target_index, data_path=data_path, resume=resume, checkpoint_path=checkpoint_path)
+        if checkpoint is not None:
+            options['checkpoint_path'] = checkpoint.path
+            checkpoint.close()
+        report = {'documents': 0, 'successes': 0, 'errors': [], 'files': {}}
+        start = time.perf_counter()
+        with self.bulk_load_settings(target_index, mappings=self.index_mappings['nvd'], force_merge=force_merge, verbose=verbose) if bulk_load == True else nullcontext():
+            with ProcessPoolExecutor(max_workers=processes, initializer=init_ingest_worker, initargs=(self.instance_type, getattr(self, 'elastic_url', None))) as executor:
+                self.metrics.set('nvd_files_total', len(files))
+                self.metrics.set('nvd_files_completed', 0)
+                futures = {}
+                for file in files:
+                    file_options = dict(options, keep=keep.get(file))
+                    if dead_letter_path:
+                        root = dead_letter_path[:-len('.ndjson.gz')] if dead_letter_path.endswith('.ndjson.gz') else dead_letter_path
+                        file_options['dead_letter_path'] = f"{root}-{file.split('.json')[0]}.ndjson.gz"
+                    futures[executor.submit(ingest_file_worker, file, target_index, data_path, file_options)] = file
+                for i, future in enumerate(as_completed(futures), start=1):
+                    file = futures[future]
                     try:
-                        self.client.indices.delete(index='nvd')
+                        result = future.result()
                     except Exception as e:
-                        pass
-                    self.ingest_bulk_json_dataset(file_list=file_list, ingest_method=technique, target_index='nvd', verbose=False)
-                    time.sleep(sleep_time_between_tests)
-                    report[technique] = self.client.cat.indices(index='nvd', format='json')[0]
+                        result = {'file': file, 'documents': 0, 'successes': 0, 'errors': [{'file': file, 'error': repr(e)}], 'seconds': 0.0}
+                    if cpe_to_cve is not None:
+                        cpe_to_cve.merge(result.pop('cpe_to_cve', {}))
+                    report['documents'] += result['documents']
+                    report['successes'] += result['successes']
+                    report['errors'].extend(result['errors'])
+                    report['files'][file] = {key: result[key] for key in ('documents', 'successes', 'seconds', 'resumed_from') if key in result}
+                    # workers keep their own metrics, so the parent records what each file reports
+                    self.metrics.inc('nvd_documents_sent_total', result['successes'])
+                    for seconds in result.pop('bulk_seconds', []):
+                        self.metrics.observe('nvd_stage_seconds', seconds, stage='bulk')
+                    self.record_file_result(result)
+                    self.metrics.set('nvd_files_completed', i)
+                    if verbose == True:
+                        print(f"{file}: {result['documents']} documents in {round(result['seconds'], 2)}s, the ingest process is %{round((i/len(files)) * 100, 2)} complete")
+        if cpe_to_cve is not None:
+            report['cpe_to_cve'] = self.publish_cpe_index(cpe_to_cve, target_index=cpe_index, lookup_path=cpe_lookup_path, verbose=verbose, chunk_size=chunk_size)
+        report['seconds'] = time.perf_counter() - start
+        report['docs_per_second'] = round(report['documents'] / report['seconds'], 2) if report['seconds'] else 0.0
         return report
 
-    def update_cve_data(self, dictionary, data_path=os.path.join('demo', 'data'), target_index='nvd', update_method='streaming_bulk'):
+    def coalesce_feeds(self, file_list, data_path=os.path.join(os.curdir, 'demo', 'data', 'db'), parse_method='stream', processes=os.cpu_count(), verbose=True):
+        # Which items of each file to send so every CVE ID goes out once, in its version with the newest lastModifiedDate,
+        # when file_list mixes the yearly feeds with recent and modified; ties go to the file later in file_list
+        # Returns {file: boolean array over the file's items}. Only IDs and dates are kept, as int64 columns, and with
+        # parse_method='cache' they come from the cached columns without decoding any document
+        files = [file for file in file_list if file.endswith('son') or file.endswith('.json.zip')]
+        paths = [os.path.join(data_path, file) for file in files]
+        if parse_method == 'cache':
+            frames = [self.cached_frame(path, columns=('id', 'last_modified_date')) for path in paths]
+            versions = [(np.fromiter(map(encode_cve_id, frame['id']), dtype=np.int64, count=len(frame)), modified_nanoseconds(frame['last_modified_date'])) 
+                        for frame in frames]
+        elif len(paths) > 1 and processes and processes > 1:
+            with ProcessPoolExecutor(max_workers=min(processes, len(paths))) as executor:
+                versions = list(executor.map(file_cve_versions, paths))
+        else:
+            versions = [file_cve_versions(path) for path in paths]
+        if not versions:
+            return {}
+        ids = np.concatenate([file_ids for file_ids, _ in versions])
+        modified = np.concatenate([file_modified for _, file_modified in versions])
+        sizes = [len(file_ids) for file_ids, _ in versions]
+        sources = np.repeat(np.arange(len(files)), sizes)
+        positions = np.concatenate([np.arange(size) for size in sizes])
+        # sorted by ID, then date, file and position; the last row of each ID is the version to send
+        order = np.lexsort((positions, sources, modified, ids))
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = ids[order][1:] != ids[order][:-1]
+        keep = np.zeros(len(order), dtype=bool)
+        keep[order[last]] = True
+        dropped = int(len(keep) - keep.sum())
+        self.metrics.inc('nvd_documents_coalesced_total', dropped)
+        if verbose == True:
+            print(f'{int(keep.sum())} of {len(keep)} CVE items across {len(files)} files are the newest version of their CVE, {dropped} superseded ones will not be sent')
+        return dict(zip(files, np.split(keep, np.cumsum(sizes)[:-1])))
+
+    def publish_cpe_index(self, cpe_to_cve, target_index='cpe_to_cve', lookup_path=None, verbose=True, chunk_size=500):
+        # One document per vulnerable CPE URI with its CVE IDs and version bounds, sent to target_index and/or written to a CpeLookupFile
+        # documents replace earlier ones per URI, so build it from the full set of feeds rather than recent or modified alone
+        result = {'cpe_uris': len(cpe_to_cve)}
+        if target_index:
+            self.create_index_if_missing(target_index, mappings=self.index_mappings['cpe_to_cve'])
+            result['sent'] = self.send_actions(cpe_to_cve.actions(target_index), target_index, ingest_method='streaming_bulk', verbose=verbose, chunk_size=chunk_size)
+        if lookup_path:
+            lookup = CpeLookupFile(lookup_path)
+            try:
+                result['written'] = lookup.write(cpe_to_cve.documents())
+            finally:
+                lookup.close()
+        if verbose == True:
+            print(f"{result['cpe_uris']} CPE URIs indexed to {target_index or lookup_path}")
+        return result
+
+    def lookup_cpe(self, cpe23Uri, target_index='cpe_to_cve', lookup_path=None):
+        # CVE IDs and version bounds for one CPE URI, from the lookup file when given, otherwise a get on target_index; None when unknown
+        if lookup_path:
+            lookup = CpeLookupFile(lookup_path)
+            try:
+                return lookup.get(cpe23Uri)
+            finally:
+                lookup.close()
+        try:
+            return self.client.get(index=target_index, id=cpe23Uri)['_source']
+        except ApiError as e:
+            if e.status_code == 404:
+                return None
+            raise
+
+    def document_total_for_directory(self, file_list, data_path=os.path.join(os.curdir, 'demo', 'data', 'db'), verbose=True, 
+                                     manifest_path=os.path.join(os.curdir, 'demo', 'data', 'document_manifest.json'), processes=os.cpu_count()):
+        # Per-file counts come from a manifest keyed on path, size, mtime and sha256; only new or changed files are parsed, in parallel
+        # manifest_path=None skips the manifest and parses every file
+        manifest = self.load_feed_state(manifest_path) if manifest_path else {}
+        stale = []
+        for file in file_list:
+            if file.endswith('son') or file.endswith('.json.zip'):
+                file_path = os.path.abspath(os.path.join(data_path, file))
+                stat = os.stat(file_path)
+                entry = manifest.get(file_path)
+                if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+                    continue
+                # a touched but identical file only needs its mtime refreshed
+                if entry and entry['size'] == stat.st_size and entry['sha256'] == file_sha256(file_path):
+                    entry['mtime'] = stat.st_mtime
+                    continue
+                stale.append(file_path)
+        if len(stale) > 1 and processes and processes > 1:
+            with ProcessPoolExecutor(max_workers=min(processes, len(stale))) as executor:
+                for file_path, entry in zip(stale, executor.map(file_document_stats, stale)):
+                    manifest[file_path] = entry
+        else:
+            for file_path in stale:
+                manifest[file_path] = file_document_stats(file_path)
+        if verbose == True:
+            print(f'{len(stale)} of {len([x for x in file_list if x.endswith("son") or x.endswith(".json.zip")])} files counted, the rest came from the manifest')
+        if manifest_path:
+            os.makedirs(os.path.dirname(manifest_path) or os.curdir, exist_ok=True)
+            self.save_feed_state(manifest, manifest_path)
+        entries = [manifest[os.path.abspath(os.path.join(data_path, file))] for file in file_list if file.endswith('son') or file.endswith('.json.zip')]
+        unique_ids = np.unique(np.concatenate([unpack_cve_ids(entry['cve_ids']) for entry in entries])) if entries else []
+        return {'total_read_documents': sum(entry['documents'] for entry in entries), 'unique_cve_ids': len(unique_ids)}
+
+    def changed_cve_actions(self, items, target_index, store, counts, pending):
+        # new CVEs are sent with op_type create, changed ones as index, unchanged ones are skipped
+        # Returns a list rather than a generator: the store's SQLite connection only works on the thread that opened it,
+        # and parallel_bulk would pull a generator from its pool's task thread
+        actions = []
+        for item in items:
+            cve_id = self.cve_id(item)
+            content_hash = store.content_hash(item)
+            state = store.classify(cve_id, content_hash)
+            counts[state] += 1
+            if state == 'unchanged':
+                continue
+            pending[cve_id] = (cve_id, item.get('lastModifiedDate'), content_hash)
+            record = {'_id': cve_id, '_index': target_index, '_source': item}
+            if state == 'new':
+                record['_op_type'] = 'create'
+            actions.append(record)
+        return actions
+
+    def ingest_changed_cves(self, file, target_index, state_path, data_path=os.path.join('demo', 'data', 'db'), ingest_method='streaming_bulk', max_retries=3, verbose=True, 
+                            batch_size=5000):
+        # Sends only the CVEs whose content changed since the state store last saw them and records what was acknowledged
+        # Items are classified batch_size at a time on this thread, then the batch's actions go to the bulk helper
+        self.create_index_if_missing(target_index, mappings=self.index_mappings['nvd'])
+        store = CveStateStore(state_path)
+        counts = {'new': 0, 'changed': 0, 'unchanged': 0}
+        pending = {}
+        errors = []
+        failed = []
+        try:
+            items = iter(self.read_cve_items(os.path.join(data_path, file)))
+            successes = 0
+            for batch in iter(lambda: list(itertools.islice(items, batch_size)), []):
+                actions = self.changed_cve_actions(batch, target_index, store, counts, pending)
+                successes += self.send_actions_for_retry(actions, target_index, failed, ingest_method=ingest_method)
+            # a CVE the store has not seen may already be in the index, e.g. from a historic load, so conflicts are sent again as index
+            conflicts = [(status, info, lines) for status, info, lines in failed if status == 409]
+            failed = [entry for entry in failed if entry[0] != 409]
+            for start in range(0, len(conflicts), 500):
+                chunk = [[b'{"index"' + lines[0][len(b'{"create"'):]] + lines[1:] for _, _, lines in conflicts[start:start + 500]]
+                sent, chunk_failed = self.send_bulk_chunk(chunk)
+                successes += sent
+                failed.extend(chunk_failed)
+            successes += self.retry_failed_items(failed, errors=errors, max_retries=max_retries, verbose=verbose)
+            for info in errors:
+                pending.pop(next(iter(info.values())).get('_id'), None)
+            store.update(pending.values())
+        finally:
+            store.close()
+        return {'new': counts['new'], 'changed': counts['changed'], 'unchanged': counts['unchanged'], 'successes': successes, 'errors': errors}
+
+    def update_cve_data(self, dictionary, data_path=os.path.join('demo', 'data'), target_index='nvd', update_method='streaming_bulk', from_archive=False, state_path=None):
+        # from_archive streams the feed straight out of the downloaded zip instead of extracting it to data_path/db
+        # state_path keeps a CveStateStore so only new and changed CVEs are sent, see ingest_changed_cves
         self.download_files({'file':dictionary['CVE-Modified']})
-        self.extract_archives(data_path=data_path)
-        output = self.ingest_bulk_json_dataset(['nvdcve-1.1-modified.json'], target_index, data_path=os.path.join(data_path, 'db'), verbose=True, ingest_method=update_method)
-        self.clean_download_directory(dictionary={'update_feed':'https://nvd.nist.gov/feeds/json/cve/1.1/nvdcve-1.1-modified.json.zip'}, output_path=data_path)
+        if state_path is not None:
+            if from_archive == True:
+                report = self.ingest_changed_cves(dictionary['CVE-Modified'].split('/')[-1], target_index, state_path, data_path=data_path, ingest_method=update_method)
+            else:
+                self.extract_archives(data_path=data_path)
+                report = self.ingest_changed_cves('nvdcve-1.1-modified.json', target_index, state_path, data_path=os.path.join(data_path, 'db'), ingest_method=update_method)
+            output = (f"{report['new']} new, {report['changed']} changed and {report['unchanged']} unchanged CVEs, "
+                      f"{report['successes']} documents sent to elasticsearch, {len(report['errors'])} errors")
+        elif from_archive == True:
+            output = self.ingest_bulk_json_dataset([dictionary['CVE-Modified'].split('/')[-1]], target_index, data_path=data_path, verbose=True, ingest_method=update_method)
+        else:
+            self.extract_archives(data_path=data_path)
+            output = self.ingest_bulk_json_dataset(['nvdcve-1.1-modified.json'], target_index, data_path=os.path.join(data_path, 'db'), verbose=True, ingest_method=update_method)
+        self.clean_download_directory(dictionary={'update_feed':'https://nvd.nist.gov/feeds/json/cve/1.1/nvdcve-1.1-modified.json.zip'}, output_path=data_path, clean_db=not from_archive)
         return output
 
-    def create_nvd_recent_index(self, data_path=os.path.join('demo', 'data'), target_index='nvd_recent'):
+    def create_nvd_recent_index(self, data_path=os.path.join('demo', 'data'), target_index='nvd_recent', from_archive=False):
         try:
             self.client.index.delete('nvd_recent')
         except:
             pass
         self.download_files({'file':self.two_hour_stream_feeds['CVE-Recent']})
-        self.extract_archives(data_path)
-        self.ingest_bulk_json_dataset([self.two_hour_stream_feeds['CVE-Recent'].split('/')[-1].rstrip('.zip')], 
-                                      target_index, data_path=os.path.join(data_path, 'db'), 
-                                      verbose=True, ingest_method='singleton')
-        self.clean_download_directory(dictionary={'update_feed':self.two_hour_stream_feeds['CVE-Recent']}, output_path=data_path)
+        if from_archive == True:
+            self.ingest_bulk_json_dataset([self.two_hour_stream_feeds['CVE-Recent'].split('/')[-1]], 
+                                          target_index, data_path=data_path, 
+                                          verbose=True, ingest_method='singleton')
+        else:
+            self.extract_archives(data_path)
+            self.ingest_bulk_json_dataset([self.two_hour_stream_feeds['CVE-Recent'].split('/')[-1].rstrip('.zip')], 
+                                          target_index, data_path=os.path.join(data_path, 'db'), 
+                                          verbose=True, ingest_method='singleton')
+        self.clean_download_directory(dictionary={'update_feed':self.two_hour_stream_feeds['CVE-Recent']}, output_path=data_path, clean_db=not from_archive)
         return True
 
-    def create_cpe_match_index(self, target_index, data_path=os.path.join('demo', 'data'), output_path=os.path.join('demo', 'data', 'db')):
-        if not target_index in [x['index'] for x in self.client.cat.indices(format='json')]:
-            self.client.indices.create(index=target_index)
-        self.download_files({'file':self.cpe_match_feed['CPE-Match']})
-        self.extract_archives(data_path)
+    def cpe_match_id(self, match):
+        # cpe23Uri alone is not unique, the same CPE appears once per version range, so the bounds are part of the ID
+        key = '|'.join(match.get(field, '') for field in ('cpe23Uri', 'versionStartIncluding', 'versionStartExcluding', 'versionEndIncluding', 'versionEndExcluding'))
+        return hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+
+    def cpe_match_actions(self, matches, target_index):
+        for match in self.with_cpe_fields(matches, lambda match: [match]):
+            yield {'_id': self.cpe_match_id(match), '_index': target_index, '_source': match}
+
+    def create_cpe_match_index(self, target_index, data_path=os.path.join('demo', 'data'), output_path=os.path.join('demo', 'data', 'db'), from_archive=False, 
+                               bulk_load=False, force_merge=False, ingest_method='streaming_bulk', verbose=False, chunk_size=500, max_chunk_bytes=100 * 1024 * 1024, 
+                               max_inflight_bytes=50 * 1024 * 1024, max_retries=0, dead_letter_path=None):
+        # The feed is streamed one match at a time and sent with IDs from cpe_match_id, so a reload overwrites instead of duplicating
+        if bulk_load == False:
+            self.create_index_if_missing(target_index, mappings=self.index_mappings['cpe_match'])
+        self.download_files({'file':self.cpe_match_feed['CPE-Match']}, output_path=data_path)
         errors = []
-        with open(os.path.join(output_path, self.cpe_match_feed['CPE-Match'].split('/')[-1].rstrip('.zip')), 'r') as f:
-            data = json.loads(f.read())
-        #  only singleton is working with this data
-        for document in data['matches']:
-            self.client.index(document=document, index=target_index)
-        # bulk
-        #output = []
-        #for item in data['matches']:
-        #    record = {}
-        #    #record['_op_type'] = 'insert'
-        #    record['_index'] = target_index
-        #    record['doc_type'] = 'cpe_match'
-        #    record['_source']  = item
-        #    output.append(record)
-        #bulk(self.client, output)
-        self.clean_download_directory(dictionary={'match_feed':self.cpe_match_feed['CPE-Match'].split('/')[-1]})
-        return 
-
-    def load_cpe_dictionary(self, target_file, target_index='cpe_dictionary', ingest_method='bulk'):
+        target_file = self.cpe_match_feed['CPE-Match'].split('/')[-1]
+        if from_archive == True:
+            matches = self.read_json_items(os.path.join(data_path, target_file), 'matches')
+        else:
+            self.extract_archives(data_path, output_path=output_path)
+            matches = self.read_json_items(os.path.join(output_path, target_file.rstrip('.zip')), 'matches')
+        actions = self.cpe_match_actions(matches, target_index)
+        if max_inflight_bytes and ingest_method != 'singleton':
+            actions = BoundedActionBuffer(actions, max_inflight_bytes=max_inflight_bytes)
+        dead_letter = DeadLetterFile(dead_letter_path) if dead_letter_path else None
+        try:
+            with self.bulk_load_settings(target_index, mappings=self.index_mappings['cpe_match'], force_merge=force_merge, verbose=verbose) if bulk_load == True else nullcontext():
+                successes = self.send_actions(actions, target_index, ingest_method=ingest_method, errors=errors, verbose=verbose, chunk_size=chunk_size, 
+                                              max_chunk_bytes=max_chunk_bytes, max_retries=max_retries, dead_letter=dead_letter)
+        finally:
+            if dead_letter is not None:
+                dead_letter.close()
+        self.clean_download_directory(dictionary={'match_feed':target_file}, output_path=data_path, clean_db=not from_archive, verbose=verbose)
+        return f'{successes} documents sent to elasticsearch, {len(errors)} networking errors were detected during the transfer'
+
+    def cpe_dictionary_actions(self, items, target_index):
+        for document in self.with_cpe_fields(items, lambda item: [item], uri_of=lambda item: (item.get('cpe-23:cpe23-item') or {}).get('@name')):
+            record = {}
+            record['_source'] = document
+            record['_id'] = document['@name']
+            record['_index'] = target_index
+            record['doc_type'] = 'cpe_record'
+            yield record
+
+    def read_cpe_items(self, file_path, parse_method='stream'):
+        # 'stream' converts one cpe-item at a time as the XML is read, 'load' parses the whole document with xmltodict first
+        if parse_method == 'cache':
+            cache, path = self.cached_source(file_path, 'cpe-item', lambda: self.read_cpe_items(file_path))
+            yield from cache.documents(path)
+            return
+        with open_feed(file_path) as f:
+            if parse_method == 'load':
+                yield from xmltodict.parse(f.read())['cpe-list']['cpe-item']
+            else:
+                yield from iter_xml_items(f, 'cpe-item')
+
+    def load_cpe_dictionary(self, target_file, target_index='cpe_dictionary', ingest_method='bulk', verbose=False, max_inflight_bytes=50 * 1024 * 1024, parse_method='stream'):
         errors = []
-        with open(target_file, 'r') as f:
-            data = xmltodict.parse(f.read())
+        self.create_index_if_missing(target_index, mappings=self.index_mappings['cpe_dictionary'])
+        records = self.cpe_dictionary_actions(self.read_cpe_items(target_file, parse_method=parse_method), target_index)
         if ingest_method=='singleton':
-            for item in data['cpe-list']['cpe-item']:
-                es.index(document=item, index='cpe_dictionary', id=item['@name'])
+            self.send_actions(records, target_index, ingest_method=ingest_method, errors=errors, verbose=verbose)
             return self.client.cat.indices(index=target_index, format='json')[0]
         else:
-            records = []
-            for document in data['cpe-list']['cpe-item']:
-                record = {}
-                record['_source'] = document
-                record['_id'] = document['@name']
-                record['_index'] = target_index
-                record['doc_type'] = 'cpe_record'
-                records.append(record)
+            if max_inflight_bytes:
+                records = BoundedActionBuffer(records, max_inflight_bytes=max_inflight_bytes)
+            successes = self.send_actions(records, target_index, ingest_method=ingest_method, errors=errors, verbose=verbose)
             if ingest_method == 'parallel_bulk':
-                for success, info in parallel_bulk(self.client, records):
-                    if not success:
-                        if verbose == True:
-                            print('A document failed:', info)
-                        errors.append(info)
                 return self.client.cat.indices(index=target_index, format='json')[0], errors
             elif ingest_method == 'bulk':
-                bulk(self.client, records)
                 return self.client.cat.indices(index=target_index, format='json')[0]
             elif ingest_method == 'streaming_bulk':
-                successes = 0
-                for ok, success in streaming_bulk(client=self.client, index=target_index, actions=records):
-                    successes += ok
-                    return self.client.cat.indices(index=target_index, format='json')[0], successes
+                return self.client.cat.indices(index=target_index, format='json')[0], successes
     
-    def load_cce_data(self, file_list, data_path, verbose=True):
-        i =0 
-        for file in file_list:
-            skip_rows = 0
-            toggle = False
-            if file.endswith('xls') or file.endswith('xlsx'):
-                while toggle == False:
-                    df = pd.read_excel(os.path.join(data_path, file))
-                    if df.columns[1].startswith('Last') or df.columns[1].startswith('Version'):
-                        skip_rows += 1
-                    df = pd.read_excel(os.path.join(data_path, file), skiprows=skip_rows)
-                    if not df.columns[1].startswith('Last') and not df.columns[1].startswith('Version'):
-                        toggle = True
-                if verbose == True:
-                    print(f'Now logging {file} to the Elasticsearch Common Configuration Enumeration definitions index')
-                db =  df.T.to_dict()
-                for row in db:
-                    document = db[row]
-                    d2 = deepcopy(document)
-                    for k,v in document.items():
-                        if not type(v) == str:
-                            if type(v) == float:
-                                if not np.isfinite(v):
-                                    d2.pop(k)
-                    if len(d2.keys()) < 1:
-                        break
-                    else:
-                        keys = d2.keys()
-                        if 'CCE' in keys:
-                            _id = d2['CCE']
-                        elif 'CCE ID' in keys:
-                            _id = d2['CCE ID']
-                        elif 'CCE ID v5' in keys:
-                            _id = d2['CCE ID v5']
-                        document['data_file'] = file
-                        self.client.index(document=d2, index='cce', id=_id)
-                i += 1
-                if verbose == True:
-                    print(f'{i} documents processed')
-        return
\ No newline at end of file
+    def cce_table(self, raw):
+        # raw is the sheet read with header=None; the header is the first row whose second cell is not a 'Last ...' or 'Version ...' preamble line
+        second = raw.iloc[:, 1].astype(str)
+        preamble = (second.str.startswith('Last') | second.str.startswith('Version')).to_numpy()
+        header_row = int(np.argmin(preamble)) if not preamble.all() else 0
+        columns = []
+        for position, name in enumerate(raw.iloc[header_row]):
+            name = f'Unnamed: {position}' if pd.isna(name) else str(name)
+            while name in columns:
+                name += '.1'
+            columns.append(name)
+        table = raw.iloc[header_row + 1:].set_axis(columns, axis=1).reset_index(drop=True).infer_objects()
+        # rows after the first empty one are notes, not definitions
+        empty = (~table.notna().any(axis=1)).to_numpy()
+        if empty.any():
+            table = table.iloc[:int(np.argmax(empty))]
+        return table
+
+    def cce_actions(self, table, file, target_index='cce'):
+        # the ID column is named CCE, CCE ID or CCE ID v5 depending on the workbook, the first non-empty one wins
+        ids = pd.Series(None, index=table.index, dtype=object)
+        for column in ('CCE', 'CCE ID', 'CCE ID v5'):
+            if column in table.columns:
+                ids = ids.where(ids.notna(), table[column])
+        present = table.notna().to_numpy()
+        values = table.to_numpy(dtype=object)
+        columns = np.array(table.columns, dtype=object)
+        for row_present, row, _id in zip(present, values, ids):
+            document = dict(zip(columns[row_present], row[row_present]))
+            document['data_file'] = file
+            action = {'_index': target_index, '_source': document}
+            if not pd.isna(_id):
+                action['_id'] = str(_id)
+            yield action
+
+    def load_cce_data(self, file_list, data_path, verbose=True, target_index='cce', ingest_method='streaming_bulk', chunk_size=500, parse_method='load'):
+        # each workbook is read once and sent as bulk actions, parse_method='cache' keeps the parsed rows in the columnar cache
+        self.create_index_if_missing(target_index)
+        successes = 0
+        errors = []
+        for i, file in enumerate([x for x in file_list if x.endswith('xls') or x.endswith('xlsx')], start=1):
+            if verbose == True:
+                print(f'Now logging {file} to the Elasticsearch Common Configuration Enumeration definitions index')
+            file_path = os.path.join(data_path, file)
+            if parse_method == 'cache':
+                parse = lambda: (action['_source'] for action in self.cce_actions(self.cce_table(pd.read_excel(file_path, header=None)), file, target_index))
+                cache, path = self.cached_source(file_path, 'cce', parse)
+                actions = ({'_index': target_index, '_source': loads_json(document), **({'_id': _id} if _id is not None else {})} for _id, document in cache.rows(path))
+            else:
+                actions = self.cce_actions(self.cce_table(pd.read_excel(file_path, header=None)), file, target_index)
+            successes += self.send_actions(actions, target_index, ingest_method=ingest_method, errors=errors, verbose=verbose, chunk_size=chunk_size)
+            if verbose == True:
+                print(f'{i} files processed, {successes} documents sent')
+        return f'{successes} documents sent to elasticsearch, {len(errors)} networking errors were detected during the transfer'
@@ -0,0 +1,934 @@
+import os, sys, io, json, zipfile, threading, hashlib, gzip, time
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from functools import partial
+import pytest
+import pandas as pd
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from elasticsearch import Elasticsearch
+import NVD_Loader
+import NVD_Benchmark
+from NVD_Loader import NVDLoader, AdaptiveBulkController, DeadLetterFile, run_coroutine
+from NVD_Benchmark import ElasticsearchStandIn, IngestBenchmark
+
+
+def feed_etag(body):
+    return '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    # Minimal stand-in for the NVD feed server, honouring single "bytes=N-" ranges and If-Range on a strong ETag
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as f:
+            body = f.read()
+        range_header = self.headers.get('Range')
+        if range_header and self.headers.get('If-Range', feed_etag(body)) != feed_etag(body):
+            range_header = None
+        if range_header:
+            offset = int(range_header.split('=')[1].rstrip('-'))
+            if offset >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(body)}')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {offset}-{len(body) - 1}/{len(body)}')
+            body = body[offset:]
+        else:
+            self.send_response(200)
+        self.send_header('ETag', feed_etag(body))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def write_cve_archive(path, year, count, last_modified=None):
+    last_modified = last_modified or f'{year}-01-01T00:00Z'
+    items = [{'cve': {'CVE_data_meta': {'ID': f'CVE-{year}-{i:04d}'}}, 'lastModifiedDate': last_modified if i % 2 else f'{year}-01-01T00:00Z'} for i in range(count)]
+    content = json.dumps({'CVE_data_type': 'CVE', 'CVE_Items': items})
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr(os.path.basename(path)[:-len('.zip')], content)
+    with open(path[:-len('.json.zip')] + '.meta', 'w') as f:
+        f.write(f'lastModifiedDate:{year}-06-01T03:00:00-04:00\r\nsize:{len(content)}\r\n'
+                f'zipSize:{os.path.getsize(path)}\r\nsha256:{hashlib.sha256(content.encode()).hexdigest().upper()}\r\n')
+
+
+@pytest.fixture
+def feed_server(tmp_path):
+    served = tmp_path / 'served'
+    served.mkdir()
+    for year in (2020, 2021, 2022):
+        write_cve_archive(str(served / f'nvdcve-1.1-{year}.json.zip'), year, 50)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(RangeRequestHandler, directory=str(served)))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}', served
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def es_server():
+    server, cluster, url = ElasticsearchStandIn.serve()
+    yield url, cluster
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def loader():
+    return NVDLoader()
+
+
+@pytest.fixture
+def local_loader(es_server):
+    base_url, _ = es_server
+    loader = NVDLoader()
+    loader.client = Elasticsearch(base_url, retry_on_status=())
+    return loader
+
+
+def cve_actions(year, count, target_index='nvd'):
+    for i in range(count):
+        yield {'_id': f'CVE-{year}-{i:04d}', '_index': target_index, '_source': {'cve': {'CVE_data_meta': {'ID': f'CVE-{year}-{i:04d}'}}}}
+
+
+def test_download_files_in_parallel(loader, feed_server, tmp_path):
+    base_url, served = feed_server
+    feeds = {f'CVE-{year}': f'{base_url}/nvdcve-1.1-{year}.json.zip' for year in (2020, 2021, 2022)}
+    output_path = str(tmp_path / 'downloads')
+    report = loader.download_files(feeds, output_path=output_path, max_workers=3, chunk_size=1024)
+    for key, target in feeds.items():
+        target_file = target.split('/')[-1]
+        with open(os.path.join(output_path, target_file), 'rb') as f, open(served / target_file, 'rb') as g:
+            assert f.read() == g.read()
+        assert report[key]['bytes'] == os.path.getsize(served / target_file)
+        assert report[key]['mb_per_second'] >= 0
+    assert not [x for x in os.listdir(output_path) if x.endswith('.part')]
+
+
+def test_download_files_resumes_partial_file(loader, feed_server, tmp_path):
+    base_url, served = feed_server
+    target_file = 'nvdcve-1.1-2021.json.zip'
+    output_path = tmp_path / 'downloads'
+    output_path.mkdir()
+    with open(served / target_file, 'rb') as f:
+        content = f.read()
+    with open(output_path / (target_file + '.part'), 'wb') as f:
+        f.write(content[:100])
+    with open(output_path / (target_file + '.part.validator'), 'w') as f:
+        f.write(feed_etag(content))
+    report = loader.download_files({'CVE-2021': f'{base_url}/{target_file}'}, output_path=str(output_path))
+    assert report['CVE-2021']['resumed_from'] == 100
+    assert report['CVE-2021']['bytes'] == len(content) - 100
+    with open(output_path / target_file, 'rb') as f:
+        assert f.read() == content
+    assert os.listdir(output_path) == [target_file]
+
+
+@pytest.mark.parametrize('validator', ['"stale"', None])
+def test_download_files_restarts_stale_partial_file(loader, feed_server, tmp_path, validator):
+    # a partial file from a feed that has since been regenerated, or one without a validator, is not appended to
+    base_url, served = feed_server
+    output_path = tmp_path / 'downloads'
+    output_path.mkdir()
+    target_file = 'nvdcve-1.1-2021.json.zip'
+    with open(served / target_file, 'rb') as f:
+        content = f.read()
+    for name, body in ((target_file + '.part', b'x' * len(content)), (target_file + '.part.validator', validator)):
+        if body is not None:
+            with open(output_path / name, 'wb' if isinstance(body, bytes) else 'w') as f:
+                f.write(body)
+    report = loader.download_files({'CVE-2021': f'{base_url}/{target_file}'}, output_path=str(output_path))
+    assert (report['CVE-2021']['resumed_from'], report['CVE-2021']['bytes']) == (0, len(content))
+    with open(output_path / target_file, 'rb') as f:
+        assert f.read() == content
+    assert os.listdir(output_path) == [target_file]
+
+
+def test_async_download_resumes_only_a_validated_partial_file(loader, feed_server, tmp_path):
+    base_url, served = feed_server
+    target_file = 'nvdcve-1.1-2021.json.zip'
+    with open(served / target_file, 'rb') as f:
+        content = f.read()
+
+    async def fetch():
+        async with NVD_Loader.aiohttp.ClientSession() as session:
+            return await loader.async_download_file(session, f'{base_url}/{target_file}', str(tmp_path))
+
+    for validator, resumed_from in ((feed_etag(content), 100), ('"stale"', 0)):
+        with open(tmp_path / (target_file + '.part'), 'wb') as f:
+            f.write(content[:100] if resumed_from else b'x' * 100)
+        with open(tmp_path / (target_file + '.part.validator'), 'w') as f:
+            f.write(validator)
+        stats = run_coroutine(fetch())
+        assert stats['resumed_from'] == resumed_from
+        with open(tmp_path / target_file, 'rb') as f:
+            assert f.read() == content
+
+
+@pytest.mark.parametrize('client', ['requests', 'aiohttp'])
+def test_downloads_handle_unsatisfiable_ranges(loader, feed_server, tmp_path, client):
+    # a 416 keeps a partial file that is already whole and restarts on one that outgrew the feed
+    base_url, served = feed_server
+    target_file = 'nvdcve-1.1-2021.json.zip'
+    output_path = tmp_path / 'downloads'
+    output_path.mkdir()
+    with open(served / target_file, 'rb') as f:
+        content = f.read()
+
+    async def fetch(session_class):
+        async with session_class() as session:
+            return await loader.async_download_file(session, f'{base_url}/{target_file}', str(output_path))
+
+    for partial, expected in ((content, (len(content), 0)), (content + b'x', (0, len(content)))):
+        with open(output_path / (target_file + '.part'), 'wb') as f:
+            f.write(partial)
+        with open(output_path / (target_file + '.part.validator'), 'w') as f:
+            f.write(feed_etag(content))
+        if client == 'aiohttp':
+            stats = run_coroutine(fetch(NVD_Loader.aiohttp.ClientSession))
+        else:
+            stats = loader.download_files({'CVE-2021': f'{base_url}/{target_file}'}, output_path=str(output_path))['CVE-2021']
+        assert (stats['resumed_from'], stats['bytes']) == expected
+        with open(output_path / target_file, 'rb') as f:
+            assert f.read() == content
+        assert os.listdir(output_path) == [target_file]
+
+
+def test_changed_feeds_skips_unchanged_years(loader, feed_server, tmp_path):
+    base_url, served = feed_server
+    feeds = {f'CVE-{year}': f'{base_url}/nvdcve-1.1-{year}.json.zip' for year in (2020, 2021, 2022)}
+    state_path = str(tmp_path / 'feed_state.json')
+    changed, metas = loader.changed_feeds(feeds, state_path=state_path)
+    assert sorted(changed) == ['CVE-2020', 'CVE-2021', 'CVE-2022']
+    assert metas['CVE-2021']['lastModifiedDate'] == '2021-06-01T03:00:00-04:00'
+    loader.record_feed_state(changed, metas, state_path=state_path)
+    write_cve_archive(str(served / 'nvdcve-1.1-2022.json.zip'), 2022, 60)
+    changed, metas = loader.changed_feeds(feeds, state_path=state_path)
+    assert list(changed) == ['CVE-2022']
+
+
+def test_refresh_feeds_records_only_clean_feeds(local_loader, es_server, feed_server, tmp_path):
+    _, cluster = es_server
+    base_url, served = feed_server
+    feeds = {f'CVE-{year}': f'{base_url}/nvdcve-1.1-{year}.json.zip' for year in (2020, 2021, 2022)}
+    state_path = str(tmp_path / 'feed_state.json')
+    data_path = tmp_path / 'data'
+    data_path.mkdir()
+    # the first item of 2020 is rejected, so only 2021 and 2022 are recorded
+    cluster.reject_statuses = [400]
+    output = local_loader.refresh_feeds(feeds, data_path=str(data_path), state_path=state_path, verbose=False)
+    assert output == '3 of 3 feeds changed, 149 documents sent to elasticsearch, 1 feeds had errors and will be retried'
+    assert sorted(local_loader.load_feed_state(state_path)) == ['nvdcve-1.1-2021.json.zip', 'nvdcve-1.1-2022.json.zip']
+    assert os.listdir(data_path) == []
+    output = local_loader.refresh_feeds(feeds, data_path=str(data_path), state_path=state_path, verbose=False)
+    assert output == '1 of 3 feeds changed, 50 documents sent to elasticsearch, 0 feeds had errors and will be retried'
+    assert len(cluster.documents['nvd']) == 150
+    assert local_loader.refresh_feeds(feeds, data_path=str(data_path), state_path=state_path, verbose=False) == '0 of 3 feeds changed, nothing sent to elasticsearch'
+
+
+def test_adaptive_bulk_grows_batches_on_fast_responses(local_loader, es_server):
+    _, cluster = es_server
+    controller = AdaptiveBulkController(chunk_docs=50, chunk_bytes=512 * 1024, min_docs=50, max_docs=400, 
+                                        min_bytes=256 * 1024, max_bytes=1024 * 1024, concurrency=1, max_concurrency=4)
+    errors = []
+    successes = local_loader.adaptive_bulk(cve_actions(2021, 6000), controller=controller, errors=errors)
+    assert successes == 6000 and not errors
+    assert len(cluster.documents['nvd']) == 6000
+    assert controller.chunk_docs == 400
+    assert controller.concurrency > 1
+
+
+def test_adaptive_bulk_grows_chunks_cut_at_the_byte_limit(local_loader, es_server):
+    # 2 KB documents fill a 512 KB request long before 1000 documents
+    controller = AdaptiveBulkController(chunk_docs=1000, chunk_bytes=512 * 1024, min_bytes=256 * 1024, max_docs=2000, max_bytes=1024 * 1024, 
+                                        concurrency=1, max_concurrency=4)
+    actions = ({'_id': f'CVE-2021-{i:04d}', '_index': 'nvd', '_source': {'text': 'x' * 2048}} for i in range(20000))
+    assert local_loader.adaptive_bulk(actions, controller=controller) == 20000
+    assert controller.history[0]['documents'] < 1000 and controller.history[0]['bytes'] > 0.9 * 512 * 1024
+    assert controller.chunk_bytes == 1024 * 1024
+    assert controller.concurrency > 1
+
+
+def test_adaptive_bulk_backs_off_on_rejections(local_loader, es_server):
+    _, cluster = es_server
+    cluster.reject_statuses = [429] * 10
+    controller = AdaptiveBulkController(chunk_docs=200, concurrency=1)
+    errors = []
+    successes = local_loader.adaptive_bulk(cve_actions(2021, 600), controller=controller, errors=errors)
+    assert successes == 590 and len(errors) == 10
+    assert controller.history[0]['rejected'] and controller.history[0]['chunk_docs'] == 100
+    controller = AdaptiveBulkController(concurrency=4)
+    controller.record(0.2, 150, 500, True)
+    assert controller.concurrency == 3
+
+
+@pytest.mark.parametrize('ingest_method', ['bulk', 'streaming_bulk', 'parallel_bulk', 'adaptive_bulk'])
+def test_send_actions_retries_and_dead_letters(local_loader, es_server, tmp_path, ingest_method):
+    _, cluster = es_server
+    cluster.reject_statuses = [429] * 5 + [400] * 2
+    dead_letter = DeadLetterFile(str(tmp_path / 'dead_letters.ndjson.gz'))
+    errors = []
+    successes = local_loader.send_actions(cve_actions(2021, 100), 'nvd', ingest_method=ingest_method, errors=errors, verbose=False, 
+                                          max_retries=3, dead_letter=dead_letter)
+    dead_letter.close()
+    assert successes == 98
+    assert [next(iter(info.values()))['status'] for info in errors] == [400, 400]
+    assert dead_letter.count == 2
+    with gzip.open(dead_letter.path, 'rb') as f:
+        assert len(f.read().splitlines()) == 4
+    report = local_loader.replay_dead_letters(dead_letter.path, verbose=False)
+    assert report['successes'] == 2 and not report['errors']
+    assert len(cluster.documents['nvd']) == 100
+
+
+def test_bulk_load_restores_settings(local_loader, es_server, feed_server):
+    _, cluster = es_server
+    _, served = feed_server
+    local_loader.client.indices.create(index='nvd', settings={'index.refresh_interval': '30s'})
+    output = local_loader.ingest_bulk_json_dataset(['nvdcve-1.1-2020.json.zip'], 'nvd', data_path=str(served), verbose=False, 
+                                                   ingest_method='streaming_bulk', bulk_load=True, force_merge=True)
+    assert output == '50 documents sent to elasticsearch'
+    assert cluster.settings['nvd'] == {'index.refresh_interval': '30s'}
+    assert ('POST', '/nvd/_refresh') in cluster.calls and ('POST', '/nvd/_forcemerge') in cluster.calls
+
+
+def test_bulk_load_restores_settings_after_a_failed_load(local_loader, es_server, feed_server):
+    _, cluster = es_server
+    _, served = feed_server
+    with pytest.raises(FileNotFoundError):
+        local_loader.ingest_bulk_json_dataset(['nvdcve-1.1-1999.json.zip'], 'nvd', data_path=str(served), verbose=False, 
+                                              ingest_method='streaming_bulk', bulk_load=True, force_merge=True)
+    assert cluster.settings['nvd'] == {}
+    assert ('POST', '/nvd/_refresh') in cluster.calls and ('POST', '/nvd/_forcemerge') not in cluster.calls
+
+
+def test_bulk_load_restores_replicas_of_a_new_index(local_loader, es_server, feed_server, monkeypatch):
+    _, cluster = es_server
+    _, served = feed_server
+    create = local_loader.client.indices.create
+    # the stand-in applies no defaults, so creation is given the replica count a cluster default or template would
+    monkeypatch.setattr(local_loader.client.indices, 'create', lambda **kwargs: create(**dict(kwargs, settings={'index.number_of_replicas': '1'})))
+    health = []
+    monkeypatch.setattr(local_loader.client.cluster, 'health', lambda **kwargs: health.append(kwargs))
+    local_loader.ingest_bulk_json_dataset(['nvdcve-1.1-2020.json.zip'], 'nvd', data_path=str(served), verbose=False, ingest_method='streaming_bulk', bulk_load=True)
+    assert cluster.settings['nvd'] == {'index.number_of_replicas': '1'}
+    assert ('PUT', '/nvd/_settings') in cluster.calls
+    assert health[0]['wait_for_status'] == 'yellow'
+
+
+def test_ndjson_bulk_ingest(local_loader, es_server, feed_server, tmp_path):
+    _, cluster = es_server
+    _, served = feed_server
+    cluster.reject_statuses = [201] * 10 + [400]
+    output = local_loader.ingest_bulk_json_dataset(['nvdcve-1.1-2020.json.zip', 'nvdcve-1.1-2021.json.zip'], 'nvd', data_path=str(served), verbose=False, 
+                                                   ingest_method='ndjson_bulk', chunk_size=50, dead_letter_path=str(tmp_path / 'dead_letters.ndjson.gz'))
+    assert output == '99 documents sent to elasticsearch, 1 networking errors were detected during the transfer'
+    assert len(cluster.documents['nvd']) == 99
+    assert 'CVE-2020-0010' not in cluster.documents['nvd']
+    with gzip.open(tmp_path / 'dead_letters.ndjson.gz', 'rb') as f:
+        header, source = [json.loads(line) for line in f.read().splitlines()]
+    assert header == {'index': {'_index': 'nvd', '_id': 'CVE-2020-0010'}}
+    assert source['cve']['CVE_data_meta']['ID'] == 'CVE-2020-0010'
+
+
+def test_benchmark_serialization(local_loader, feed_server):
+    _, served = feed_server
+    report = local_loader.benchmark_serialization('nvdcve-1.1-2022.json.zip', data_path=str(served), repetitions=1)
+    assert report['documents'] == 50
+    assert report['ndjson']['docs_per_second'] > 0 and report['action_dicts']['docs_per_second'] > 0
+
+
+@pytest.mark.parametrize('ingest_method', ['streaming_bulk', 'parallel_bulk', 'adaptive_bulk'])
+def test_ingest_changed_cves_sends_only_changes(local_loader, es_server, feed_server, tmp_path, ingest_method):
+    _, cluster = es_server
+    _, served = feed_server
+    # two CVEs are already indexed by an earlier historic load the state store never saw
+    cluster.documents['nvd'] = {'CVE-2021-0001': {}, 'CVE-2021-0002': {}}
+    state_path = str(tmp_path / 'cve_state.sqlite')
+    options = {'data_path': str(served), 'ingest_method': ingest_method, 'verbose': False, 'batch_size': 20}
+    report = local_loader.ingest_changed_cves('nvdcve-1.1-2021.json.zip', 'nvd', state_path, **options)
+    assert (report['new'], report['changed'], report['unchanged'], report['successes']) == (50, 0, 0, 50)
+    assert cluster.documents['nvd']['CVE-2021-0001']['cve']['CVE_data_meta']['ID'] == 'CVE-2021-0001'
+    report = local_loader.ingest_changed_cves('nvdcve-1.1-2021.json.zip', 'nvd', state_path, **options)
+    assert (report['new'], report['changed'], report['unchanged'], report['successes']) == (0, 0, 50, 0)
+    write_cve_archive(str(served / 'nvdcve-1.1-2021.json.zip'), 2021, 52, last_modified='2021-03-01T00:00Z')
+    report = local_loader.ingest_changed_cves('nvdcve-1.1-2021.json.zip', 'nvd', state_path, **options)
+    assert (report['new'], report['changed'], report['unchanged'], report['successes']) == (2, 25, 25, 27)
+
+
+def test_ingest_changed_cves_resends_cves_lost_with_the_connection(es_server, feed_server, tmp_path):
+    base_url, cluster = es_server
+    _, served = feed_server
+    loader = NVDLoader()
+    loader.client = Elasticsearch(base_url, retry_on_status=(), max_retries=0)
+    # the first bulk request never gets an answer and nothing retries it
+    cluster.drop_bulk_requests = 1
+    state_path = str(tmp_path / 'cve_state.sqlite')
+    options = {'data_path': str(served), 'ingest_method': 'adaptive_bulk', 'verbose': False, 'batch_size': 20, 'max_retries': 0}
+    report = loader.ingest_changed_cves('nvdcve-1.1-2021.json.zip', 'nvd', state_path, **options)
+    lost = 50 - len(cluster.documents['nvd'])
+    assert lost > 0 and report['successes'] == 50 - lost
+    report = loader.ingest_changed_cves('nvdcve-1.1-2021.json.zip', 'nvd', state_path, **options)
+    assert (report['new'], report['unchanged'], report['successes']) == (lost, 50 - lost, lost)
+    assert len(cluster.documents['nvd']) == 50
+
+
+def test_update_cve_data_with_state_store_and_parallel_bulk(local_loader, es_server, feed_server, tmp_path, monkeypatch):
+    _, cluster = es_server
+    url, served = feed_server
+    write_cve_archive(str(served / 'nvdcve-1.1-modified.json.zip'), 2021, 30)
+    # update_cve_data downloads to the default ./demo/data
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'demo').mkdir()
+    state_path = str(tmp_path / 'cve_state.sqlite')
+    for from_archive, expected in ((True, '30 new, 0 changed and 0 unchanged CVEs'), (False, '0 new, 0 changed and 30 unchanged CVEs')):
+        output = local_loader.update_cve_data({'CVE-Modified': f'{url}/nvdcve-1.1-modified.json.zip'}, data_path=os.path.join(os.curdir, 'demo', 'data'), 
+                                              update_method='parallel_bulk', from_archive=from_archive, state_path=state_path)
+        assert output.startswith(expected)
+    assert len(cluster.documents['nvd']) == 30
+
+
+def test_ingest_benchmark_reports_and_compares_to_baseline(local_loader, es_server, feed_server, tmp_path):
+    _, cluster = es_server
+    _, served = feed_server
+    files = ['nvdcve-1.1-2020.json.zip', 'nvdcve-1.1-2021.json.zip']
+    benchmark = IngestBenchmark(local_loader, files, str(served), warmup=0, repetitions=1, verbose=False)
+    results = benchmark.run(['bulk', 'ndjson_bulk'])
+    assert [result['case'] for result in results] == ['bulk', 'ndjson_bulk']
+    for result in results:
+        assert result['documents'] == 100
+        assert result['docs_per_second'] > 0 and result['mb_per_second'] > 0
+        assert result['bulk_requests'] >= 1 and result['p50_latency_ms'] <= result['p99_latency_ms']
+        assert result['peak_rss_mb'] > 0
+    assert 'nvd_benchmark' not in cluster.indices
+    benchmark.write_json(results, str(tmp_path / 'results.json'))
+    benchmark.write_csv(results, str(tmp_path / 'results.csv'))
+    assert (tmp_path / 'results.csv').read_text().splitlines()[0].startswith('case,documents,repetitions,seconds,docs_per_second')
+    assert benchmark.compare_to_baseline(results, str(tmp_path / 'results.json')) == []
+    slower = [dict(result, docs_per_second=result['docs_per_second'] / 2) for result in results]
+    regressions = benchmark.compare_to_baseline(slower, str(tmp_path / 'results.json'))
+    assert {(regression['case'], regression['metric']) for regression in regressions} >= {('bulk', 'docs_per_second'), ('ndjson_bulk', 'docs_per_second')}
+
+
+def test_ingest_benchmark_times_async_and_worker_requests(es_server, feed_server):
+    url, _ = es_server
+    _, served = feed_server
+    benchmark = IngestBenchmark(NVDLoader(elastic_url=url), ['nvdcve-1.1-2020.json.zip', 'nvdcve-1.1-2021.json.zip'], str(served), warmup=0, repetitions=1, verbose=False)
+    for result in benchmark.run(['async', 'process_pool']):
+        assert result['bulk_requests'] >= 1, result['case']
+        assert result['p50_latency_ms'] <= result['p95_latency_ms'] <= result['p99_latency_ms']
+
+
+def test_benchmark_main_runs_against_a_stand_in_process(feed_server, tmp_path):
+    _, served = feed_server
+    output_json = str(tmp_path / 'results.json')
+    status = NVD_Benchmark.main(['--data-path', str(served), '--files', 'nvdcve-1.1-2020.json.zip', '--cases', 'bulk', 'async', '--warmup', '0', '--repetitions', '1',
+                                 '--output-json', output_json, '--output-csv', str(tmp_path / 'results.csv')])
+    assert status == 0
+    with open(output_json) as f:
+        results = json.load(f)
+    assert [(result['case'], result['documents']) for result in results] == [('bulk', 50), ('async', 50)]
+    assert all(result['bulk_requests'] >= 1 and result['p95_latency_ms'] is not None for result in results)
+    # a baseline with faster requests flags the async case too
+    with open(str(tmp_path / 'baseline.json'), 'w') as f:
+        json.dump([dict(result, p95_latency_ms=result['p95_latency_ms'] / 10) for result in results], f)
+    assert NVD_Benchmark.main(['--data-path', str(served), '--files', 'nvdcve-1.1-2020.json.zip', '--cases', 'async', '--warmup', '0', '--repetitions', '1',
+                               '--output-json', output_json, '--output-csv', str(tmp_path / 'results.csv'), '--baseline', str(tmp_path / 'baseline.json')]) == 1
+
+
+def test_document_total_for_directory_uses_manifest(loader, feed_server, tmp_path, monkeypatch):
+    _, served = feed_server
+    write_cve_archive(str(served / 'nvdcve-1.1-modified.json.zip'), 2020, 10)
+    files = ['nvdcve-1.1-2020.json.zip', 'nvdcve-1.1-2021.json.zip', 'nvdcve-1.1-2022.json.zip', 'nvdcve-1.1-modified.json.zip', 'nvdcve-1.1-2020.json.zip.meta']
+    manifest_path = str(tmp_path / 'manifest.json')
+    totals = loader.document_total_for_directory(files, data_path=str(served), verbose=False, manifest_path=manifest_path)
+    assert totals == {'total_read_documents': 160, 'unique_cve_ids': 150}
+    counted = []
+    original = NVD_Loader.file_document_stats
+    monkeypatch.setattr(NVD_Loader, 'file_document_stats', lambda file_path: counted.append(os.path.basename(file_path)) or original(file_path))
+    assert loader.document_total_for_directory(files, data_path=str(served), verbose=False, manifest_path=manifest_path, processes=1) == totals
+    assert counted == []
+    write_cve_archive(str(served / 'nvdcve-1.1-2022.json.zip'), 2022, 60)
+    totals = loader.document_total_for_directory(files, data_path=str(served), verbose=False, manifest_path=manifest_path, processes=1)
+    assert totals == {'total_read_documents': 170, 'unique_cve_ids': 160}
+    assert counted == ['nvdcve-1.1-2022.json.zip']
+
+
+def test_async_ingest_dead_letters_rejected_items(es_server, feed_server, tmp_path):
+    base_url, cluster = es_server
+    _, served = feed_server
+    loader = NVDLoader(elastic_url=base_url)
+    cluster.reject_statuses = [201] * 10 + [400]
+    output = loader.ingest_bulk_json_dataset(['nvdcve-1.1-2020.json.zip', 'nvdcve-1.1-2021.json.zip', 'nvdcve-1.1-2022.json.zip'], 'nvd', data_path=str(served), 
+                                             verbose=False, ingest_method='async', concurrency=3, chunk_size=20, dead_letter_path=str(tmp_path / 'dead_letters.ndjson.gz'))
+    assert output == '149 documents sent to elasticsearch, 1 networking errors were detected during the transfer'
+    assert len(cluster.documents['nvd']) == 149
+    with gzip.open(tmp_path / 'dead_letters.ndjson.gz', 'rb') as f:
+        header, source = [json.loads(line) for line in f.read().splitlines()]
+    assert header['index']['_id'] == source['cve']['CVE_data_meta']['ID']
+
+
+def test_async_ingest_downloads_and_sends(es_server, feed_server, tmp_path):
+    base_url, cluster = es_server
+    url, _ = feed_server
+    loader = NVDLoader(elastic_url=base_url)
+    dictionary = {f'CVE-{year}': f'{url}/nvdcve-1.1-{year}.json.zip' for year in (2020, 2021)}
+    report = run_coroutine(loader.async_ingest_json_dataset(None, 'nvd', data_path=str(tmp_path / 'downloads'), verbose=False, dictionary=dictionary))
+    assert report['files'] == {'nvdcve-1.1-2020.json.zip': 50, 'nvdcve-1.1-2021.json.zip': 50}
+    assert (report['documents'], report['successes'], report['errors']) == (100, 100, [])
+    assert sorted(os.listdir(tmp_path / 'downloads')) == ['nvdcve-1.1-2020.json.zip', 'nvdcve-1.1-2021.json.zip']
+    assert len(cluster.documents['nvd']) == 100
+
+
+def test_create_cpe_match_index_is_idempotent(local_loader, es_server, feed_server, tmp_path):
+    _, cluster = es_server
+    url, served = feed_server
+    matches = [{'cpe23Uri': f'cpe:2.3:a:vendor:product_{i % 40}:*:*:*:*:*:*:*:*', 'versionEndExcluding': f'{i}.0', 'cpe_name': []} for i in range(120)]
+    with zipfile.ZipFile(served / 'nvdcpematch-1.0.json.zip', 'w') as archive:
+        archive.writestr('nvdcpematch-1.0.json', json.dumps({'matches': matches}))
+    local_loader.cpe_match_feed = {'CPE-Match': f'{url}/nvdcpematch-1.0.json.zip'}
+    data_path = tmp_path / 'data'
+    data_path.mkdir()
+    for _ in range(2):
+        output = local_loader.create_cpe_match_index('cpe_match', data_path=str(data_path), from_archive=True, chunk_size=50)
+        assert output == '120 documents sent to elasticsearch, 0 networking errors were detected during the transfer'
+    assert len(cluster.documents['cpe_match']) == 120
+    assert local_loader.cpe_match_id(matches[0]) in cluster.documents['cpe_match']
+    assert local_loader.cpe_match_id(matches[0]) != local_loader.cpe_match_id(matches[40])
+    assert cluster.documents['cpe_match'][local_loader.cpe_match_id(matches[41])]['cpe'] == {
+        'part': 'a', 'vendor': 'vendor', 'product': 'product_1', 'version': '*', 'update': '*', 'versionEndExcluding': 'D241.B'}
+    assert os.listdir(data_path) == []
+
+
+def write_cpe_dictionary(path, count):
+    items = ''.join(f'''
+  <cpe-item name="cpe:/a:vendor:product:{i}">
+    <title xml:lang="en-US">Vendor Product {i}</title>
+    <references>
+      <reference href="https://example.com/{i}">Advisory</reference>
+      <reference href="https://example.com/{i}/changelog">Change Log</reference>
+    </references>
+    <cpe-23:cpe23-item name="cpe:2.3:a:vendor:product:{i}:*:*:*:*:*:*:*"/>
+  </cpe-item>''' for i in range(count))
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('official-cpe-dictionary_v2.3.xml', f'''<?xml version='1.0' encoding='UTF-8'?>
+<cpe-list xmlns:config="http://scap.nist.gov/schema/configuration/0.1" xmlns="http://cpe.mitre.org/dictionary/2.0" xmlns:cpe-23="http://scap.nist.gov/schema/cpe-extension/2.3">
+  <generator>
+    <product_name>National Vulnerability Database (NVD)</product_name>
+  </generator>{items}
+</cpe-list>''')
+
+
+@pytest.mark.parametrize('ingest_method', ['singleton', 'bulk', 'parallel_bulk', 'streaming_bulk'])
+def test_load_cpe_dictionary_streams_items(local_loader, es_server, tmp_path, ingest_method):
+    _, cluster = es_server
+    target_file = str(tmp_path / 'official-cpe-dictionary_v2.3.xml.zip')
+    write_cpe_dictionary(target_file, 30)
+    assert list(local_loader.read_cpe_items(target_file)) == list(local_loader.read_cpe_items(target_file, parse_method='load'))
+    local_loader.load_cpe_dictionary(target_file, ingest_method=ingest_method)
+    assert len(cluster.documents['cpe_dictionary']) == 30
+    document = cluster.documents['cpe_dictionary']['cpe:/a:vendor:product:7']
+    assert document['title'] == {'@xml:lang': 'en-US', '#text': 'Vendor Product 7'}
+    assert document['cpe-23:cpe23-item'] == {'@name': 'cpe:2.3:a:vendor:product:7:*:*:*:*:*:*:*'}
+    assert document['cpe'] == {'part': 'a', 'vendor': 'vendor', 'product': 'product', 'version': '7', 'update': '*', 'version_key': 'D17.B'}
+    assert len(document['references']['reference']) == 2
+
+
+def test_cce_table_and_actions(local_loader, es_server):
+    _, cluster = es_server
+    nan = float('nan')
+    raw = pd.DataFrame([
+        ['CCE List', 'Last Modified: 2013-01-01', nan, nan],
+        ['Platform', 'Version 5.20130214', nan, nan],
+        ['CCE ID v5', 'CCE ID', 'Description', 'Parameter'],
+        ['CCE-1234-5', nan, 'Password length', 8],
+        [nan, 'CCE-6789-0', 'Audit policy', nan],
+        [nan, nan, nan, nan],
+        ['Notes', nan, 'not a definition', nan]
+    ])
+    table = local_loader.cce_table(raw)
+    assert list(table.columns) == ['CCE ID v5', 'CCE ID', 'Description', 'Parameter'] and len(table) == 2
+    actions = list(local_loader.cce_actions(table, 'cce-windows.xls'))
+    assert [action['_id'] for action in actions] == ['CCE-1234-5', 'CCE-6789-0']
+    assert actions[0]['_source'] == {'CCE ID v5': 'CCE-1234-5', 'Description': 'Password length', 'Parameter': 8, 'data_file': 'cce-windows.xls'}
+    assert actions[1]['_source'] == {'CCE ID': 'CCE-6789-0', 'Description': 'Audit policy', 'data_file': 'cce-windows.xls'}
+    assert local_loader.send_actions(iter(actions), 'cce', ingest_method='streaming_bulk', verbose=False) == 2
+    assert set(cluster.documents['cce']) == {'CCE-1234-5', 'CCE-6789-0'}
+
+
+def test_columnar_cache_is_keyed_on_checksum(local_loader, es_server, feed_server, tmp_path):
+    _, cluster = es_server
+    _, served = feed_server
+    local_loader.cache_dir = str(tmp_path / 'cache')
+    file_path = str(served / 'nvdcve-1.1-2020.json.zip')
+    assert list(local_loader.read_cve_items(file_path, parse_method='cache')) == list(local_loader.read_cve_items(file_path))
+    cached = os.listdir(tmp_path / 'cache')
+    assert len(cached) == 1 and cached[0].startswith('nvdcve-1.1-2020.json.zip.CVE_Items.')
+    frame = local_loader.cached_frame(file_path)
+    assert list(frame.columns) == ['id', 'published_date', 'last_modified_date'] and frame['id'][3] == 'CVE-2020-0003'
+    output = local_loader.ingest_bulk_json_dataset(['nvdcve-1.1-2020.json.zip'], 'nvd', data_path=str(served), verbose=False, ingest_method='ndjson_bulk', parse_method='cache')
+    assert output == '50 documents sent to elasticsearch, 0 networking errors were detected during the transfer'
+    assert cluster.documents['nvd']['CVE-2020-0003'] == next(item for item in local_loader.read_cve_items(file_path) if item['cve']['CVE_data_meta']['ID'] == 'CVE-2020-0003')
+    assert os.listdir(tmp_path / 'cache') == cached
+    write_cve_archive(file_path, 2020, 60)
+    assert len(list(local_loader.read_cve_items(file_path, parse_method='cache'))) == 60
+    assert len(os.listdir(tmp_path / 'cache')) == 1 and os.listdir(tmp_path / 'cache') != cached
+
+
+def test_columnar_cache_is_rebuilt_for_a_new_cache_version(local_loader, feed_server, tmp_path, monkeypatch):
+    _, served = feed_server
+    local_loader.cache_dir = str(tmp_path / 'cache')
+    file_path = str(served / 'nvdcve-1.1-2020.json.zip')
+    # a cache written before the documents gained a field
+    monkeypatch.setattr(local_loader, 'read_cve_items', lambda path, parse_method='stream': NVDLoader.read_cve_items(local_loader, path, parse_method) if parse_method == 'cache' 
+                        else ({'cve': item['cve']} for item in NVDLoader.read_cve_items(local_loader, path)))
+    assert all('lastModifiedDate' not in item for item in local_loader.read_cve_items(file_path, parse_method='cache'))
+    monkeypatch.undo()
+    assert all('lastModifiedDate' not in item for item in local_loader.read_cve_items(file_path, parse_method='cache'))
+    monkeypatch.setattr(NVD_Loader.ColumnarCache, 'version', NVD_Loader.ColumnarCache.version + 1)
+    assert list(local_loader.read_cve_items(file_path, parse_method='cache')) == list(local_loader.read_cve_items(file_path))
+    cached = os.listdir(tmp_path / 'cache')
+    assert len(cached) == 1 and f'.CVE_Items.v{NVD_Loader.ColumnarCache.version}-' in cached[0]
+
+
+def test_resume_continues_from_last_acknowledged_item(local_loader, es_server, feed_server, tmp_path, monkeypatch):
+    _, cluster = es_server
+    _, served = feed_server
+    files = ['nvdcve-1.1-2020.json.zip', 'nvdcve-1.1-2021.json.zip']
+    checkpoint_path = str(tmp_path / 'checkpoint.sqlite')
+    send_actions = local_loader.send_actions
+    segments = []
+
+    def crash_on_fourth_segment(actions, *args, **kwargs):
+        segments.append(1)
+        if len(segments) == 4:
+            raise ConnectionError('node restarted')
+        return send_actions(actions, *args, **kwargs)
+
+    monkeypatch.setattr(local_loader, 'send_actions', crash_on_fourth_segment)
+    with pytest.raises(ConnectionError):
+        local_loader.ingest_bulk_json_dataset(files, 'nvd', data_path=str(served), verbose=False, ingest_method='streaming_bulk', 
+                                              checkpoint_path=checkpoint_path, checkpoint_every=20)
+    # 2020 is complete after three segments, 2021 crashed before its first segment was acknowledged
+    assert len(cluster.documents['nvd']) == 50
+    monkeypatch.setattr(local_loader, 'send_actions', send_actions)
+    cluster.documents['nvd'].pop('CVE-2020-0049')
+    output = local_loader.ingest_bulk_json_dataset(files, 'nvd', data_path=str(served), verbose=False, ingest_method='streaming_bulk', 
+                                                   resume=True, checkpoint_path=checkpoint_path, checkpoint_every=20)
+    assert output == '50 documents sent to elasticsearch'
+    assert len(cluster.documents['nvd']) == 99
+    result = local_loader.ingest_file(files[1], 'nvd', data_path=str(served), verbose=False, ingest_method='ndjson_bulk', 
+                                      checkpoint=NVD_Loader.IngestCheckpoint(checkpoint_path))
+    assert (result['documents'], result['resumed_from']) == (0, 50)
+    write_cve_archive(str(served / files[1]), 2021, 55)
+    result = local_loader.ingest_file(files[1], 'nvd', data_path=str(served), verbose=False, ingest_method='ndjson_bulk', 
+                                      checkpoint=NVD_Loader.IngestCheckpoint(checkpoint_path))
+    assert (result['documents'], result['resumed_from']) == (55, 0)
+    output = local_loader.ingest_bulk_json_dataset(files, 'nvd', data_path=str(served), verbose=False, ingest_method='streaming_bulk', checkpoint_path=checkpoint_path)
+    assert output == '105 documents sent to elasticsearch'
+    assert len(cluster.documents['nvd']) == 105
+
+
+def test_resume_sends_segments_with_rejected_items_again(local_loader, es_server, feed_server, tmp_path):
+    _, cluster = es_server
+    _, served = feed_server
+    files = ['nvdcve-1.1-2020.json.zip']
+    checkpoint_path = str(tmp_path / 'checkpoint.sqlite')
+    # five items of the second segment are rejected and nothing retries or dead-letters them
+    cluster.reject_statuses.extend([201] * 25 + [429] * 5)
+    local_loader.ingest_bulk_json_dataset(files, 'nvd', data_path=str(served), verbose=False, ingest_method='parallel_bulk', 
+                                          checkpoint_path=checkpoint_path, checkpoint_every=20)
+    assert len(cluster.documents['nvd']) == 45
+    checkpoint = NVD_Loader.IngestCheckpoint(checkpoint_path)
+    assert checkpoint.offset('nvd', os.path.abspath(str(served / files[0])), NVD_Loader.file_sha256(str(served / files[0]))) == (20, False)
+    output = local_loader.ingest_bulk_json_dataset(files, 'nvd', data_path=str(served), verbose=False, ingest_method='parallel_bulk', 
+                                                   resume=True, checkpoint_path=checkpoint_path, checkpoint_every=20)
+    assert output.startswith('30 documents sent to elasticsearch')
+    assert len(cluster.documents['nvd']) == 50
+    output = local_loader.ingest_bulk_json_dataset(files, 'nvd', data_path=str(served), verbose=False, ingest_method='parallel_bulk', 
+                                                   resume=True, checkpoint_path=checkpoint_path, checkpoint_every=20)
+    assert output.startswith('0 documents sent to elasticsearch')
+
+
+def test_ingest_metrics_and_exporters(local_loader, es_server, feed_server, tmp_path):
+    _, cluster = es_server
+    _, served = feed_server
+    events = []
+    local_loader.metrics.add_hook(lambda kind, name, value, labels: events.append((kind, name)))
+    local_loader.metrics.textfile_path = str(tmp_path / 'nvd.prom')
+    cluster.reject_statuses = [429] * 3 + [201] * 10 + [400]
+    local_loader.ingest_bulk_json_dataset(['nvdcve-1.1-2020.json.zip', 'nvdcve-1.1-2021.json.zip'], 'nvd', data_path=str(served), verbose=False, 
+                                          ingest_method='ndjson_bulk', chunk_size=25, max_retries=2, dead_letter_path=str(tmp_path / 'dead_letters.ndjson.gz'))
+    metrics = local_loader.metrics
+    assert metrics.value('nvd_documents_total') == 100
+    assert metrics.value('nvd_documents_sent_total') == 99
+    assert metrics.value('nvd_documents_failed_total', status=429) == 3 and metrics.value('nvd_documents_failed_total', status=400) == 1
+    assert metrics.value('nvd_retries_total') == 3 and metrics.value('nvd_dead_letters_total') == 1
+    assert metrics.value('nvd_stage_seconds', stage='bulk')['count'] == 5
+    assert metrics.value('nvd_stage_seconds_total', stage='parse') > 0 and metrics.value('nvd_stage_seconds_total', stage='serialize') > 0
+    assert metrics.value('nvd_files_completed') == 2
+    assert ('histogram', 'nvd_stage_seconds') in events and ('counter', 'nvd_documents_sent_total') in events
+    text = (tmp_path / 'nvd.prom').read_text()
+    assert '# TYPE nvd_documents_sent_total counter\nnvd_documents_sent_total 99\n' in text
+    assert 'nvd_stage_seconds_bucket{stage="bulk",le="+Inf"} 5\n' in text
+    server = metrics.serve(port=0, host='127.0.0.1')
+    try:
+        response = requests.get(f'http://127.0.0.1:{server.server_address[1]}/metrics', timeout=10)
+        assert response.status_code == 200 and 'nvd_documents_total 100' in response.text
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_add_cvss_fields_splits_vectors(loader):
+    item = {'cve': {'CVE_data_meta': {'ID': 'CVE-2021-44228'}}, 'impact': {
+        'baseMetricV3': {'cvssV3': {'version': '3.1', 'vectorString': 'CVSS:3.1/AV:N/AC:L/PR:N/UI:N/S:C/C:H/I:H/A:H', 'baseScore': 10.0}},
+        'baseMetricV2': {'cvssV2': {'version': '2.0', 'vectorString': 'AV:N/AC:M/Au:N/C:C/I:C/A:C', 'baseScore': 9.3}, 'obtainAllPrivilege': False}}}
+    cvss = loader.add_cvss_fields(item)['cvss']
+    assert cvss['v3'] == {'version': '3.1', 'AV': 'N', 'AC': 'L', 'PR': 'N', 'UI': 'N', 'S': 'C', 'C': 'H', 'I': 'H', 'A': 'H', 'severity_bucket': 'critical'}
+    assert cvss['v2'] == {'AV': 'N', 'AC': 'M', 'Au': 'N', 'C': 'C', 'I': 'C', 'A': 'C', 'severity_bucket': 'high'}
+    assert cvss['severity_bucket'] == 'critical'
+    del item['impact']['baseMetricV3']
+    assert loader.add_cvss_fields(item)['cvss']['severity_bucket'] == 'high'
+    assert loader.add_cvss_fields({'cve': {}, 'impact': {}})['cvss'] == {}
+    assert [NVD_Loader.cvss_severity_bucket(score, 3) for score in (0.0, 3.9, 4.0, 7.0, 9.0)] == ['none', 'low', 'medium', 'high', 'critical']
+    assert set(loader.index_mappings['nvd']['properties']['cvss']['properties']['v3']['properties']) >= {'AV', 'PR', 'UI', 'I', 'severity_bucket'}
+
+
+def write_cve_configurations(path, year, configurations):
+    items = [{'cve': {'CVE_data_meta': {'ID': cve_id}}, 'configurations': {'nodes': nodes}, 'lastModifiedDate': f'{year}-01-01T00:00Z'} 
+             for cve_id, nodes in configurations.items()]
+    with open(path, 'w') as f:
+        json.dump({'CVE_data_type': 'CVE', 'CVE_Items': items}, f)
+
+
+def test_cpe_to_cve_index_built_during_ingest(es_server, tmp_path):
+    url, cluster = es_server
+    log4j = 'cpe:2.3:a:apache:log4j:*:*:*:*:*:*:*:*'
+    write_cve_configurations(str(tmp_path / 'nvdcve-1.1-2021.json'), 2021, {
+        'CVE-2021-44228': [{'operator': 'OR', 'cpe_match': [{'vulnerable': True, 'cpe23Uri': log4j, 'versionStartIncluding': '2.0.1', 'versionEndExcluding': '2.3.1'}]}],
+        'CVE-2021-45046': [{'operator': 'AND', 'children': [
+            {'operator': 'OR', 'cpe_match': [{'vulnerable': True, 'cpe23Uri': log4j, 'versionEndExcluding': '2.12.2'}]},
+            {'operator': 'OR', 'cpe_match': [{'vulnerable': False, 'cpe23Uri': 'cpe:2.3:o:linux:linux_kernel:-:*:*:*:*:*:*:*'}]}]}]})
+    write_cve_configurations(str(tmp_path / 'nvdcve-1.1-2017.json'), 2017, {
+        'CVE-2017-5645': [{'operator': 'OR', 'cpe_match': [{'vulnerable': True, 'cpe23Uri': log4j, 'versionEndExcluding': '2.8.2'}, 
+                                                           {'vulnerable': True, 'cpe23Uri': 'cpe:2.3:a:apache:log4j:1.2:*:*:*:*:*:*:*'}]}]})
+    files = ['nvdcve-1.1-2017.json', 'nvdcve-1.1-2021.json']
+    loader = NVDLoader(elastic_url=url)
+    loader.ingest_bulk_json_dataset(files, 'nvd', data_path=str(tmp_path), verbose=False, ingest_method='streaming_bulk', 
+                                    cpe_index='cpe_to_cve', cpe_lookup_path=str(tmp_path / 'cpe_to_cve.sqlite'))
+    assert len(cluster.documents['nvd']) == 3
+    assert set(cluster.documents['cpe_to_cve']) == {log4j, 'cpe:2.3:a:apache:log4j:1.2:*:*:*:*:*:*:*'}
+    document = loader.lookup_cpe(log4j)
+    assert document['cve_ids'] == ['CVE-2017-5645', 'CVE-2021-44228', 'CVE-2021-45046'] and document['cve_count'] == 3
+    assert document['ranges'][1] == {'cve_id': 'CVE-2021-44228', 'versionStartIncluding': '2.0.1', 'versionEndExcluding': '2.3.1', 
+                                     'cpe': {'versionStartIncluding': 'D12.D10.D11.B', 'versionEndExcluding': 'D12.D13.D11.B'}}
+    key = NVD_Loader.cpe_version_keys(['2.10.0'])[0]
+    assert [entry['cve_id'] for entry in document['ranges'] if entry['cpe'].get('versionEndExcluding', '') > key] == ['CVE-2021-45046']
+    assert loader.lookup_cpe(log4j, lookup_path=str(tmp_path / 'cpe_to_cve.sqlite')) == document
+    assert loader.lookup_cpe('cpe:2.3:a:apache:tomcat:*:*:*:*:*:*:*:*') is None
+    assert loader.lookup_cpe('cpe:2.3:o:linux:linux_kernel:-:*:*:*:*:*:*:*', lookup_path=str(tmp_path / 'cpe_to_cve.sqlite')) is None
+    report = loader.parallel_ingest_json_dataset(files, 'nvd', data_path=str(tmp_path), processes=2, verbose=False, 
+                                                 cpe_lookup_path=str(tmp_path / 'parallel.sqlite'))
+    assert report['cpe_to_cve'] == {'cpe_uris': 2, 'written': 2}
+    assert loader.lookup_cpe(log4j, lookup_path=str(tmp_path / 'parallel.sqlite')) == document
+    # a resume that skips files it already sent still indexes their CPEs, so republishing keeps their CVEs
+    checkpoint_path = str(tmp_path / 'checkpoint.sqlite')
+    for resume in (False, True):
+        output = loader.ingest_bulk_json_dataset(files, 'nvd', data_path=str(tmp_path), verbose=False, ingest_method='streaming_bulk', resume=resume, 
+                                                 checkpoint_path=checkpoint_path, cpe_index='cpe_to_cve')
+        assert output == f"{0 if resume else 3} documents sent to elasticsearch"
+        assert loader.lookup_cpe(log4j) == document
+    report = loader.parallel_ingest_json_dataset(files, 'nvd', data_path=str(tmp_path), processes=2, verbose=False, resume=True, checkpoint_path=checkpoint_path, 
+                                                 cpe_lookup_path=str(tmp_path / 'resumed.sqlite'))
+    assert report['successes'] == 0 and loader.lookup_cpe(log4j, lookup_path=str(tmp_path / 'resumed.sqlite')) == document
+
+
+def test_cpe_fields_hold_a_bounded_batch(loader):
+    pulled = []
+
+    def items():
+        for i in range(5000):
+            pulled.append(i)
+            yield {'cpe23Uri': f'cpe:2.3:a:vendor:product:1.{i}:*:*:*:*:*:*:*'}
+
+    documents = loader.with_cpe_fields(items(), lambda item: [item])
+    assert next(documents)['cpe']['version_key'] == 'D11.B'
+    assert len(pulled) == 500
+    pulled.clear()
+    documents = loader.with_cpe_fields(items(), lambda item: [item] * 4)
+    next(documents)
+    assert len(pulled) == 250
+
+
+def test_cpe_fields_and_sortable_version_keys(es_server, tmp_path):
+    url, cluster = es_server
+    frame = NVD_Loader.parse_cpe23_uris(['cpe:2.3:a:apache:log4j:2.0:beta9:*:*:*:*:*:*', 'cpe:2.3:a:vendor\\:name:product:1.0:*:*:*:*:*:*:*', 'not a cpe'])
+    assert frame.iloc[0][['part', 'vendor', 'product', 'version', 'update']].tolist() == ['a', 'apache', 'log4j', '2.0', 'beta9']
+    assert frame.iloc[1]['vendor'] == 'vendor:name'
+    assert frame.iloc[2].isna().all()
+    versions = ['10.0', '2.0', '2.0.1', '2.0rc1', '2.0-beta9', '2.0-dev', '2.0k', '2.14.1', '2.3', '2.3.1', '123456789', '99999999', '12345678901']
+    keys = NVD_Loader.cpe_version_keys(versions).tolist()
+    assert len(set(keys)) == len(keys)
+    assert [version for _, version in sorted(zip(keys, versions))] == ['2.0-dev', '2.0-beta9', '2.0rc1', '2.0', '2.0k', '2.0.1', '2.3', '2.3.1', '2.14.1', '10.0', 
+                                                                       '99999999', '123456789', '12345678901']
+    # trailing zeros, before the end or a pre-release tag, and leading ones do not change the version
+    assert NVD_Loader.cpe_version_keys(['2', '2.0', '2.0.0', '2.00']).nunique() == 1
+    assert NVD_Loader.cpe_version_keys(['2.0.0-rc1', '2.0rc1', '2_rc_1', '02.rc.01']).nunique() == 1
+    keys = NVD_Loader.cpe_version_keys(['2.0.0.1', '2.10', '20']).tolist()
+    assert keys == sorted(keys)
+    assert NVD_Loader.cpe_version_keys(['*', '-', None, '']).isna().all()
+    write_cve_configurations(str(tmp_path / 'nvdcve-1.1-2021.json'), 2021, {
+        'CVE-2021-44228': [{'operator': 'OR', 'cpe_match': [{'vulnerable': True, 'cpe23Uri': 'cpe:2.3:a:apache:log4j:*:*:*:*:*:*:*:*', 
+                                                             'versionStartIncluding': '2.0.1', 'versionEndExcluding': '2.15.0'}]}]})
+    loader = NVDLoader(elastic_url=url)
+    loader.ingest_bulk_json_dataset(['nvdcve-1.1-2021.json'], 'nvd', data_path=str(tmp_path), verbose=False, ingest_method='streaming_bulk')
+    cpe = cluster.documents['nvd']['CVE-2021-44228']['configurations']['nodes'][0]['cpe_match'][0]['cpe']
+    assert cpe == {'part': 'a', 'vendor': 'apache', 'product': 'log4j', 'version': '*', 'update': '*', 
+                   'versionStartIncluding': 'D12.D10.D11.B', 'versionEndExcluding': 'D12.D215.B'}
+    assert cpe['versionStartIncluding'] <= NVD_Loader.cpe_version_keys(['2.14.1'])[0] < cpe['versionEndExcluding']
+    assert NVD_Loader.cpe_version_keys(['2.15.0-rc1'])[0] < cpe['versionEndExcluding']
+    # each match is its own nested document, so its bounds are never paired with a sibling's
+    nodes = cluster.mappings['nvd']['properties']['configurations']['properties']['nodes']['properties']
+    assert nodes['cpe_match']['type'] == nodes['children']['properties']['cpe_match']['type'] == 'nested'
+    assert set(loader.index_mappings['cpe_match']['properties']['cpe']['properties']) >= {'product', 'version_key', 'versionEndExcluding'}
+
+
+def mapped_paths(mapping, prefix=''):
+    for field, spec in mapping.get('properties', {}).items():
+        yield prefix + field
+        yield from mapped_paths(spec, prefix + field + '.')
+
+
+def document_paths(document, prefix=''):
+    for field, value in document.items():
+        for value in value if isinstance(value, list) else [value]:
+            if isinstance(value, dict):
+                yield from document_paths(value, prefix + field + '.')
+            else:
+                yield prefix + field
+
+
+def test_nvd_index_maps_nested_configuration_children(es_server, tmp_path):
+    url, cluster = es_server
+    write_cve_configurations(str(tmp_path / 'nvdcve-1.1-2021.json'), 2021, {
+        'CVE-2021-45046': [{'operator': 'AND', 'children': [
+            {'operator': 'OR', 'cpe_match': [{'vulnerable': True, 'cpe23Uri': 'cpe:2.3:a:apache:log4j:*:*:*:*:*:*:*:*', 'versionEndExcluding': '2.12.2'}]},
+            {'operator': 'OR', 'cpe_match': [{'vulnerable': False, 'cpe23Uri': 'cpe:2.3:o:linux:linux_kernel:-:*:*:*:*:*:*:*'}]}]}]})
+    loader = NVDLoader(elastic_url=url)
+    assert loader.index_mappings is NVD_Loader.INDEX_MAPPINGS
+    loader.ingest_bulk_json_dataset(['nvdcve-1.1-2021.json'], 'nvd', data_path=str(tmp_path), verbose=False, ingest_method='streaming_bulk')
+    assert cluster.mappings['nvd'] == NVD_Loader.INDEX_MAPPINGS['nvd']
+    configurations = cluster.documents['nvd']['CVE-2021-45046']['configurations']
+    paths = set(document_paths(configurations, 'configurations.'))
+    assert {'configurations.nodes.children.cpe_match.cpe23Uri', 'configurations.nodes.children.cpe_match.cpe.product', 
+            'configurations.nodes.children.cpe_match.cpe.versionEndExcluding'} <= paths
+    # every field of an AND configuration's children is searchable, not just kept in _source
+    assert paths <= set(mapped_paths(cluster.mappings['nvd']))
+
+
+def test_coalesce_feeds_sends_newest_version_once(es_server, tmp_path):
+    url, cluster = es_server
+    write_cve_archive(str(tmp_path / 'nvdcve-1.1-modified.json.zip'), 2021, 10, last_modified='2021-06-01T00:00Z')
+    write_cve_archive(str(tmp_path / 'nvdcve-1.1-2021.json.zip'), 2021, 50)
+    write_cve_archive(str(tmp_path / 'nvdcve-1.1-2022.json.zip'), 2022, 20)
+    files = ['nvdcve-1.1-modified.json.zip', 'nvdcve-1.1-2021.json.zip', 'nvdcve-1.1-2022.json.zip']
+    loader = NVDLoader(elastic_url=url)
+    keep = loader.coalesce_feeds(files, data_path=str(tmp_path), verbose=False)
+    # odd items of the modified feed are newer, even ones tie with the yearly feed and go to the later file
+    assert keep['nvdcve-1.1-modified.json.zip'].tolist() == [i % 2 == 1 for i in range(10)]
+    assert keep['nvdcve-1.1-2021.json.zip'].tolist() == [i >= 10 or i % 2 == 0 for i in range(50)]
+    assert keep['nvdcve-1.1-2022.json.zip'].all()
+    loader.cache_dir = str(tmp_path / 'cache')
+    cached = loader.coalesce_feeds(files, data_path=str(tmp_path), parse_method='cache', verbose=False)
+    assert all((cached[file] == keep[file]).all() for file in files)
+    output = loader.ingest_bulk_json_dataset(files, 'nvd', data_path=str(tmp_path), verbose=False, ingest_method='streaming_bulk', coalesce=True)
+    assert output == '70 documents sent to elasticsearch'
+    # three coalescing passes so far, each dropping 10 superseded versions
+    assert loader.metrics.value('nvd_documents_coalesced_total') == 30
+    assert cluster.documents['nvd']['CVE-2021-0001']['lastModifiedDate'] == '2021-06-01T00:00Z'
+    cluster.documents['nvd'].clear()
+    report = loader.parallel_ingest_json_dataset(files, 'nvd', data_path=str(tmp_path), processes=2, verbose=False, coalesce=True)
+    assert (report['documents'], report['successes'], len(cluster.documents['nvd'])) == (70, 70, 70)
+    assert cluster.documents['nvd']['CVE-2021-0003']['lastModifiedDate'] == '2021-06-01T00:00Z'
+
+
+def test_resume_with_coalesce_restarts_files_whose_mask_changed(es_server, tmp_path):
+    url, cluster = es_server
+    write_cve_archive(str(tmp_path / 'nvdcve-1.1-modified.json.zip'), 2021, 10, last_modified='2021-06-01T00:00Z')
+    write_cve_archive(str(tmp_path / 'nvdcve-1.1-2021.json.zip'), 2021, 50)
+    write_cve_archive(str(tmp_path / 'nvdcve-1.1-2022.json.zip'), 2022, 20)
+    loader = NVDLoader(elastic_url=url)
+    options = {'data_path': str(tmp_path), 'verbose': False, 'ingest_method': 'streaming_bulk', 'coalesce': True, 'checkpoint_path': str(tmp_path / 'checkpoint.sqlite')}
+    assert loader.ingest_bulk_json_dataset(['nvdcve-1.1-modified.json.zip', 'nvdcve-1.1-2021.json.zip', 'nvdcve-1.1-2022.json.zip'], 'nvd', **options) == '70 documents sent to elasticsearch'
+    assert loader.ingest_bulk_json_dataset(['nvdcve-1.1-modified.json.zip', 'nvdcve-1.1-2021.json.zip', 'nvdcve-1.1-2022.json.zip'], 'nvd', resume=True, **options) == '0 documents sent to elasticsearch'
+    # without the modified feed every item of the 2021 feed is kept, so its offset under the old mask no longer applies
+    cluster.documents['nvd'].clear()
+    assert loader.ingest_bulk_json_dataset(['nvdcve-1.1-2021.json.zip', 'nvdcve-1.1-2022.json.zip'], 'nvd', resume=True, **options) == '50 documents sent to elasticsearch'
+    assert sorted(cluster.documents['nvd']) == [f'CVE-2021-{i:04d}' for i in range(50)]
+    assert NVD_Loader.mask_digest([True, False]) != NVD_Loader.mask_digest([True, False, False])
+
+
+def test_iter_json_array_across_chunk_boundaries():
+    # strings with escapes and brackets, and decoy keys before the real one, split at every possible point
+    items = [{'s': 'a"b\\c]}[{,', 'u': 'é☃ "CVE_Items": [', 'n': [1, [2, {}], -1.5e3]}, {'x': None, 'y': True}, {'s': '\\'}, {}]
+    document = {'CVE_data_type': 'CVE_Items', 'nested': {'CVE_Items': 'x', 'list': [{'CVE_Items': [1]}]}, 'CVE_Items': items, 'CVE_data_numberOfCVEs': '4'}
+    for text in (json.dumps(document), json.dumps(document, ensure_ascii=False, indent=2)):
+        expected = json.load(io.StringIO(text))['CVE_Items']
+        for chunk_size in range(1, 17):
+            assert list(NVD_Loader.iter_json_array(io.StringIO(text), 'CVE_Items', chunk_size=chunk_size)) == expected, chunk_size
+    assert list(NVD_Loader.iter_json_array(io.StringIO('{"key": "CVE_Items"}'), 'CVE_Items', chunk_size=2)) == []
+    with pytest.raises(ValueError):
+        list(NVD_Loader.iter_json_array(io.StringIO('{"CVE_Items": {"CVE_Items": []}}'), 'CVE_Items', chunk_size=3))
+    with pytest.raises(ValueError):
+        list(NVD_Loader.iter_json_array(io.StringIO('{"CVE_Items": [{"a": 1}, {"b":'), 'CVE_Items', chunk_size=4))
+
+
+def test_bounded_action_buffer_keeps_order_and_budget(monkeypatch):
+    encoded = []
+    dumps_json = NVD_Loader.dumps_json
+    monkeypatch.setattr(NVD_Loader, 'dumps_json', lambda document: encoded.append(1) or dumps_json(document))
+    actions = [{'_id': str(i), '_source': {'text': 'x' * 1000}} for i in range(500)]
+    buffer = NVD_Loader.BoundedActionBuffer(iter(actions), max_inflight_bytes=10 * 1024)
+    held, ids = [], []
+    for action in buffer:
+        held.append(buffer.inflight_bytes)
+        ids.append(action['_id'])
+        time.sleep(0.0005)
+    assert ids == [str(i) for i in range(500)]
+    assert max(held) <= 10 * 1024
+    assert len(encoded) == 5
+    # with a size_of every action is measured by it instead
+    assert list(NVD_Loader.BoundedActionBuffer(iter(actions), max_inflight_bytes=10, size_of=len)) == actions
+
+
+def test_bounded_action_buffer_raises_producer_errors():
+    def actions():
+        yield {'_source': {}}
+        raise ValueError('bad item')
+    with pytest.raises(ValueError, match='bad item'):
+        list(NVD_Loader.BoundedActionBuffer(actions()))
+
+
+def test_ingest_reads_zip_archives_in_place(local_loader, es_server, feed_server, tmp_path):
+    _, cluster = es_server
+    _, served = feed_server
+    with zipfile.ZipFile(served / 'nvdcve-1.1-2020.json.zip') as archive:
+        archive.extractall(tmp_path)
+    with NVD_Loader.open_feed(str(served / 'nvdcve-1.1-2020.json.zip')) as f:
+        archived = json.load(f)
+    with NVD_Loader.open_feed(str(tmp_path / 'nvdcve-1.1-2020.json')) as f:
+        assert json.load(f) == archived
+    output = local_loader.ingest_bulk_json_dataset(['nvdcve-1.1-2020.json.zip', 'nvdcve-1.1-2020.meta'], 'nvd', data_path=str(served), verbose=False, ingest_method='bulk')
+    assert output == '50 documents sent to elasticsearch'
+    assert sorted(cluster.documents['nvd']) == sorted(item['cve']['CVE_data_meta']['ID'] for item in archived['CVE_Items'])